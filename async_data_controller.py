@@ -0,0 +1,81 @@
+"""An asyncio facade over `DataController`, for the event loop of the UI.
+
+All calls run one after the other on a single DB worker thread, and return
+asyncio futures:
+
+  adc = AsyncDataController(dc)
+  accounts = await adc.get_all_accounts(category=0)
+  # Several calls on one connection:
+  accounts, totals = await adc.run(
+    lambda dc: (dc.get_all_accounts(), dc.get_category_totals()))
+
+Since there is only one worker, calls are run in the order they were made,
+e.g., a refresh made after a commit sees the committed data.
+
+Cancelling a future skips its call if it has not started yet. Calls of the
+`get_*` methods, and `run(..., interruptible=True)`, are interrupted if they
+already started, see `sqlite3.Connection.interrupt`.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+
+import data_controller
+
+import logging
+
+logger = logging.getLogger()
+
+
+class AsyncDataController(object):
+  def __init__(self, dc: data_controller.DataController):
+    self.dc = dc
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=1, thread_name_prefix='DataControllerWorker')
+    self._lock = threading.Lock()
+    self._running = None  # (job, connection) of the call on the worker.
+
+  def run(self, fn, *args, interruptible=False) -> asyncio.Future:
+    """Runs `fn(dc, *args)` on the worker thread, with one connection.
+
+    Must be called from the thread of the running event loop. The call is
+    queued right away, not when the future is awaited.
+    """
+    job = object()
+    future = asyncio.wrap_future(
+      self._executor.submit(self._call, job, fn, args))
+    if interruptible:
+      future.add_done_callback(
+        lambda f: f.cancelled() and self._interrupt(job))
+    return future
+
+  def close(self):
+    """Waits for the queued calls, and stops the worker thread."""
+    self._executor.shutdown(wait=True)
+
+  def __getattr__(self, name):
+    """Async versions of the methods of the `DataController`."""
+    if not callable(getattr(self.dc, name)):
+      raise AttributeError(name)
+
+    def call(*args, **kwargs):
+      return self.run(lambda dc: getattr(dc, name)(*args, **kwargs),
+                      interruptible=name.startswith('get_'))
+    return call
+
+  def _call(self, job, fn, args):
+    with self.dc.connect() as c:
+      with self._lock:
+        self._running = job, c.connection
+      try:
+        return fn(self.dc, *args)
+      finally:
+        with self._lock:
+          self._running = None
+
+  def _interrupt(self, job):
+    with self._lock:
+      if self._running and self._running[0] is job:
+        logger.info('Interrupting a cancelled query.')
+        self._running[1].interrupt()
@@ -0,0 +1,380 @@
+"""Benchmarks for the DataController and the summary rendering.
+
+Runs fully offline on a synthetic db: quotes are replayed from a file (see
+`symbol_values.RecordedQuoteProvider`), symbols are not checked. Results
+are written as JSON, so runs of different commits can be compared:
+
+  python benchmark.py --output before.json
+  (change things)
+  python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+import async_data_controller
+import data_controller
+import helpers
+import projection
+import symbol_values
+
+logger = logging.getLogger()
+
+_CURRENCIES = ('CHF', 'USD')
+_BASE_DATE = helpers.parse_date('2015-01-01')
+_DAY = 24 * 60 * 60
+
+
+class SyntheticData(object):
+  def __init__(self, num_accounts, num_transactions, num_symbols, num_trades,
+               seed=0):
+    self.num_accounts = num_accounts
+    self.num_transactions = num_transactions
+    self.num_symbols = num_symbols
+    self.num_trades = num_trades
+    self.rand = random.Random(seed)
+    self.accounts = [(f'Account{i:04d}', self.rand.choice(_CURRENCIES),
+                      int(i % 10 == 9))  # Every 10th is category 1.
+                     for i in range(num_accounts)]
+    self.symbols = [(f'SYM{i:04d}', self.rand.choice(_CURRENCIES))
+                    for i in range(num_symbols)]
+    self.prices = {symbol: self.rand.uniform(5, 500)
+                   for symbol, _ in self.symbols}
+
+  def transactions(self):
+    """Yields (account, value, date, info), in date order."""
+    for i in range(self.num_transactions):
+      account, _, _ = self.rand.choice(self.accounts)
+      yield (account, round(self.rand.uniform(-500, 1000), 2),
+             _BASE_DATE + i * 600, f'Transaction {i}')
+
+  def trades(self):
+    """Yields (symbol, currency, quantity, proceeds, date), in date order."""
+    holdings = {symbol: 0 for symbol, _ in self.symbols}
+    for i in range(self.num_trades):
+      symbol, currency = self.rand.choice(self.symbols)
+      quantity = self.rand.randint(1, 50)
+      if holdings[symbol] > quantity and self.rand.random() < 0.4:
+        quantity = -quantity
+      holdings[symbol] += quantity
+      price = self.prices[symbol] * self.rand.uniform(0.8, 1.2)
+      yield (symbol, currency, quantity, round(-quantity * price, 2),
+             _BASE_DATE + i * _DAY // 4)
+
+  def write_ibkr_csv(self, path):
+    with open(path, 'w') as f:
+      f.write('Trades,Header,DataDiscriminator,Asset Category,Currency,'
+              'Symbol,Date/Time,Quantity,T. Price,Proceeds\n')
+      for symbol, currency, quantity, proceeds, date in self.trades():
+        date = helpers.format_date(date)
+        f.write(f'Trades,Data,Order,Stocks,{currency},{symbol},"{date}",'
+                f'{quantity},0,{proceeds}\n')
+      f.write('Financial Instrument Information,Header,Asset Category,'
+              'Symbol,Description,Listing Exch\n')
+      for symbol, _ in self.symbols:
+        f.write(f'Financial Instrument Information,Data,Stocks,{symbol},'
+                f'{symbol} INC,NASDAQ\n')
+
+
+def record_quotes(prices, path):
+  """Writes `prices` and FX rates as quotes to `path`."""
+  rand = random.Random(0)
+  fx = {f'{a}{b}=X': rand.uniform(0.8, 1.2)
+        for a in _CURRENCIES for b in _CURRENCIES if a != b}
+  for symbol, price in {**prices, **fx}.items():
+    symbol_values.RecordedQuoteProvider.write(
+      path, symbol, {'regularMarketOpen': price, 'shortName': symbol}, 0)
+
+
+def warm_quotes(symbols):
+  """Fetch all `symbols` once and make sure they are never refetched."""
+  futures = [symbol_values.Ticker.make(symbol).lazy_update(force=True)
+             for symbol in symbols]
+  concurrent.futures.wait(futures)
+  for symbol in symbols:
+    symbol_values.Ticker.make(symbol).query_cache_timeout_s = float('inf')
+
+
+def bench_quote_refresh(quotes_p, num_symbols, latency_s, error_rate):
+  """Refreshes `num_symbols` concurrently from a simulated provider."""
+  symbols = [f'REFRESH{i:04d}' for i in range(num_symbols)]
+  for symbol in symbols:
+    symbol_values.RecordedQuoteProvider.write(
+      quotes_p, symbol, {'regularMarketOpen': 1.}, 0)
+  provider = symbol_values.SimulatedQuoteProvider(
+    symbol_values.RecordedQuoteProvider(quotes_p), latency_s=latency_s,
+    latency_jitter_s=latency_s / 2, error_rate=error_rate, seed=0)
+  previous = symbol_values.set_provider(provider)
+  try:
+    def refresh():
+      futures = [symbol_values.Ticker.make(symbol).lazy_update(force=True)
+                 for symbol in symbols]
+      concurrent.futures.wait(futures)
+    result = _time(refresh, repeat=1)
+  finally:
+    symbol_values.set_provider(previous)
+  result['ops_per_s'] = num_symbols / result['median_s']
+  result['fetches'] = provider.num_fetches
+  result['errors'] = provider.num_errors
+  return result
+
+
+def _time(fn, repeat):
+  """Runs `fn` `repeat` times, returns the median and minimum in seconds."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    timings.append(time.perf_counter() - start)
+  return {'median_s': statistics.median(timings), 'min_s': min(timings)}
+
+
+def bench_add_transactions(data: SyntheticData, dc):
+  with dc.connect():
+    for name, currency, category in data.accounts:
+      dc.create_account(name, currency, category)
+  transactions = list(data.transactions())
+
+  def add():
+    with dc.connect():
+      for account, value, date, info in transactions:
+        dc.add_transaction(account, value, date, info)
+
+  result = _time(add, repeat=1)
+  result['ops_per_s'] = len(transactions) / result['median_s']
+  return result
+
+
+def bench_add_share_transactions(data: SyntheticData, dc):
+  trades = list(data.trades())
+
+  def add():
+    with dc.connect():
+      for symbol, currency in data.symbols:
+        dc.add_stock_symbol(symbol, currency)
+      for symbol, _, quantity, proceeds, date in trades:
+        dc.add_share_transaction(symbol, quantity, proceeds, date)
+
+  result = _time(add, repeat=1)
+  result['ops_per_s'] = len(trades) / result['median_s']
+  return result
+
+
+def bench_accounts_and_balances(dc, repeat):
+  def get():
+    with dc.connect():
+      for acc in dc.get_all_accounts():
+        acc.get_balance()
+        acc.get_diff_to_last()
+  return _time(get, repeat)
+
+
+def bench_symbol_overviews(dc, repeat):
+  def get():
+    with dc.connect():
+      for so in dc.get_all_symbol_overviews():
+        so.get_current_total_gain(currency='CHF')
+        so.get_current_total_value(currency='CHF')
+  return _time(get, repeat)
+
+
+def bench_search(data: SyntheticData, dc, repeat):
+  # A prefix and a word matching all rows, and a query matching one row.
+  queries = ['tra', 'transaction', f'transaction {data.num_transactions // 2}']
+
+  def search():
+    with dc.connect():
+      for query in queries:
+        dc.search_transactions(query)
+
+  result = _time(search, repeat)
+  result['ops_per_s'] = len(queries) / result['median_s']
+  return result
+
+
+def bench_projection(data: SyntheticData, repeat, num_paths=10000,
+                     num_steps=120, num_workers=0):
+  # Monthly prices, correlated through a common market return.
+  market = [data.rand.gauss(0.005, 0.04) for _ in range(num_steps)]
+  prices = {}
+  for symbol, _ in data.symbols:
+    price, prices[symbol] = 1., [1.]
+    for market_return in market:
+      price *= math.exp(market_return + data.rand.gauss(0.002, 0.05))
+      prices[symbol].append(price)
+  history = projection.History(prices)
+  portfolio = projection.Portfolio(
+    'CHF', 10000., {symbol: 1000. for symbol, _ in data.symbols})
+
+  def project():
+    projection.project(portfolio, history, num_steps, num_paths=num_paths,
+                       num_workers=num_workers)
+
+  result = _time(project, repeat)
+  result['ops_per_s'] = num_paths / result['median_s']
+  return result
+
+
+def bench_ibkr_import(data: SyntheticData, tmp_dir, repeat):
+  csv_p = os.path.join(tmp_dir, 'ibkr.csv')
+  data.write_ibkr_csv(csv_p)
+  check_symbols = symbol_values.check_symbols
+  symbol_values.check_symbols = (
+    lambda symbols, timeout_s=None: {symbol: symbol for symbol in symbols})
+  try:
+    def do_import():
+      db_p = os.path.join(tmp_dir, 'import.db')
+      if os.path.isfile(db_p):
+        os.remove(db_p)
+      with contextlib.redirect_stdout(io.StringIO()):
+        data_controller.import_files(data_controller.DataController(db_p),
+                                     [csv_p])
+    result = _time(do_import, repeat)
+  finally:
+    symbol_values.check_symbols = check_symbols
+  result['ops_per_s'] = data.num_trades / result['median_s']
+  return result
+
+
+def bench_summary_view(dc, repeat, size=(120, 60)):
+  # Imported here since main configures logging and creates the event loop.
+  import main
+  _quiet_logging()
+  controller = main.Controller()
+  adc = async_data_controller.AsyncDataController(dc)
+  view = main.SummaryView(adc, controller)
+  # The first load is not measured.
+  main._asyncio_loop.run_until_complete(view._task)
+
+  def render():
+    # As the view does it, but on this thread.
+    with dc.connect():
+      menu = view._get_menu(*view._load(dc))
+    canvas = menu.render(size, focus=True)
+    for _ in canvas.content():
+      pass
+  try:
+    return _time(render, repeat)
+  finally:
+    # Else quote updates would keep refreshing the view.
+    symbol_values.Ticker.remove_callback('SummaryView')
+    adc.close()
+
+
+def _quiet_logging():
+  # We don't want to measure writing the debug log.
+  logger.setLevel(logging.WARNING)
+
+
+def run(data: SyntheticData, repeat, num_quote_symbols=200):
+  _quiet_logging()
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    dc = data_controller.DataController(os.path.join(tmp_dir, 'bench.db'))
+    quotes_p = os.path.join(tmp_dir, 'quotes.jsonl')
+    record_quotes(data.prices, quotes_p)
+    previous_provider = symbol_values.set_provider(
+      symbol_values.RecordedQuoteProvider(quotes_p))
+    warm_quotes(symbol_values.get_provider()._quotes.keys())
+    benchmarks = [
+      ('add_transaction', lambda: bench_add_transactions(data, dc)),
+      ('add_share_transaction',
+       lambda: bench_add_share_transactions(data, dc)),
+      ('get_all_accounts+balances',
+       lambda: bench_accounts_and_balances(dc, repeat)),
+      ('get_all_symbol_overviews',
+       lambda: bench_symbol_overviews(dc, repeat)),
+      ('search_transactions', lambda: bench_search(data, dc, repeat)),
+      ('projection (paths)', lambda: bench_projection(data, repeat)),
+      ('ibkr_import', lambda: bench_ibkr_import(data, tmp_dir, repeat)),
+      ('SummaryView._get_menu+render',
+       lambda: bench_summary_view(dc, repeat)),
+      ('quote_refresh', lambda: bench_quote_refresh(
+        quotes_p, num_quote_symbols, latency_s=0.02, error_rate=0.05)),
+    ]
+    num_cpus = os.cpu_count() or 1
+    if num_cpus > 1:
+      benchmarks.append((f'projection (paths, {num_cpus} processes)',
+                         lambda: bench_projection(data, repeat,
+                                                  num_workers=num_cpus)))
+    try:
+      for name, fn in benchmarks:
+        results[name] = fn()
+        print(f'{name:40s} {_format_result(results[name])}')
+    finally:
+      symbol_values.set_provider(previous_provider)
+  return results
+
+
+def _format_result(result):
+  out = f'{result["median_s"] * 1000:10.2f} ms'
+  if 'ops_per_s' in result:
+    out += f' {result["ops_per_s"]:12,.0f} ops/s'
+  return out
+
+
+def _git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                          capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline):
+  print('-' * 20, f'Compared to {baseline["commit"]}:', sep='\n')
+  for name, result in results.items():
+    if name not in baseline['results']:
+      continue
+    ratio = result['median_s'] / baseline['results'][name]['median_s']
+    print(f'{name:40s} {ratio:6.2f}x time')
+
+
+def main():
+  p = argparse.ArgumentParser()
+  p.add_argument('--accounts', type=int, default=50)
+  p.add_argument('--transactions', type=int, default=20000)
+  p.add_argument('--symbols', type=int, default=30)
+  p.add_argument('--trades', type=int, default=5000)
+  p.add_argument('--quote_symbols', type=int, default=200,
+                 help='Number of symbols for the quote refresh load test.')
+  p.add_argument('--repeat', type=int, default=5)
+  p.add_argument('--seed', type=int, default=0)
+  p.add_argument('--output', '-o', help='Write results as JSON to this path.')
+  p.add_argument('--compare', help='JSON of an earlier run to compare to.')
+  flags = p.parse_args()
+
+  data = SyntheticData(flags.accounts, flags.transactions, flags.symbols,
+                       flags.trades, flags.seed)
+  results = run(data, flags.repeat, flags.quote_symbols)
+  output = {
+    'commit': _git_commit(),
+    'time': time.time(),
+    'params': {k: getattr(flags, k) for k in
+               ('accounts', 'transactions', 'symbols', 'trades',
+                'quote_symbols', 'repeat', 'seed')},
+    'results': results,
+  }
+  if flags.output:
+    with open(flags.output, 'w') as f:
+      json.dump(output, f, indent=2)
+  if flags.compare:
+    with open(flags.compare, 'r') as f:
+      compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,213 @@
+"""Downsampled terminal charts of long series, e.g. balances over time.
+
+A terminal chart has one column per character, so drawing years of history
+only needs a few numbers per column. `downsample` reduces the points within
+[start, end) to the span (lowest and highest value) of each column, either
+  - MINMAX: directly, which keeps every spike, or
+  - LTTB: via Largest-Triangle-Three-Buckets, which keeps the visual shape
+    with one point per column and connects consecutive points.
+Results are cached per (series, range, width, method), so redrawing after a
+resize or when panning back is free.
+
+  series = charts.Series('Bank', dates, balances)
+  lows, highs = charts.downsample(series, start, end, width=80)
+  lines = charts.render(lows, highs, height=20)
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+import profiling
+
+MINMAX = 'minmax'
+LTTB = 'lttb'
+METHODS = (MINMAX, LTTB)
+
+# Number of downsampled results kept, see `downsample`.
+_MAX_CACHED = 128
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class Series(object):
+  """A step function over time, such as a balance.
+
+  :param x: Sorted timestamps.
+  :param y: The value from each timestamp on.
+  """
+
+  def __init__(self, name, x, y):
+    self.name = name
+    self.x = np.asarray(x, dtype=np.float64)
+    self.y = np.asarray(y, dtype=np.float64)
+    if self.x.shape != self.y.shape:
+      raise ValueError(f'Shapes differ: {self.x.shape} / {self.y.shape}')
+    # Cached results of a series are invalid once it has new points.
+    self.key = (name, len(self.x),
+                (self.x[-1], self.y[-1]) if len(self.x) else None)
+
+  def __len__(self):
+    return len(self.x)
+
+
+def minmax(x, y, start, end, width):
+  """Spans of the step function (x, y) in `width` columns of [start, end).
+
+  :returns: (lows, highs), arrays of length `width`. A column spans the
+      points within it and the value it starts with, i.e., the last point
+      before it. Columns before the first point are NaN.
+  """
+  i0, i1 = np.searchsorted(x, [start, end])
+  xs, ys = x[i0:i1], y[i0:i1]
+  columns = ((xs - start) * (width / (end - start))).astype(np.int64)
+  np.clip(columns, 0, width - 1, out=columns)
+  # Index of the first point in each column, len(xs) if there is none.
+  firsts = np.searchsorted(columns, np.arange(width))
+  # The value at the start of each column.
+  before = np.concatenate(([y[i0 - 1] if i0 else np.nan], ys))[firsts]
+  lows, highs = before.copy(), before.copy()
+  non_empty = firsts < np.append(firsts[1:], len(xs))
+  if non_empty.any():
+    indices = firsts[non_empty]
+    lows[non_empty] = np.fmin(lows[non_empty],
+                              np.minimum.reduceat(ys, indices))
+    highs[non_empty] = np.fmax(highs[non_empty],
+                               np.maximum.reduceat(ys, indices))
+  return lows, highs
+
+
+def lttb(x, y, num_points):
+  """Largest-Triangle-Three-Buckets, selects `num_points` of (x, y).
+
+  The first and last point are kept, every bucket in between contributes
+  the point forming the largest triangle with the point selected in the
+  previous bucket and the average of the next bucket.
+  """
+  n = len(x)
+  if num_points >= n or num_points < 3:
+    return x, y
+  # Buckets [edges[i], edges[i + 1]) between the first and last point.
+  edges = np.linspace(1, n - 1, num_points - 1).astype(np.int64)
+  selected = np.empty(num_points, dtype=np.int64)
+  selected[0], selected[-1] = 0, n - 1
+  # Averages of all buckets at once, the last "bucket" is the last point.
+  counts = np.diff(np.append(edges, n))
+  avg_x = np.add.reduceat(x, edges) / counts
+  avg_y = np.add.reduceat(y, edges) / counts
+  a = 0
+  for i in range(num_points - 2):
+    lo, hi = edges[i], edges[i + 1]
+    areas = np.abs((x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) -
+                   (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+    a = lo + int(np.argmax(areas))
+    selected[i + 1] = a
+  return x[selected], y[selected]
+
+
+def combine(keys, y, weights):
+  """Weighted sum of several step functions, e.g. balances per currency.
+
+  :param keys: For each point, which step function it belongs to.
+  :param y: For each point, the new value of its step function.
+  :param weights: Maps keys to factors, e.g. exchange rates.
+  :returns: The sum at each point, step functions count as 0 before their
+      first point.
+  """
+  keys = np.asarray(keys)
+  y = np.asarray(y, dtype=np.float64)
+  positions = np.arange(len(y))
+  total = np.zeros(len(y))
+  for key, weight in weights.items():
+    # Index of the last point of `key` so far, -1 before the first.
+    last = np.maximum.accumulate(np.where(keys == key, positions, -1))
+    total += np.where(last >= 0, y[last], 0.) * weight
+  return total
+
+
+@profiling.timed('charts.downsample')
+def downsample(series: Series, start, end, width, method=MINMAX):
+  """Spans of `series` in `width` columns of [start, end), see `minmax`.
+
+  The result is cached and must not be modified.
+  """
+  key = (series.key, start, end, width, method)
+  with _cache_lock:
+    if key in _cache:
+      profiling.count('charts.cache_hit')
+      _cache.move_to_end(key)
+      return _cache[key]
+  if method == MINMAX:
+    result = minmax(series.x, series.y, start, end, width)
+  elif method == LTTB:
+    # Only the points in the range, plus the one it starts with.
+    i0, i1 = np.searchsorted(series.x, [start, end])
+    i0 = max(i0 - 1, 0)
+    x, y = lttb(series.x[i0:i1], series.y[i0:i1], width)
+    lows, highs = minmax(x, y, start, end, width)
+    # Connect each point to the next one.
+    result = (np.fmin(lows, np.append(lows[1:], np.nan)),
+              np.fmax(highs, np.append(highs[1:], np.nan)))
+  else:
+    raise ValueError(method)
+  with _cache_lock:
+    _cache[key] = result
+    while len(_cache) > _MAX_CACHED:
+      _cache.popitem(last=False)
+  return result
+
+
+def render(lows, highs, height, low=None, high=None, label=None, char='█'):
+  """Draws the spans as `height` lines of text, the top line first.
+
+  :param low: Value of the bottom line, defaults to the lowest value.
+  :param high: Value of the top line, defaults to the highest value.
+  :param label: If given, formats `high` and `low` to label the top and
+      bottom line.
+  """
+  width = len(lows)
+  drawn = ~np.isnan(lows)
+  if not drawn.any():
+    return [' ' * width for _ in range(height)]
+  low = np.nanmin(lows) if low is None else low
+  high = np.nanmax(highs) if high is None else high
+  scale = (height - 1) / (high - low) if high > low else 0.
+  # Rows counted from the bottom.
+  bottoms = np.round((np.where(drawn, lows, low) - low) * scale)
+  tops = np.round((np.where(drawn, highs, low) - low) * scale)
+  rows = np.arange(height - 1, -1, -1)[:, np.newaxis]
+  filled = (rows >= bottoms) & (rows <= tops) & drawn
+  chars = np.where(filled, char, ' ')
+  lines = [''.join(line) for line in chars]
+  return _add_labels(lines, low, high, label)
+
+
+def render_bands(bands, height, chars='░▒█', label=None):
+  """Draws nested spans, e.g. percentile bands, the inner ones on top.
+
+  :param bands: (lows, highs) per band, the outermost first.
+  :param chars: The character of each band.
+  :param label: See `render`.
+  """
+  lows = np.concatenate([band_lows for band_lows, _ in bands])
+  highs = np.concatenate([band_highs for _, band_highs in bands])
+  if np.isnan(lows).all():
+    return [' ' * len(bands[0][0]) for _ in range(height)]
+  low, high = np.nanmin(lows), np.nanmax(highs)
+  lines = None
+  for (band_lows, band_highs), char in zip(bands, chars):
+    band = render(band_lows, band_highs, height, low, high, char=char)
+    lines = band if lines is None else [
+      ''.join(b if b != ' ' else a for a, b in zip(line, band_line))
+      for line, band_line in zip(lines, band)]
+  return _add_labels(lines, low, high, label)
+
+
+def _add_labels(lines, low, high, label):
+  if label and len(lines) > 1:
+    for row, value in ((0, high), (-1, low)):
+      text = label(value)
+      lines[row] = text + lines[row][len(text):]
+  return lines
@@ -1,14 +1,23 @@
 import argparse
 import collections
+import concurrent.futures
 import csv
 import contextlib
 import dataclasses
+import hashlib
 import json
+import re
 import sqlite3
 import os
-from datetime import datetime
-
-from helpers import OptionalFloat, OptionalBalance
+import queue
+import threading
+import zlib
+
+import helpers
+import lots
+import profiling
+import sql_trace
+from helpers import OptionalFloat, OptionalBalance, FixedBalance
 import symbol_values
 
 
@@ -26,60 +35,156 @@ class SymbolExistsException(Exception):
 
 
 class DataController(object):
-  def __init__(self, db_path):
+  """Access to the db, safe to use from several threads.
+
+  Each thread gets its own connection (see `connect`), and the db is in WAL
+  mode, so readers never block on writers. Background writes can also be
+  queued with `submit_write`, a single writer thread runs them in batches.
+  """
+
+  # Seconds to wait for the write lock of another connection.
+  _BUSY_TIMEOUT_S = 30
+  # Maximum number of queued writes committed in one transaction.
+  _MAX_WRITE_BATCH = 256
+  # Whether the add_*/create_* methods are supported.
+  read_only = False
+
+  def __init__(self, db_path, trace: sql_trace.QueryStats = None):
+    """
+    :param db_path: Path of the SQLite db, created if needed.
+    :param trace: If given, all queries are recorded in it.
+    """
     self.db_path = db_path
-    self.conn = None
-    self.num_conns = 0
+    self.trace = trace
+    self._local = threading.local()  # Per thread: conn, num_conns.
+    self._write_queue = queue.Queue()
+    self._writer = None
+    self._writer_lock = threading.Lock()
     self.setup()
 
   @contextlib.contextmanager
   def connect(self) -> sqlite3.Cursor:
-    if not self.conn:
-      self.conn = sqlite3.connect(self.db_path)
-    self.num_conns += 1
-    yield self.conn.cursor()
-    self.num_conns -= 1
-    if self.num_conns == 0:
-      logger.info('Commiting...')
-      self.conn.commit()
-      self.conn.close()
-      self.conn = None
+    """Yields a cursor of the connection of the current thread.
+
+    Nested calls share the connection, which is closed when the outermost
+    block exits. It is committed then, or rolled back if that block raises.
+    """
+    local = self._local
+    if not getattr(local, 'conn', None):
+      profiling.count('db.connect')
+      local.conn = self._open_connection()
+      local.num_conns = 0
+      if self.trace:
+        local.conn.set_trace_callback(self.trace.trace_callback)
+    local.num_conns += 1
+    is_ok = False
+    try:
+      if self.trace:
+        yield sql_trace.TracingCursor(local.conn.cursor(), self.trace)
+      else:
+        yield local.conn.cursor()
+      is_ok = True
+    finally:
+      local.num_conns -= 1
+      if local.num_conns == 0:
+        conn, local.conn = local.conn, None
+        try:
+          if is_ok:
+            logger.info('Commiting...')
+            with profiling.timer('db.commit'):
+              conn.commit()
+          else:
+            conn.rollback()
+        finally:
+          conn.close()
+
+  def _open_connection(self) -> sqlite3.Connection:
+    return sqlite3.connect(self.db_path, timeout=self._BUSY_TIMEOUT_S)
+
+  def submit_write(self, fn) -> concurrent.futures.Future:
+    """Run `fn(self)` on the writer thread, returns a future of its result.
+
+    Writes queued at the same time are committed in a single transaction.
+    If `fn` raises, only its own changes are rolled back.
+    """
+    future = concurrent.futures.Future()
+    with self._writer_lock:
+      if self._writer is None:
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name='DataControllerWriter',
+                                        daemon=True)
+        self._writer.start()
+      self._write_queue.put((fn, future))
+    return future
+
+  def close(self):
+    """Stops the writer thread after all queued writes are done."""
+    with self._writer_lock:
+      writer, self._writer = self._writer, None
+      if writer is None:
+        return
+      self._write_queue.put(None)
+    writer.join()
+
+  def _write_loop(self):
+    while True:
+      batch = [self._write_queue.get()]
+      while len(batch) < self._MAX_WRITE_BATCH:
+        try:
+          batch.append(self._write_queue.get_nowait())
+        except queue.Empty:
+          break
+      stop = None in batch
+      batch = [job for job in batch if job is not None]
+      # The futures are only resolved once the whole batch is committed.
+      results = []
+      try:
+        with profiling.timer('db.write_batch'), self.connect() as c:
+          # Else the first RELEASE would already commit.
+          c.execute('BEGIN')
+          for fn, future in batch:
+            if not future.set_running_or_notify_cancel():
+              continue
+            c.execute('SAVEPOINT write_job')
+            try:
+              results.append((future, fn(self), None))
+            except BaseException as e:
+              c.execute('ROLLBACK TO write_job')
+              c.execute('RELEASE write_job')
+              results.append((future, None, e))
+            else:
+              c.execute('RELEASE write_job')
+      except BaseException as e:
+        # Nothing of the batch was committed.
+        results = [(future, None, e) for future, _, _ in results]
+      for future, result, error in results:
+        if error is None:
+          future.set_result(result)
+        else:
+          future.set_exception(error)
+      if stop:
+        return
+
+  def trace_refresh(self, name):
+    """Context manager counting the queries within as one UI refresh."""
+    if self.trace:
+      return self.trace.refresh(name)
+    return contextlib.nullcontext()
 
   def setup(self):
-    if os.path.isfile(self.db_path):
-      return
-    print('Creating db...')
-    with self.connect() as c:
-      c.execute("""
-        CREATE TABLE accounts
-        (id INTEGER PRIMARY KEY, 
-         category INTEGER,
-         name text,
-         currency text)""")
-      c.execute("""
-        CREATE TABLE transactions
-        (id INTEGER PRIMARY KEY, 
-        accountID INTEGER,
-        date text,
-        info text,
-        value real,
-        balance_after real)""")
-      c.execute("""
-        CREATE TABLE stocks
-        (id INTEGER PRIMARY KEY,
-         symbol text,
-         currency text)
-        """)
-      c.execute("""
-        CREATE TABLE shareTransactions
-        (id INTEGER PRIMARY KEY,
-        symbolID INTEGER,
-        date text,
-        quantity int,   -- How many bought/sold
-        proceeds real,   
-        quantity_after int,
-        proceeds_after real)
-        """)
+    is_new = not os.path.isfile(self.db_path)
+    if is_new:
+      print('Creating db...')
+    with self.connect() as c:
+      # Persistent, readers don't block on writers and vice versa.
+      c.execute('PRAGMA journal_mode=WAL')
+      if is_new:
+        _create_tables_v0(c)
+      version, = c.execute('PRAGMA user_version').fetchone()
+      for version in range(version, len(_MIGRATIONS)):
+        logger.info(f'Migrating db to version {version + 1}...')
+        _MIGRATIONS[version](c)
+        c.execute(f'PRAGMA user_version = {version + 1}')
 
   def add_stock_symbol(self, symbol, currency):
     with self.connect() as c:
@@ -89,28 +194,98 @@ class DataController(object):
       c.execute('INSERT INTO stocks (symbol, currency) VALUES (?, ?)',
                 (symbol, currency))
 
-  def add_share_transaction(self, symbol, quantity, proceeds, date=None):
+  @profiling.timed('db.add_share_transaction')
+  def add_share_transaction(self, symbol, quantity, proceeds, date=None,
+                            content_hash=None):
+    """Add a trade, `proceeds` is in major units (see `helpers.to_minor`).
+
+    :param content_hash: Used by imports to skip known trades, must be unique.
+    """
+    date = helpers.parse_date(date) if date else helpers.now_timestamp()
     with self.connect() as c:
-      if not date:
-        date = datetime.now().strftime('%Y-%m-%d, %H:%M:%S')
-      quantity_so_far, proceeds_so_far, symbolID = self._fetch_symbol(symbol)
+      quantity_so_far, proceeds_so_far, symbolID, currency = \
+        self._fetch_symbol(symbol)
+      proceeds = helpers.to_minor(proceeds, currency)
       quantity_after = quantity_so_far + quantity
       proceeds_after = proceeds_so_far + proceeds
-      c.execute('INSERT INTO shareTransactions ('
-                'symbolID, date, quantity, proceeds, quantity_after, proceeds_after) '
-                'VALUES (?, ?, ?, ?, ?, ?)',
-                (symbolID, date, quantity, proceeds,
-                 quantity_after, proceeds_after))
+      self._insert_share_transaction(
+        c, symbolID, 'trade', date, quantity, proceeds,
+        quantity_after, proceeds_after, None, content_hash)
+
+  def add_stock_split(self, symbol, ratio: float, date=None,
+                      content_hash=None):
+    """Record a split of `ratio` new shares per old share (e.g. 4 for 4:1)."""
+    date = helpers.parse_date(date) if date else helpers.now_timestamp()
+    with self.connect() as c:
+      quantity_so_far, proceeds_so_far, symbolID, _ = self._fetch_symbol(symbol)
+      # Only right if the split is the latest, else the replay fixes it.
+      quantity = quantity_so_far * (ratio - 1)
+      self._insert_share_transaction(
+        c, symbolID, 'split', date, quantity, 0,
+        quantity_so_far + quantity, proceeds_so_far, ratio, content_hash)
+
+  def _insert_share_transaction(self, c, symbolID, kind, date,
+                                quantity, proceeds, quantity_after,
+                                proceeds_after, ratio, content_hash):
+    """Inserts a row and updates the position of the symbol."""
+    position = _load_current_position(c, symbolID)
+    c.execute("SELECT MAX(date), MAX(CASE WHEN kind='checkpoint' THEN date END) "
+              'FROM shareTransactions WHERE symbolID=?', (symbolID,))
+    last_date, checkpoint_date = c.fetchone()
+    if checkpoint_date is not None and date < checkpoint_date:
+      # We could not replay the archived trades.
+      raise ValueError(f'Cannot add trades before the compacted history, '
+                       f'i.e., before {helpers.format_date(checkpoint_date)}')
+    c.execute('INSERT INTO shareTransactions ('
+              'symbolID, kind, date, quantity, proceeds, '
+              'quantity_after, proceeds_after, ratio, hash) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+              (symbolID, kind, date, quantity, proceeds,
+               quantity_after, proceeds_after, ratio, content_hash))
+    if last_date is not None and date < last_date:
+      # Positions and running totals are in date order, so we have to replay.
+      _replay_positions(c, symbolID)
+    else:
+      position.apply(kind, date, quantity, proceeds, c.lastrowid, ratio)
+      _save_position(c, symbolID, position)
+
+  @profiling.timed('db.get_position')
+  def get_position(self, symbol) -> lots.Position:
+    with self.connect() as c:
+      _, _, symbolID, _ = self._fetch_symbol(symbol)
+      return _load_current_position(c, symbolID)
 
-  def get_all_symbol_overviews(self):
+  def rebuild_positions(self):
+    """Replay all share transactions into the lots/positions tables."""
+    with self.connect() as c:
+      _replay_positions(c)
+
+  def get_import_watermarks(self):
+    """Maps import sources to the date of the last row imported from them."""
     with self.connect() as c:
-      return [self.get_symbol_overview(res[0])
-              for res in c.execute('SELECT symbol FROM stocks')]
+      return dict(c.execute('SELECT source, last_date FROM importWatermarks'))
 
+  @profiling.timed('db.get_all_symbol_overviews')
+  def get_all_symbol_overviews(self):
+    with self.connect() as c:
+      # One query for all symbols, see `_fetch_symbol`.
+      return [SymbolOverview(self, symbol, quantity_after,
+                             FixedBalance(proceeds_after, currency), currency)
+              for symbol, currency, quantity_after, proceeds_after
+              in c.execute(
+                'SELECT s.symbol, s.currency, '
+                'IFNULL(t.quantity_after, 0), IFNULL(t.proceeds_after, 0) '
+                'FROM stocks s LEFT JOIN shareTransactions t ON t.id = ('
+                '  SELECT id FROM shareTransactions WHERE symbolID=s.id '
+                '  ORDER BY date DESC, id DESC LIMIT 1) '
+                'ORDER BY s.id')]
+
+  @profiling.timed('db.get_symbol_overview')
   def get_symbol_overview(self, symbol) -> 'SymbolOverview':
-    quantity_so_far, proceeds_so_far, _ = self._fetch_symbol(symbol)
+    quantity_so_far, proceeds_so_far, _, currency = self._fetch_symbol(symbol)
     return SymbolOverview(
-      self, symbol, quantity_so_far, proceeds_so_far)
+      self, symbol, quantity_so_far, FixedBalance(proceeds_so_far, currency),
+      currency)
 
   def get_currency_of_symbol(self, symbol):
     with self.connect() as c:
@@ -119,16 +294,17 @@ class DataController(object):
 
   def _fetch_symbol(self, symbol):
     with self.connect() as c:
-      c.execute('SELECT id FROM stocks WHERE symbol=?', (symbol,))
-      symbolID = c.fetchone()
-      if symbolID is None:
+      c.execute('SELECT id, currency FROM stocks WHERE symbol=?', (symbol,))
+      res = c.fetchone()
+      if res is None:
         raise UnknownSymbolException(symbol)
-      symbolID, = symbolID  # Unpack 1-tuple
+      symbolID, currency = res
+      # The running totals of the latest row, see `_replay_positions`.
       c.execute('SELECT quantity_after, proceeds_after FROM shareTransactions '
                 'WHERE symbolID=? '
-                'ORDER BY id DESC LIMIT 1', (symbolID,))
-      quantity_after, proceeds_after = c.fetchone() or (0, 0.)
-      return quantity_after, proceeds_after, symbolID
+                'ORDER BY date DESC, id DESC LIMIT 1', (symbolID,))
+      quantity_after, proceeds_after = c.fetchone() or (0, 0)
+      return quantity_after, proceeds_after, symbolID, currency
 
   def create_account(self, name, currency, category=0):
     with self.connect() as c:
@@ -138,64 +314,257 @@ class DataController(object):
       c.execute('INSERT INTO accounts (name, currency, category) VALUES (?, ?, ?)',
                 (name, currency, category))
 
+  @profiling.timed('db.get_all_accounts')
   def get_all_accounts(self, category=None):
+    """All accounts, with their last two balances fetched in the same query."""
     with self.connect() as c:
+      query = ('SELECT name, currency, b.balance, b.balance - b.last_value '
+               'FROM accounts a '
+               'LEFT JOIN accountBalances b ON b.accountID = a.id')
       if category is None:
-        results = c.execute('SELECT name, currency FROM accounts')
+        results = c.execute(query + ' ORDER BY a.id')
       else:
-        results = c.execute('SELECT name, currency FROM accounts '
-                            'WHERE category=?', (category,))
-      return [Account(self, name, currency) for name, currency in results]
-
-  def get_account_transactions(self, account_name):
+        results = c.execute(query + ' WHERE category=? ORDER BY a.id',
+                            (category,))
+      return [Account(self, name, currency,
+                      FixedBalance(balance or 0, currency),
+                      FixedBalance(last_balance or 0, currency))
+              for name, currency, balance, last_balance in results]
+
+  @profiling.timed('db.get_account_transactions')
+  def get_account_transactions(self, account_name, start=None, end=None):
+    """Transactions of `account_name`, ordered by date.
+
+    :param start: If given, only return transactions at or after this date.
+    :param end: If given, only return transactions strictly before this date.
+    """
     with self.connect() as c:
       c.execute('SELECT id, currency FROM accounts WHERE name=?', (account_name,))
       accountID, currency = c.fetchone()
-      return [AccountTransaction(date, info, OptionalBalance(value, currency))
-              for date, info, value
-              in c.execute('SELECT date, info, value FROM transactions '
-                           'WHERE accountID=?', (accountID,))]
+      where, params = _date_range_query(start, end)
+      return [AccountTransaction(date, info, FixedBalance(value, currency),
+                                 kind == 'checkpoint')
+              for date, info, value, kind
+              in c.execute('SELECT date, info, value, kind FROM transactions '
+                           'WHERE accountID=?' + where + ' '
+                           'ORDER BY date, id', (accountID, *params))]
+
+  @profiling.timed('db.get_balance_history')
+  def get_balance_history(self, account_name=None, category=None,
+                          start=None, end=None):
+    """Running balances after each transaction in a date range, for charts.
+
+    Archived transactions are summed up in their checkpoint, see `compact`.
+
+    :param account_name: Only this account, otherwise all accounts, or all of
+        `category` if given.
+    :returns: (date, currency, balance) tuples in date order, where
+        `balance` sums all selected accounts of `currency`, in minor units.
+    """
+    with self.connect() as c:
+      return _get_balance_history(c, ['main'], account_name, category, start,
+                                  end)
+
+  @profiling.timed('db.search_transactions')
+  def search_transactions(self, text, account_name=None, date_range=None,
+                          limit=50, offset=0):
+    """Transactions whose info contains all words of `text`, best first.
+
+    Ranked by bm25 of the FTS5 index `transactionsFts`. The last word also
+    matches as a prefix, for as-you-type queries. Archived transactions are
+    not searched, see `compact`.
+
+    Ranking needs all matches, so if there are more than `_MAX_RANKED`, e.g.
+    for a single letter, the most recently added ones come first instead.
+
+    :param account_name: If given, only search this account.
+    :param date_range: (start, end), as for `get_account_transactions`.
+    :returns: At most `limit` SearchResults, after skipping `offset`.
+    """
+    query = _fts_query(text)
+    if query is None:
+      return []
+    where, params = _search_conditions(account_name, date_range)
+    with self.connect() as c:
+      ranked = _num_matches(c, ['main'], query) <= _MAX_RANKED
+      results = c.execute(
+        _search_query(ranked).format(db='main', i=0) + where +
+        _search_order(ranked) + ' LIMIT ? OFFSET ?',
+        (query, *params, limit, offset))
+      return [SearchResult(name, AccountTransaction(
+                date, info, FixedBalance(value, currency)))
+              for _, name, currency, date, info, value, _ in results]
+
+  @profiling.timed('db.get_archived_transactions')
+  def get_archived_transactions(self, account_name, before=None):
+    """Transactions archived by `compact`, one archive at a time.
+
+    Archives are returned newest first.
+
+    :param before: Id of the archive returned by the previous call, None to
+        get the newest one.
+    :returns: (transactions ordered by date, id of their archive), or
+        ([], None) if there is no older archive.
+    """
+    with self.connect() as c:
+      return _get_archived_transactions(c, 'main', account_name, before)
+
+  @profiling.timed('db.get_balance_as_of')
+  def get_balance_as_of(self, account_name: str, date) -> FixedBalance:
+    """Balance of `account_name` including all transactions up to `date`."""
+    date = helpers.parse_date(date)
+    with self.connect() as c:
+      c.execute('SELECT id, currency FROM accounts WHERE name=?',
+                (account_name,))
+      accountID, currency = c.fetchone()
+      c.execute('SELECT IFNULL(SUM(value), 0) FROM transactions '
+                "WHERE accountID=? AND date<=? AND kind!='checkpoint'",
+                (accountID, date))
+      balance, = c.fetchone()
+      # Archives entirely before `date` are summed up already.
+      for total, rows in c.execute(
+          'SELECT total, CASE WHEN last_date>? THEN rows END '
+          'FROM transactionsArchive WHERE accountID=? AND first_date<=?',
+          (date, accountID, date)).fetchall():
+        if rows is None:
+          balance += total
+        else:
+          balance += sum(row['value']
+                         for row in _unpack_rows('transactions', rows)
+                         if row['date'] <= date)
+      return FixedBalance(balance, currency)
+
+  @profiling.timed('db.compact')
+  def compact(self, cutoff) -> int:
+    """Archives the rows before `cutoff` into compressed archive tables.
+
+    The archived rows of each account and symbol are replaced by one
+    checkpoint row with their running totals, and the latest row is always
+    kept. Balances, positions and imports are not affected, but shares
+    cannot be traded before the checkpoint anymore. See
+    `get_archived_transactions` for the archived transactions.
+
+    :returns: The number of rows archived.
+    """
+    cutoff = helpers.parse_date(cutoff)
+    num_archived = 0
+    with self.connect() as c:
+      for accountID, in c.execute('SELECT id FROM accounts').fetchall():
+        num_archived += _compact_transactions(c, accountID, cutoff)
+      for symbolID, in c.execute('SELECT id FROM stocks').fetchall():
+        num_archived += _compact_share_transactions(c, symbolID, cutoff)
+    return num_archived
+
+  @profiling.timed('db.get_category_totals')
+  def get_category_totals(self, category=None):
+    """Sums the current balances of all accounts in `category`.
+
+    :returns: A dict mapping each currency to a pair of `FixedBalance`s:
+        (total balance, total diff of the last transactions).
+    """
+    with self.connect() as c:
+      # Maintained on write, see `_migrate_v6_aggregates`.
+      query = 'SELECT currency, SUM(total), SUM(diff) FROM categoryTotals '
+      if category is None:
+        results = c.execute(query + 'GROUP BY currency')
+      else:
+        results = c.execute(query + 'WHERE category=? GROUP BY currency',
+                            (category,))
+      return {currency: (FixedBalance(total, currency),
+                         FixedBalance(diff, currency))
+              for currency, total, diff in results}
 
+  @profiling.timed('db.add_transaction')
   def add_transaction(self,
                       account_name: str,
-                      value: float,
-                      date: str = None,
-                      info: str = ''):
-    if not date:
-      # TODO: Validate!
-      date = datetime.now().strftime('%Y-%m-%d, %H:%M:%S')
-    with self.connect() as c:
-      last_balance, accountID = self._get_last_balance(account_name)
+                      value,
+                      date=None,
+                      info: str = '',
+                      content_hash: str = None) -> FixedBalance:
+    """Add a transaction.
+
+    :param value: In major units, anything `helpers.to_minor` takes.
+    :param date: Anything `helpers.parse_date` takes, defaults to now.
+    :param content_hash: Used by imports to skip known entries, must be unique.
+    """
+    date = helpers.parse_date(date) if date else helpers.now_timestamp()
+    with self.connect() as c:
+      last_balance, accountID, currency = self._get_last_balance(account_name)
+      value = helpers.to_minor(value, currency)
       new_balance = last_balance + value
       c.execute('INSERT INTO transactions '
-                '(accountID, date, info, value, balance_after) '
+                '(accountID, date, info, value, balance_after, hash) '
                 'VALUES '
-                '(?, ?, ?, ?, ?)',
-                (accountID, date, info, value, new_balance))
-      return new_balance
-
-  def get_balance(self, account_name: str, index=-1) -> float:
+                '(?, ?, ?, ?, ?, ?)',
+                (accountID, date, info, value, new_balance, content_hash))
+      return FixedBalance(new_balance, currency)
+
+  @profiling.timed('db.add_transactions')
+  def add_transactions(self, transactions, date=None,
+                       info: str = '') -> list:
+    """Add many transactions at once, in one transaction.
+
+    :param transactions: Iterable of (account name, value), see
+        `add_transaction`. An account may appear more than once.
+    :returns: The new balance after each transaction.
+    """
+    date = helpers.parse_date(date) if date else helpers.now_timestamp()
+    transactions = list(transactions)
+    with self.connect() as c:
+      # There are few accounts, simpler to get all than to build an IN query.
+      accounts = {name: [accountID, currency, balance]
+                  for name, accountID, currency, balance in c.execute(
+                    'SELECT a.name, a.id, a.currency, IFNULL(b.balance, 0) '
+                    'FROM accounts a '
+                    'LEFT JOIN accountBalances b ON b.accountID = a.id')}
+      rows = []
+      balances = []
+      for account_name, value in transactions:
+        if account_name not in accounts:
+          raise ValueError(f'Unknown account: {account_name}')
+        account = accounts[account_name]
+        accountID, currency, balance = account
+        value = helpers.to_minor(value, currency)
+        account[2] = balance + value
+        rows.append((accountID, date, info, value, account[2]))
+        balances.append(FixedBalance(account[2], currency))
+      c.executemany('INSERT INTO transactions '
+                    '(accountID, date, info, value, balance_after) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+      return balances
+
+  @profiling.timed('db.get_balance')
+  def get_balance(self, account_name: str, index=-1) -> FixedBalance:
     with self.connect() as c:
-      last_balance, _ = self._get_last_balance(account_name, index)
-      return last_balance
+      last_balance, _, currency = self._get_last_balance(account_name, index)
+      return FixedBalance(last_balance, currency)
 
-  def _get_last_balance(self, account_name, index=-1):
+  def _get_last_balance(self, account_name, index=-1, db='main'):
+    """`db` is the schema of the account, see `PortfolioDataController`."""
     if index >= 0:
       raise NotImplementedError(index)
     with self.connect() as c:
-      c.execute('SELECT id FROM accounts WHERE name=?', (account_name,))
-      accountID, = c.fetchone()
+      if index == -1:
+        c.execute('SELECT a.id, a.currency, IFNULL(b.balance, 0) '
+                  f'FROM {db}.accounts a '
+                  f'LEFT JOIN {db}.accountBalances b ON b.accountID = a.id '
+                  'WHERE a.name=?', (account_name,))
+        accountID, currency, last_balance = c.fetchone()
+        return last_balance, accountID, currency
+      c.execute(f'SELECT id, currency FROM {db}.accounts WHERE name=?',
+                (account_name,))
+      accountID, currency = c.fetchone()
       c.execute(
-        'SELECT balance_after FROM transactions '
+        f'SELECT balance_after FROM {db}.transactions '
         'WHERE accountID=? '
         f'ORDER BY id DESC LIMIT {abs(index)} ',
         (accountID,))
       res = c.fetchall()
       if not res:
-        last_balance = 0.
+        last_balance = 0
       else:
         last_balance, = res[-1]
-      return last_balance, accountID
+      return last_balance, accountID, currency
 
 
 @dataclasses.dataclass
@@ -203,26 +572,951 @@ class Account:
   dc: DataController
   name: str
   currency: str
-  _balance: float = None
-  _last_balance: float = None
+  _balance: FixedBalance = None
+  _last_balance: FixedBalance = None
 
-  def get_diff_to_last(self) -> OptionalBalance:
-    return OptionalBalance(
-      self.get_balance() - _lazy(self, '_last_balance',
-                                 lambda: self.dc.get_balance(self.name, -2)),
-      self.currency)
+  def get_diff_to_last(self) -> FixedBalance:
+    return self.get_balance() - _lazy(
+      self, '_last_balance', lambda: self.dc.get_balance(self.name, -2))
 
-  def get_balance(self) -> OptionalBalance:
-    return OptionalBalance(
-      _lazy(self, '_balance', lambda: self.dc.get_balance(self.name)),
-      self.currency)
+  def get_balance(self) -> FixedBalance:
+    return _lazy(self, '_balance', lambda: self.dc.get_balance(self.name))
 
 
 @dataclasses.dataclass
 class AccountTransaction:
-  date: str
+  timestamp: int  # See `helpers.parse_date`.
   info: str
-  value: OptionalBalance
+  value: FixedBalance
+  # Sum of the archived transactions, see `DataController.compact`.
+  is_checkpoint: bool = False
+
+  @property
+  def date(self) -> str:
+    return helpers.format_date(self.timestamp)
+
+
+@dataclasses.dataclass
+class SearchResult:
+  account_name: str
+  transaction: AccountTransaction
+
+
+class PortfolioDataController(DataController):
+  """Read-only view of several dbs, e.g. one per person, as one portfolio.
+
+  All dbs are attached to the connection of each thread, and the summary
+  queries are single `UNION ALL` statements over all of them. Account names
+  are qualified with the name of their db (the file name without extension),
+  as in 'alice/Bank'. Shares and positions of the same symbol are added up.
+  Other methods only see the first db.
+  """
+
+  read_only = True
+
+  def __init__(self, db_paths, trace: sql_trace.QueryStats = None):
+    """
+    :param db_paths: Paths of existing SQLite dbs, migrated if needed.
+    """
+    self.db_paths = list(db_paths)
+    self.names = [os.path.splitext(os.path.basename(db_path))[0]
+                  for db_path in self.db_paths]
+    if len(set(self.names)) != len(self.names):
+      raise ValueError(f'File names must be unique: {self.db_paths}')
+    # The first db is `main`, see `_open_connection`.
+    self._schemas = ['main'] + [f'db{i}' for i in range(1, len(db_paths))]
+    super().__init__(self.db_paths[0], trace)
+
+  def setup(self):
+    for db_path in self.db_paths:
+      if not os.path.isfile(db_path):
+        raise FileNotFoundError(db_path)
+      # Own connection without `query_only`, for migrations.
+      DataController(db_path)
+
+  def _open_connection(self) -> sqlite3.Connection:
+    conn = super()._open_connection()
+    for schema, db_path in zip(self._schemas[1:], self.db_paths[1:]):
+      conn.execute(f'ATTACH DATABASE ? AS {schema}', (db_path,))
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+  def _union_all(self, query):
+    """Joins `query` for each db.
+
+    `{db}` is replaced by the schema name of the db, `{i}` by its index.
+    """
+    return ' UNION ALL '.join(query.format(db=schema, i=i)
+                              for i, schema in enumerate(self._schemas))
+
+  def _split_account_name(self, account_name):
+    """Returns the schema and the account name within that db."""
+    name, _, name_in_db = account_name.partition('/')
+    if name not in self.names:
+      raise ValueError(f'Not a portfolio account: {account_name}')
+    return self._schemas[self.names.index(name)], name_in_db
+
+  @profiling.timed('db.get_all_accounts')
+  def get_all_accounts(self, category=None):
+    where = '' if category is None else ' WHERE a.category=?'
+    params = () if category is None else (category,) * len(self._schemas)
+    with self.connect() as c:
+      results = c.execute(
+        self._union_all(
+          'SELECT {i}, a.id, a.name, a.currency, b.balance, '
+          'b.balance - b.last_value '
+          'FROM {db}.accounts a '
+          'LEFT JOIN {db}.accountBalances b ON b.accountID = a.id' + where) +
+        ' ORDER BY 1, 2', params)
+      return [Account(self, f'{self.names[i]}/{name}', currency,
+                      FixedBalance(balance or 0, currency),
+                      FixedBalance(last_balance or 0, currency))
+              for i, _, name, currency, balance, last_balance in results]
+
+  @profiling.timed('db.get_account_transactions')
+  def get_account_transactions(self, account_name, start=None, end=None):
+    schema, account_name = self._split_account_name(account_name)
+    with self.connect() as c:
+      c.execute(f'SELECT id, currency FROM {schema}.accounts WHERE name=?',
+                (account_name,))
+      accountID, currency = c.fetchone()
+      where, params = _date_range_query(start, end)
+      return [AccountTransaction(date, info, FixedBalance(value, currency),
+                                 kind == 'checkpoint')
+              for date, info, value, kind
+              in c.execute('SELECT date, info, value, kind '
+                           f'FROM {schema}.transactions '
+                           'WHERE accountID=?' + where + ' '
+                           'ORDER BY date, id', (accountID, *params))]
+
+  @profiling.timed('db.search_transactions')
+  def search_transactions(self, text, account_name=None, date_range=None,
+                          limit=50, offset=0):
+    query = _fts_query(text)
+    if query is None:
+      return []
+    if account_name is None:
+      schemas = self._schemas
+      where, params = _search_conditions(None, date_range)
+    else:
+      schema, account_name = self._split_account_name(account_name)
+      schemas = [schema]
+      where, params = _search_conditions(account_name, date_range)
+    with self.connect() as c:
+      ranked = _num_matches(c, schemas, query) <= _MAX_RANKED
+      # bm25 ranks are per db, but comparable enough to be merged.
+      sql = ' UNION ALL '.join(
+        (_search_query(ranked) + where).format(
+          db=schema, i=self._schemas.index(schema))
+        for schema in schemas)
+      results = c.execute(sql + _search_order(ranked) + ' LIMIT ? OFFSET ?',
+                          ((query, *params) * len(schemas) + (limit, offset)))
+      return [SearchResult(f'{self.names[i]}/{name}', AccountTransaction(
+                date, info, FixedBalance(value, currency)))
+              for i, name, currency, date, info, value, _ in results]
+
+  @profiling.timed('db.get_archived_transactions')
+  def get_archived_transactions(self, account_name, before=None):
+    schema, account_name = self._split_account_name(account_name)
+    with self.connect() as c:
+      return _get_archived_transactions(c, schema, account_name, before)
+
+  @profiling.timed('db.get_balance')
+  def get_balance(self, account_name: str, index=-1) -> FixedBalance:
+    schema, account_name = self._split_account_name(account_name)
+    with self.connect() as c:
+      last_balance, _, currency = self._get_last_balance(account_name, index,
+                                                         schema)
+      return FixedBalance(last_balance, currency)
+
+  @profiling.timed('db.get_balance_history')
+  def get_balance_history(self, account_name=None, category=None,
+                          start=None, end=None):
+    schemas = self._schemas
+    if account_name is not None:
+      schema, account_name = self._split_account_name(account_name)
+      schemas = [schema]
+    with self.connect() as c:
+      return _get_balance_history(c, schemas, account_name, category, start,
+                                  end)
+
+  @profiling.timed('db.get_category_totals')
+  def get_category_totals(self, category=None):
+    where = '' if category is None else ' WHERE category=?'
+    params = () if category is None else (category,) * len(self._schemas)
+    with self.connect() as c:
+      results = c.execute(
+        'SELECT currency, SUM(total), SUM(diff) FROM (' +
+        self._union_all('SELECT currency, total, diff '
+                        'FROM {db}.categoryTotals' + where) +
+        ') GROUP BY currency', params)
+      return {currency: (FixedBalance(total, currency),
+                         FixedBalance(diff, currency))
+              for currency, total, diff in results}
+
+  @profiling.timed('db.get_position')
+  def get_position(self, symbol) -> lots.Position:
+    """The positions of `symbol` in all dbs, see `lots.combine`.
+
+    They are not replayed, which needs writing, but every write keeps them
+    current anyway.
+    """
+    with self.connect() as c:
+      results = c.execute(self._union_all(
+        "SELECT '{db}', id FROM {db}.stocks WHERE symbol=?"),
+        (symbol,) * len(self._schemas)).fetchall()
+      if not results:
+        raise UnknownSymbolException(symbol)
+      return lots.combine(_load_position(c, symbolID, schema)
+                          for schema, symbolID in results)
+
+  def get_currency_of_symbol(self, symbol):
+    with self.connect() as c:
+      c.execute(self._union_all('SELECT currency FROM {db}.stocks '
+                                'WHERE symbol=?') + ' LIMIT 1',
+                (symbol,) * len(self._schemas))
+      res = c.fetchone()
+      if res is None:
+        raise UnknownSymbolException(symbol)
+      return res[0]
+
+  @profiling.timed('db.get_symbol_overview')
+  def get_symbol_overview(self, symbol) -> 'SymbolOverview':
+    for so in self.get_all_symbol_overviews():
+      if so.symbol == symbol:
+        return so
+    raise UnknownSymbolException(symbol)
+
+  @profiling.timed('db.get_all_symbol_overviews')
+  def get_all_symbol_overviews(self):
+    with self.connect() as c:
+      results = c.execute(
+        'SELECT symbol, currency, SUM(quantity), SUM(proceeds) FROM (' +
+        self._union_all(
+          'SELECT {i} AS i, s.id, s.symbol, s.currency, '
+          'IFNULL(t.quantity_after, 0) AS quantity, '
+          'IFNULL(t.proceeds_after, 0) AS proceeds '
+          'FROM {db}.stocks s LEFT JOIN {db}.shareTransactions t ON t.id = ('
+          '  SELECT id FROM {db}.shareTransactions WHERE symbolID=s.id '
+          '  ORDER BY date DESC, id DESC LIMIT 1)') +
+        ') GROUP BY symbol, currency ORDER BY MIN(i), MIN(id)')
+      return [SymbolOverview(self, symbol, quantity,
+                             FixedBalance(proceeds, currency), currency)
+              for symbol, currency, quantity, proceeds in results]
+
+
+def _get_balance_history(c: sqlite3.Cursor, schemas, account_name, category,
+                         start, end):
+  """See `DataController.get_balance_history`, summed over all `schemas`."""
+  conditions, params = [], []
+  if account_name is not None:
+    conditions.append('a.name=?')
+    params.append(account_name)
+  if category is not None:
+    conditions.append('a.category=?')
+    params.append(category)
+  if end is not None:
+    conditions.append('t.date<?')
+    params.append(helpers.parse_date(end))
+  where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+  start = helpers.parse_date(start) if start is not None else None
+  transactions = ' UNION ALL '.join(
+    f'SELECT {i} AS i, t.id, t.date, a.currency, t.value '
+    f'FROM {db}.transactions t JOIN {db}.accounts a ON a.id = t.accountID' +
+    where for i, db in enumerate(schemas))
+  # The balances at `start` need everything before it, so `start` is only
+  # applied after summing.
+  return c.execute(
+    'SELECT date, currency, balance FROM ('
+    '  SELECT i, id, date, currency, SUM(value) OVER ('
+    '    PARTITION BY currency ORDER BY date, i, id) AS balance '
+    '  FROM (' + transactions + ')) '
+    'WHERE date>=IFNULL(?, date) ORDER BY date, i, id',
+    (*params * len(schemas), start)).fetchall()
+
+
+def _get_archived_transactions(c: sqlite3.Cursor, db, account_name, before):
+  """See `DataController.get_archived_transactions`, `db` is the schema."""
+  c.execute(f'SELECT id, currency FROM {db}.accounts WHERE name=?',
+            (account_name,))
+  accountID, currency = c.fetchone()
+  where, params = ('', ()) if before is None else (' AND id<?', (before,))
+  c.execute(f'SELECT id, rows FROM {db}.transactionsArchive '
+            'WHERE accountID=?' + where + ' ORDER BY id DESC LIMIT 1',
+            (accountID, *params))
+  res = c.fetchone()
+  if res is None:
+    return [], None
+  archiveID, rows = res
+  return [AccountTransaction(row['date'], row['info'],
+                             FixedBalance(row['value'], currency))
+          for row in _unpack_rows('transactions', rows)], archiveID
+
+
+def _load_position(c: sqlite3.Cursor, symbolID, db='main') -> lots.Position:
+  c.execute('SELECT average_cost, realized_fifo, realized_average, '
+            f'lastShareTransactionID FROM {db}.positions WHERE symbolID=?',
+            (symbolID,))
+  res = c.fetchone()
+  if res is None:
+    return lots.Position()
+  open_lots = [lots.Lot(date, quantity, cost) for date, quantity, cost in
+               c.execute(f'SELECT date, quantity, cost FROM {db}.lots '
+                         'WHERE symbolID=? ORDER BY id', (symbolID,))]
+  return lots.Position(open_lots, *res)
+
+
+def _load_current_position(c: sqlite3.Cursor, symbolID) -> lots.Position:
+  """Like `_load_position`, but replays the trades if it is outdated."""
+  position = _load_position(c, symbolID)
+  c.execute('SELECT IFNULL(MAX(id), 0) FROM shareTransactions '
+            'WHERE symbolID=?', (symbolID,))
+  last_id, = c.fetchone()
+  if position.last_transaction_id != last_id:
+    logger.info(f'Position of {symbolID} is outdated, replaying...')
+    _replay_positions(c, symbolID)
+    position = _load_position(c, symbolID)
+  return position
+
+
+def _save_position(c: sqlite3.Cursor, symbolID, position: lots.Position):
+  c.execute('DELETE FROM lots WHERE symbolID=?', (symbolID,))
+  c.executemany('INSERT INTO lots (symbolID, date, quantity, cost) '
+                'VALUES (?, ?, ?, ?)',
+                [(symbolID, lot.date, lot.quantity, lot.cost)
+                 for lot in position.lots])
+  c.execute('INSERT OR REPLACE INTO positions '
+            '(symbolID, average_cost, realized_fifo, realized_average, '
+            'lastShareTransactionID) VALUES (?, ?, ?, ?, ?)',
+            (symbolID, position.average_cost,
+             position.get_realized(lots.FIFO),
+             position.get_realized(lots.AVERAGE),
+             position.last_transaction_id))
+
+
+def _replay_positions(c: sqlite3.Cursor, symbolID=None):
+  """Rebuild positions in one streaming pass over shareTransactions.
+
+  Trades are applied in date order (trades with the same date by ID). The
+  running `quantity_after` and `proceeds_after` are recomputed on the way,
+  as is the `quantity` of splits, which follows from their `ratio`.
+  """
+  columns = [r[1] for r in c.execute('PRAGMA table_info(shareTransactions)')]
+  # Before `_migrate_v10_split_ratios` there are no split rows to replay.
+  ratio = 'ratio' if 'ratio' in columns else 'NULL'
+  query = 'SELECT id, symbolID, kind, date, quantity, proceeds, ' \
+          f'quantity_after, proceeds_after, {ratio} FROM shareTransactions'
+  params = ()
+  if symbolID is not None:
+    query += ' WHERE symbolID=?'
+    params = (symbolID,)
+  # Separate cursor, since `c` is used for writing while we stream.
+  rows = c.connection.cursor().execute(
+    query + ' ORDER BY symbolID, date, id', params)
+  current_id, position = None, None
+  quantity_so_far, proceeds_so_far = 0, 0
+  updates = []
+  for (id_, row_symbol_id, kind, date, quantity, proceeds, quantity_after,
+       proceeds_after, ratio) in rows:
+    if row_symbol_id != current_id:
+      if position is not None:
+        _save_position(c, current_id, position)
+      current_id, position = row_symbol_id, lots.Position()
+      quantity_so_far, proceeds_so_far = 0, 0
+    if kind == 'checkpoint':
+      # The archived rows cannot change, so its totals are still right.
+      position = _load_checkpoint_position(c, row_symbol_id, id_)
+      quantity_so_far, proceeds_so_far = quantity_after, proceeds_after
+      continue
+    position.apply(kind, date, quantity, proceeds, id_, ratio)
+    if kind == 'split':
+      quantity = quantity_so_far * (ratio - 1)
+    quantity_so_far += quantity
+    proceeds_so_far += proceeds
+    if (quantity_so_far, proceeds_so_far) != (quantity_after, proceeds_after):
+      updates.append((quantity, quantity_so_far, proceeds_so_far, id_))
+  if position is not None:
+    _save_position(c, current_id, position)
+  c.executemany('UPDATE shareTransactions '
+                'SET quantity=?, quantity_after=?, proceeds_after=? '
+                'WHERE id=?', updates)
+
+
+# Columns of the archived rows, see `_take_archivable`.
+_ARCHIVE_COLUMNS = {
+  'transactions': ('id', 'date', 'info', 'value', 'balance_after', 'hash',
+                   'kind'),
+  'shareTransactions': ('id', 'date', 'kind', 'quantity', 'proceeds',
+                        'quantity_after', 'proceeds_after', 'hash', 'ratio'),
+}
+
+
+def _pack(obj) -> bytes:
+  return zlib.compress(json.dumps(obj).encode())
+
+
+def _unpack(blob):
+  return json.loads(zlib.decompress(blob))
+
+
+def _unpack_rows(table, blob):
+  """Archived rows of `table` as dicts, see `_compact_transactions`."""
+  return [dict(zip(_ARCHIVE_COLUMNS[table], row)) for row in _unpack(blob)]
+
+
+def _take_archivable(c: sqlite3.Cursor, table, parent_column, parent_id,
+                     cutoff):
+  """Deletes and returns the rows of `parent_id` to archive, in date order.
+
+  These are the rows before `cutoff`, but never the latest row (by id) or
+  rows after it in date order, so the latest row stays the latest.
+
+  :returns: Dicts of the `_ARCHIVE_COLUMNS`, empty if there is nothing new
+      to archive.
+  """
+  c.execute(f'SELECT date FROM {table} WHERE {parent_column}=? '
+            'ORDER BY id DESC LIMIT 1', (parent_id,))
+  res = c.fetchone()
+  if res is None:
+    return []
+  columns = _ARCHIVE_COLUMNS[table]
+  rows = [dict(zip(columns, row)) for row in c.execute(
+    f'SELECT {", ".join(columns)} FROM {table} '
+    f'WHERE {parent_column}=? AND date<? ORDER BY date, id',
+    (parent_id, min(cutoff, res[0]))).fetchall()]
+  if all(row['kind'] == 'checkpoint' for row in rows):
+    return []
+  c.executemany(f'DELETE FROM {table} WHERE id=?',
+                [(row['id'],) for row in rows])
+  c.executemany('INSERT INTO archivedHashes VALUES (?)',
+                [(row['hash'],) for row in rows if row['hash']])
+  return rows
+
+
+def _compact_transactions(c: sqlite3.Cursor, accountID, cutoff) -> int:
+  """Archives old transactions of `accountID`, returns how many."""
+  rows = _take_archivable(c, 'transactions', 'accountID', accountID, cutoff)
+  if not rows:
+    return 0
+  # A previous checkpoint is not archived again, its rows already are.
+  archived = [row for row in rows if row['kind'] != 'checkpoint']
+  last = max(rows, key=lambda row: row['id'])
+  c.execute('INSERT INTO transactionsArchive '
+            '(accountID, checkpointID, first_date, last_date, total, rows) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (accountID, last['id'], archived[0]['date'],
+             archived[-1]['date'], sum(row['value'] for row in archived),
+             _pack([list(row.values()) for row in archived])))
+  # Same id and `balance_after` as the last archived row, so the order of
+  # the rows and the running balances stay the same. The aggregate triggers
+  # ignore it, since there is a newer row.
+  c.execute('INSERT INTO transactions '
+            '(id, accountID, date, info, value, balance_after, kind) '
+            "VALUES (?, ?, ?, '', ?, ?, 'checkpoint')",
+            (last['id'], accountID, rows[-1]['date'],
+             sum(row['value'] for row in rows), last['balance_after']))
+  return len(archived)
+
+
+def _compact_share_transactions(c: sqlite3.Cursor, symbolID, cutoff) -> int:
+  """Archives old trades of `symbolID`, returns how many."""
+  rows = _take_archivable(c, 'shareTransactions', 'symbolID', symbolID,
+                          cutoff)
+  if not rows:
+    return 0
+  archived = [row for row in rows if row['kind'] != 'checkpoint']
+  last = max(rows, key=lambda row: row['id'])
+  # Like `_replay_positions`, the position at the checkpoint.
+  position = lots.Position()
+  for row in rows:
+    if row['kind'] == 'checkpoint':
+      position = _load_checkpoint_position(c, symbolID, row['id'])
+    else:
+      position.apply(row['kind'], row['date'], row['quantity'],
+                     row['proceeds'], ratio=row['ratio'])
+  c.execute('INSERT INTO shareTransactionsArchive '
+            '(symbolID, checkpointID, first_date, last_date, position, rows) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (symbolID, last['id'], archived[0]['date'], archived[-1]['date'],
+             _pack({'lots': [[lot.date, lot.quantity, lot.cost]
+                             for lot in position.lots],
+                    'average_cost': position.average_cost,
+                    'realized_fifo': position.get_realized(lots.FIFO),
+                    'realized_average': position.get_realized(lots.AVERAGE)}),
+             _pack([list(row.values()) for row in archived])))
+  c.execute('INSERT INTO shareTransactions '
+            '(id, symbolID, kind, date, quantity, proceeds, '
+            'quantity_after, proceeds_after) '
+            "VALUES (?, ?, 'checkpoint', ?, ?, ?, ?, ?)",
+            (last['id'], symbolID, rows[-1]['date'],
+             sum(row['quantity'] for row in rows),
+             sum(row['proceeds'] for row in rows),
+             rows[-1]['quantity_after'], rows[-1]['proceeds_after']))
+  return len(archived)
+
+
+def _load_checkpoint_position(c: sqlite3.Cursor, symbolID,
+                              checkpointID) -> lots.Position:
+  c.execute('SELECT position FROM shareTransactionsArchive '
+            'WHERE symbolID=? AND checkpointID=?', (symbolID, checkpointID))
+  position, = c.fetchone()
+  position = _unpack(position)
+  return lots.Position([lots.Lot(*lot) for lot in position['lots']],
+                       position['average_cost'], position['realized_fifo'],
+                       position['realized_average'], checkpointID)
+
+
+def _date_range_query(start, end):
+  """Returns a WHERE clause suffix and its params for a date range."""
+  where, params = '', []
+  if start is not None:
+    where += ' AND date>=?'
+    params.append(helpers.parse_date(start))
+  if end is not None:
+    where += ' AND date<?'
+    params.append(helpers.parse_date(end))
+  return where, params
+
+
+# Searches with more matches are not ranked, see `search_transactions`.
+_MAX_RANKED = 10000
+
+
+def _search_query(ranked):
+  """Matches of an FTS5 query in the db `{db}`, see `search_transactions`.
+
+  The columns are (db index, account name, currency, date, info, value,
+  rank or rowid).
+  """
+  return (
+    'SELECT {i}, a.name, a.currency, t.date, t.info, t.value, ' +
+    ('f.rank ' if ranked else 'f.rowid ') +
+    'FROM {db}.transactionsFts f '
+    'JOIN {db}.transactions t ON t.id = f.rowid '
+    'JOIN {db}.accounts a ON a.id = t.accountID '
+    "WHERE f.transactionsFts MATCH ? AND t.kind!='checkpoint'")
+
+
+def _search_order(ranked):
+  # Without ranking, the index is read newest first, up to the limit.
+  return ' ORDER BY 7, 4 DESC' if ranked else ' ORDER BY 7 DESC'
+
+
+def _num_matches(c: sqlite3.Cursor, schemas, query):
+  """Matches of `query` in the dbs, counted up to `_MAX_RANKED` + 1 each."""
+  return sum(c.execute(f'SELECT COUNT(*) FROM ('
+                       f'  SELECT 1 FROM {schema}.transactionsFts '
+                       f'  WHERE transactionsFts MATCH ? LIMIT ?)',
+                       (query, _MAX_RANKED + 1)).fetchone()[0]
+             for schema in schemas)
+
+
+def _fts_query(text):
+  """FTS5 query for rows with all words of `text`, None if there are none.
+
+  Words are quoted, so that operators and stray quotes are taken literally.
+  The last word is a prefix, unless `text` ends with a space.
+  """
+  words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+  if not words:
+    return None
+  query = ' '.join(words)
+  return query if text[-1].isspace() else query + '*'
+
+
+def _search_conditions(account_name, date_range):
+  """Returns the WHERE clause suffix of `_search_query` and its params."""
+  where, params = '', []
+  if account_name is not None:
+    where += ' AND a.name=?'
+    params.append(account_name)
+  if date_range is not None:
+    range_where, range_params = _date_range_query(*date_range)
+    where += range_where
+    params += range_params
+  return where, params
+
+
+def _create_tables_v0(c: sqlite3.Cursor):
+  c.execute("""
+    CREATE TABLE accounts
+    (id INTEGER PRIMARY KEY, 
+     category INTEGER,
+     name text,
+     currency text)""")
+  c.execute("""
+    CREATE TABLE transactions
+    (id INTEGER PRIMARY KEY, 
+    accountID INTEGER,
+    date text,
+    info text,
+    value real,
+    balance_after real)""")
+  c.execute("""
+    CREATE TABLE stocks
+    (id INTEGER PRIMARY KEY,
+     symbol text,
+     currency text)
+    """)
+  c.execute("""
+    CREATE TABLE shareTransactions
+    (id INTEGER PRIMARY KEY,
+    symbolID INTEGER,
+    date text,
+    quantity int,   -- How many bought/sold
+    proceeds real,   
+    quantity_after int,
+    proceeds_after real)
+    """)
+
+
+def _rebuild_table(c: sqlite3.Cursor, table, create_sql, convert_row):
+  """Re-create `table` with `create_sql`, passing each row through `convert_row`.
+
+  SQLite cannot change column types, so we copy everything over.
+  """
+  c.execute(f'ALTER TABLE {table} RENAME TO _{table}_old')
+  c.execute(create_sql)
+  rows = [convert_row(row)
+          for row in c.execute(f'SELECT * FROM _{table}_old ORDER BY id')]
+  if rows:
+    placeholders = ', '.join('?' for _ in rows[0])
+    c.executemany(f'INSERT INTO {table} VALUES ({placeholders})', rows)
+  c.execute(f'DROP TABLE _{table}_old')
+
+
+def _migrate_v1_integer_dates(c: sqlite3.Cursor):
+  """Store dates as epoch seconds (see `helpers.parse_date`) and index them."""
+  def convert(row):
+    id_, parent_id, date, *rest = row
+    return (id_, parent_id, helpers.parse_date(date), *rest)
+
+  _rebuild_table(c, 'transactions', """
+    CREATE TABLE transactions
+    (id INTEGER PRIMARY KEY,
+    accountID INTEGER,
+    date INTEGER,  -- Epoch seconds
+    info text,
+    value real,
+    balance_after real)""", convert)
+  _rebuild_table(c, 'shareTransactions', """
+    CREATE TABLE shareTransactions
+    (id INTEGER PRIMARY KEY,
+    symbolID INTEGER,
+    date INTEGER,  -- Epoch seconds
+    quantity int,   -- How many bought/sold
+    proceeds real,
+    quantity_after int,
+    proceeds_after real)""", convert)
+  c.execute('CREATE INDEX transactions_account_date '
+            'ON transactions (accountID, date)')
+  c.execute('CREATE INDEX shareTransactions_symbol_date '
+            'ON shareTransactions (symbolID, date)')
+
+
+def _migrate_v2_minor_units(c: sqlite3.Cursor):
+  """Store money as INTEGER minor units (see `helpers.to_minor`).
+
+  Running balances are re-accumulated from the converted values, which gets
+  rid of any float drift in the old `balance_after`/`proceeds_after` chains.
+  """
+  def make_converter(parent_table):
+    currencies = dict(c.execute(f'SELECT id, currency FROM {parent_table}'))
+    running = collections.defaultdict(int)
+
+    def convert(row):
+      id_, parent_id, date, *mid, value, _ = row
+      currency = currencies.get(parent_id)
+      value = helpers.to_minor(value or 0, currency)
+      running[parent_id] += value
+      return (id_, parent_id, date, *mid, value, running[parent_id])
+    return convert
+
+  _rebuild_table(c, 'transactions', """
+    CREATE TABLE transactions
+    (id INTEGER PRIMARY KEY,
+    accountID INTEGER,
+    date INTEGER,  -- Epoch seconds
+    info text,
+    value INTEGER,  -- Minor units of the account currency
+    balance_after INTEGER)""", make_converter('accounts'))
+
+  convert_share_transaction = make_converter('stocks')
+
+  def convert_share_row(row):
+    # Move the quantity_after column out of the way of `convert`.
+    id_, symbol_id, date, quantity, proceeds, quantity_after, proceeds_after = row
+    id_, symbol_id, date, quantity, proceeds, proceeds_after = \
+      convert_share_transaction(
+        (id_, symbol_id, date, quantity, proceeds, proceeds_after))
+    return (id_, symbol_id, date, quantity, proceeds,
+            quantity_after, proceeds_after)
+
+  _rebuild_table(c, 'shareTransactions', """
+    CREATE TABLE shareTransactions
+    (id INTEGER PRIMARY KEY,
+    symbolID INTEGER,
+    date INTEGER,  -- Epoch seconds
+    quantity int,   -- How many bought/sold
+    proceeds INTEGER,  -- Minor units of the symbol currency
+    quantity_after int,
+    proceeds_after INTEGER)""", convert_share_row)
+  # Rebuilding dropped the old indices.
+  c.execute('CREATE INDEX transactions_account_date '
+            'ON transactions (accountID, date)')
+  c.execute('CREATE INDEX shareTransactions_symbol_date '
+            'ON shareTransactions (symbolID, date)')
+  # Index on the rowid per parent for "latest transaction" lookups.
+  c.execute('CREATE INDEX transactions_account ON transactions (accountID)')
+  c.execute('CREATE INDEX shareTransactions_symbol '
+            'ON shareTransactions (symbolID)')
+
+
+def _migrate_v3_lots(c: sqlite3.Cursor):
+  """Add split rows and the persisted position state (see `lots`)."""
+  # Either 'trade' or 'split'.
+  c.execute("ALTER TABLE shareTransactions "
+            "ADD COLUMN kind text DEFAULT 'trade'")
+  c.execute("""
+    CREATE TABLE lots
+    (id INTEGER PRIMARY KEY,
+    symbolID INTEGER,
+    date INTEGER,
+    quantity real,
+    cost INTEGER)""")
+  c.execute('CREATE INDEX lots_symbol ON lots (symbolID)')
+  c.execute("""
+    CREATE TABLE positions
+    (symbolID INTEGER PRIMARY KEY,
+    average_cost INTEGER,
+    realized_fifo INTEGER,
+    realized_average INTEGER,
+    lastShareTransactionID INTEGER)""")
+  _replay_positions(c)
+
+
+def _migrate_v4_content_hashes(c: sqlite3.Cursor):
+  """Content hashes of imported rows, see `import_files`."""
+  for table in ('transactions', 'shareTransactions'):
+    c.execute(f'ALTER TABLE {table} ADD COLUMN hash text')
+    c.execute(f'CREATE UNIQUE INDEX {table}_hash ON {table} (hash)')
+
+
+def _migrate_v5_import_watermarks(c: sqlite3.Cursor):
+  """Per source file, the date of the last imported row."""
+  c.execute("""
+    CREATE TABLE importWatermarks
+    (source text PRIMARY KEY,
+    last_date INTEGER,
+    last_hash text)""")
+
+
+def _migrate_v6_aggregates(c: sqlite3.Cursor):
+  """Latest balance per account and totals per category, kept by triggers.
+
+  The latest transaction of an account is the one with the highest id, as
+  everywhere else. Its value is the diff of the account, see
+  `Account.get_diff_to_last`.
+  """
+  c.execute("""
+    CREATE TABLE accountBalances
+    (accountID INTEGER PRIMARY KEY,
+    balance INTEGER,
+    last_value INTEGER)""")
+  c.execute("""
+    CREATE TABLE categoryTotals
+    (category INTEGER,
+    currency text,
+    total INTEGER,
+    diff INTEGER,
+    PRIMARY KEY (category, currency))""")
+  c.execute('CREATE INDEX accounts_category ON accounts (category)')
+  _create_aggregate_triggers(c)
+  c.execute('INSERT INTO accountBalances '
+            'SELECT accountID, balance_after, value FROM transactions '
+            'WHERE id IN (SELECT MAX(id) FROM transactions GROUP BY accountID)')
+  c.execute('INSERT INTO categoryTotals '
+            'SELECT a.category, a.currency, IFNULL(SUM(b.balance), 0), '
+            '  IFNULL(SUM(b.last_value), 0) '
+            'FROM accounts a LEFT JOIN accountBalances b ON b.accountID = a.id '
+            'GROUP BY a.category, a.currency')
+
+
+def _create_aggregate_triggers(c: sqlite3.Cursor):
+  """Must be re-created whenever `transactions` or `accounts` are rebuilt."""
+  c.execute("""
+    CREATE TRIGGER accounts_aggregates AFTER INSERT ON accounts
+    BEGIN
+      INSERT OR IGNORE INTO categoryTotals
+      VALUES (NEW.category, NEW.currency, 0, 0);
+    END""")
+  # Only for the latest transaction of the account, e.g. not for rows
+  # inserted with an older id. The first transaction of an account has no
+  # balance before it, so its diff is 0, see `Account.get_diff_to_last`.
+  diff = ('CASE WHEN EXISTS (SELECT 1 FROM transactions '
+          '  WHERE accountID = NEW.accountID AND id < NEW.id) '
+          'THEN NEW.value ELSE 0 END')
+  c.execute(f"""
+    CREATE TRIGGER transactions_aggregates AFTER INSERT ON transactions
+    WHEN NOT EXISTS (SELECT 1 FROM transactions
+                     WHERE accountID = NEW.accountID AND id > NEW.id)
+    BEGIN
+      UPDATE categoryTotals SET
+        total = total + NEW.balance_after - IFNULL(
+          (SELECT balance FROM accountBalances
+           WHERE accountID = NEW.accountID), 0),
+        diff = diff + {diff} - IFNULL(
+          (SELECT last_value FROM accountBalances
+           WHERE accountID = NEW.accountID), 0)
+      WHERE (category, currency) =
+        (SELECT category, currency FROM accounts WHERE id = NEW.accountID);
+      INSERT OR REPLACE INTO accountBalances
+      VALUES (NEW.accountID, NEW.balance_after, {diff});
+    END""")
+
+
+def _migrate_v7_symbol_resolutions(c: sqlite3.Cursor):
+  """Validated IBKR -> Yahoo Finance symbols, see `_resolve_symbols`."""
+  c.execute("""
+    CREATE TABLE symbolResolutions
+    (ibkr_symbol text,
+    exchange text,
+    yf_symbol text,
+    short_name text,
+    validated_at INTEGER,
+    PRIMARY KEY (ibkr_symbol, exchange))""")
+
+
+def _migrate_v8_archive(c: sqlite3.Cursor):
+  """Compressed archives of old rows, see `DataController.compact`.
+
+  Archived rows are replaced by one 'checkpoint' row per account/symbol,
+  which has the id and running totals of the last archived row. The
+  shareTransactions checkpoints refer to a position snapshot in their
+  archive, to replay from.
+  """
+  c.execute("ALTER TABLE transactions "
+            "ADD COLUMN kind text DEFAULT 'transaction'")
+  c.execute("""
+    CREATE TABLE transactionsArchive
+    (id INTEGER PRIMARY KEY,
+    accountID INTEGER,
+    checkpointID INTEGER,
+    first_date INTEGER,
+    last_date INTEGER,
+    total INTEGER,  -- Sum of the values of the rows
+    rows BLOB)""")
+  c.execute('CREATE INDEX transactionsArchive_account '
+            'ON transactionsArchive (accountID)')
+  c.execute("""
+    CREATE TABLE shareTransactionsArchive
+    (id INTEGER PRIMARY KEY,
+    symbolID INTEGER,
+    checkpointID INTEGER,
+    first_date INTEGER,
+    last_date INTEGER,
+    position BLOB,  -- After applying the rows
+    rows BLOB)""")
+  c.execute('CREATE INDEX shareTransactionsArchive_symbol '
+            'ON shareTransactionsArchive (symbolID, checkpointID)')
+  # So that imports still skip archived rows.
+  c.execute('CREATE TABLE archivedHashes (hash text PRIMARY KEY)')
+
+
+def _migrate_v9_search(c: sqlite3.Cursor):
+  """Full-text index of `transactions.info`, see `search_transactions`.
+
+  An external content table: it only stores the index, and reads the info
+  from `transactions`. Prefixes of 2 and 3 characters are indexed too, for
+  short as-you-type queries.
+  """
+  c.execute("""
+    CREATE VIRTUAL TABLE transactionsFts USING fts5
+    (info,
+    content='transactions',
+    content_rowid='id',
+    prefix='2 3',
+    tokenize='unicode61 remove_diacritics 2')""")
+  _create_search_triggers(c)
+  c.execute("INSERT INTO transactionsFts (transactionsFts) VALUES ('rebuild')")
+
+
+def _create_search_triggers(c: sqlite3.Cursor):
+  """Must be re-created whenever `transactions` is rebuilt."""
+  c.execute("""
+    CREATE TRIGGER transactions_search_insert AFTER INSERT ON transactions
+    BEGIN
+      INSERT INTO transactionsFts (rowid, info) VALUES (NEW.id, NEW.info);
+    END""")
+  # Deleting from an external content index needs the old values.
+  c.execute("""
+    CREATE TRIGGER transactions_search_delete AFTER DELETE ON transactions
+    BEGIN
+      INSERT INTO transactionsFts (transactionsFts, rowid, info)
+      VALUES ('delete', OLD.id, OLD.info);
+    END""")
+  c.execute("""
+    CREATE TRIGGER transactions_search_update AFTER UPDATE OF info
+    ON transactions
+    BEGIN
+      INSERT INTO transactionsFts (transactionsFts, rowid, info)
+      VALUES ('delete', OLD.id, OLD.info);
+      INSERT INTO transactionsFts (rowid, info) VALUES (NEW.id, NEW.info);
+    END""")
+
+
+def _migrate_v10_split_ratios(c: sqlite3.Cursor):
+  """The ratio of splits, which their quantity lost without earlier shares."""
+  c.execute('ALTER TABLE shareTransactions ADD COLUMN ratio real')
+  c.execute("UPDATE shareTransactions SET ratio=IFNULL("
+            "  CAST(quantity_after AS REAL) "
+            "  / NULLIF(quantity_after - quantity, 0), 1) "
+            "WHERE kind='split'")
+  _replay_positions(c)
+
+
+def _migrate_v11_first_transaction_diffs(c: sqlite3.Cursor):
+  """The diff of an account with a single transaction is 0, as before v6."""
+  c.execute('DROP TRIGGER accounts_aggregates')
+  c.execute('DROP TRIGGER transactions_aggregates')
+  _create_aggregate_triggers(c)
+  c.execute('UPDATE accountBalances SET last_value=0 WHERE accountID IN ('
+            '  SELECT accountID FROM transactions GROUP BY accountID '
+            '  HAVING COUNT(*)=1)')
+  c.execute('UPDATE categoryTotals SET diff=('
+            '  SELECT IFNULL(SUM(b.last_value), 0) FROM accounts a '
+            '  JOIN accountBalances b ON b.accountID = a.id '
+            '  WHERE a.category = categoryTotals.category '
+            '  AND a.currency = categoryTotals.currency)')
+
+
+def _migrate_v12_drop_watermark_hashes(c: sqlite3.Cursor):
+  """The hash of the last imported row is not needed, see `_merge_into_db`."""
+  c.execute('ALTER TABLE importWatermarks RENAME TO _importWatermarks_old')
+  c.execute("""
+    CREATE TABLE importWatermarks
+    (source text PRIMARY KEY,
+    last_date INTEGER)""")
+  c.execute('INSERT INTO importWatermarks '
+            'SELECT source, last_date FROM _importWatermarks_old')
+  c.execute('DROP TABLE _importWatermarks_old')
+
+
+# Migration i brings the db from version i to i + 1 (`PRAGMA user_version`).
+_MIGRATIONS = [
+  _migrate_v1_integer_dates,
+  _migrate_v2_minor_units,
+  _migrate_v3_lots,
+  _migrate_v4_content_hashes,
+  _migrate_v5_import_watermarks,
+  _migrate_v6_aggregates,
+  _migrate_v7_symbol_resolutions,
+  _migrate_v8_archive,
+  _migrate_v9_search,
+  _migrate_v10_split_ratios,
+  _migrate_v11_first_transaction_diffs,
+  _migrate_v12_drop_watermark_hashes,
+]
 
 
 def _lazy(obj, field_name, fn):
@@ -236,8 +1530,9 @@ class SymbolOverview:
   dc: DataController
   symbol: str
   quantity: int
-  proceeds_so_far: float
+  proceeds_so_far: FixedBalance
   _currency: str = None
+  _position: lots.Position = None
 
   def __str__(self):
     return f'Symbol({self.symbol} / quant={self.quantity} / ' \
@@ -245,10 +1540,36 @@ class SymbolOverview:
            f'gain={self.get_current_total_gain():,.2f})'
 
   def get_current_total_gain(self, currency=None) -> OptionalBalance:
-    return self.get_current_total_value(currency) + self.proceeds_so_far
+    proceeds = self.proceeds_so_far
+    if currency:
+      proceeds = symbol_values.convert_currency(proceeds, self.get_currency(),
+                                                currency)
+    return self.get_current_total_value(currency) + proceeds
+
+  def get_realized_gain(self, method=lots.FIFO) -> FixedBalance:
+    return FixedBalance(self._get_position().get_realized(method),
+                        self.get_currency())
+
+  def get_cost_basis(self, method=lots.FIFO) -> FixedBalance:
+    return FixedBalance(self._get_position().cost_basis(method),
+                        self.get_currency())
+
+  def get_unrealized_gain(self, method=lots.FIFO,
+                          currency=None) -> OptionalBalance:
+    cost_basis = self.get_cost_basis(method)
+    if currency:
+      cost_basis = symbol_values.convert_currency(
+        cost_basis, self.get_currency(), currency)
+    return self.get_current_total_value(currency) - cost_basis
+
+  def _get_position(self) -> lots.Position:
+    return _lazy(self, '_position', lambda: self.dc.get_position(self.symbol))
 
   # TODO: Optionals?
   def get_current_total_value(self, currency=None) -> OptionalBalance:
+    if self.quantity == 0:
+      # Closed position, no need to know (and fetch) the price.
+      return FixedBalance(0, currency or self.get_currency())
     t = symbol_values.Ticker.make(self.symbol)
     current_value = OptionalBalance(t.get_current_value(), self.get_currency())
     value_in_native_currency = current_value * self.quantity
@@ -262,57 +1583,232 @@ class SymbolOverview:
                  lambda: self.dc.get_currency_of_symbol(self.symbol))
 
 
-def create_db_from_files(accounts_json_p, stocks_ibkr_csv_p):
+def create_db_from_files(accounts_json_p, stocks_ibkr_csv_p,
+                         incremental=False):
+  """Create a db next to `accounts_json_p`.
+
+  :param incremental: If True, an existing db is kept and only new entries
+      of the files are appended. Otherwise, it is moved to .bak.
+  """
   out_p = accounts_json_p.replace('.json', '.db')
 
-  if os.path.isfile(out_p):
+  if os.path.isfile(out_p) and not incremental:
     os.rename(out_p, out_p + '.bak')
 
   dc = DataController(out_p)
-  _parse_accounts_json_into_db(accounts_json_p, dc)
-  _parse_stocks_ibkr_csv(stocks_ibkr_csv_p, dc)
+  import_files(dc, [p for p in (accounts_json_p, stocks_ibkr_csv_p) if p],
+               incremental=incremental)
+  print('\n'.join(map(str, dc.get_all_symbol_overviews())))
+
+
+def import_files(dc: DataController, paths, workers=None,
+                 incremental=False) -> int:
+  """Import accounts JSON and IBKR CSV files into `dc`.
 
+  Files are parsed in a process pool, then merged by a single writer in one
+  transaction. Everything already in the DB (by content hash) is skipped, so
+  importing overlapping files, or the same file twice, is fine.
 
-def _parse_accounts_json_into_db(accounts_json_p, dc: DataController):
+  :param workers: Number of processes, defaults to the number of CPUs.
+  :param incremental: If True, rows of a file older than what was imported
+      from the same file before (its watermark) are skipped while parsing.
+  :returns: Number of new transactions.
+  """
+  sources = [_source_key(path) for path in paths]
+  watermarks = dc.get_import_watermarks() if incremental else {}
+  since = [watermarks.get(source) for source in sources]
+  if workers == 1 or len(paths) == 1:
+    parsed_files = list(map(_parse_file, paths, since))
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+      parsed_files = list(pool.map(_parse_file, paths, since))
+  # Only resolve symbols we actually need.
+  traded = set(event.symbol for parsed in parsed_files
+               for event in parsed.share_events)
+  instruments = set(instrument for parsed in parsed_files
+                    for instrument in parsed.instruments
+                    if instrument[0] in traded)
+  symbols_yf = _resolve_symbols(dc, instruments) if instruments else {}
+  return _merge_into_db(dc, parsed_files, symbols_yf)
+
+
+def _source_key(path):
+  return os.path.abspath(path)
+
+
+_ParsedFile = collections.namedtuple(
+  '_ParsedFile',
+  ['path',
+   'accounts',  # List of (name, currency, category).
+   'account_entries',  # List of `_AccountEntry`.
+   'instruments',  # List of (IBKR symbol, listing exchange).
+   'share_events',  # List of `_StockTrade` and `_StockSplit`.
+   ])
+
+
+def _parse_file(path, since=None) -> _ParsedFile:
+  """Parses one file, runs in the import process pool.
+
+  :param since: If given, skip dated rows before this date.
+  """
+  if path.endswith('.json'):
+    return _parse_accounts_json(path, since)
+  if path.endswith('.csv'):
+    return _parse_stocks_ibkr_csv(path, since)
+  raise ValueError(f'Unknown file type: {path}')
+
+
+def _known_hashes(c: sqlite3.Cursor, hashes):
+  """Returns the subset of `hashes` that is already in the db."""
+  hashes = list(hashes)
+  known = set()
+  chunk_size = 500  # SQLite limits the number of parameters.
+  for i in range(0, len(hashes), chunk_size):
+    chunk = hashes[i:i + chunk_size]
+    placeholders = ', '.join('?' for _ in chunk)
+    for table in ('transactions', 'shareTransactions', 'archivedHashes'):
+      known.update(h for h, in c.execute(
+        f'SELECT hash FROM {table} WHERE hash IN ({placeholders})', chunk))
+  return known
+
+
+def _merge_into_db(dc: DataController, parsed_files, symbols_yf) -> int:
+  """Writes `parsed_files` into `dc`, skipping already imported entries."""
+  num_new = 0
+  with dc.connect() as c:
+    # Only look up what we parsed, via the index, so that this is
+    # proportional to the new data and not the db.
+    known_hashes = _known_hashes(
+      c, (entry.hash for parsed in parsed_files
+          for entry in parsed.account_entries + parsed.share_events))
+    accounts = set(name for name, in c.execute('SELECT name FROM accounts'))
+    symbols = set(symbol for symbol, in c.execute('SELECT symbol FROM stocks'))
+
+    for parsed in parsed_files:
+      for name, currency, category in parsed.accounts:
+        if name not in accounts:
+          dc.create_account(name, currency, category)
+          accounts.add(name)
+      for entry in parsed.account_entries:
+        if entry.hash in known_hashes:
+          continue
+        known_hashes.add(entry.hash)
+        value = entry.value
+        if entry.kind == 'balance':
+          value = value - dc.get_balance(entry.account)
+        dc.add_transaction(entry.account, value, date=entry.date,
+                           info=entry.info, content_hash=entry.hash)
+        num_new += 1
+
+    # Stable, so trades at the same time keep their order.
+    share_events = sorted((event for parsed in parsed_files
+                           for event in parsed.share_events),
+                          key=lambda event: event.date)
+    # Splits have no currency, but may come before the first trade.
+    currencies = {event.symbol: event.currency for event in share_events
+                  if not isinstance(event, _StockSplit)}
+    for event in share_events:
+      if event.hash in known_hashes:
+        continue
+      symbol = symbols_yf.get(event.symbol, event.symbol)
+      # Add symbols to db. Do it here because here we know the currency!
+      if symbol not in symbols:
+        if event.symbol not in currencies:
+          # Nothing to split, and it is imported again with the trades.
+          logger.info(f'*** Skipping split of unknown {symbol}')
+          continue
+        dc.add_stock_symbol(symbol, currencies[event.symbol])
+        symbols.add(symbol)
+      known_hashes.add(event.hash)
+      if isinstance(event, _StockSplit):
+        dc.add_stock_split(symbol, event.ratio, event.date,
+                           content_hash=event.hash)
+      else:
+        dc.add_share_transaction(symbol, event.quantity, event.proceeds,
+                                 event.date, content_hash=event.hash)
+      num_new += 1
+
+    # Rows at the watermark are parsed again, and skipped by their hashes.
+    watermarks = dc.get_import_watermarks()
+    for parsed in parsed_files:
+      dates = [entry.date
+               for entry in parsed.account_entries + parsed.share_events
+               if entry.date is not None]
+      if not dates:
+        continue
+      source = _source_key(parsed.path)
+      last_date = max(dates)
+      if source in watermarks and watermarks[source] > last_date:
+        continue
+      c.execute('INSERT OR REPLACE INTO importWatermarks '
+                '(source, last_date) VALUES (?, ?)', (source, last_date))
+  return num_new
+
+
+def _with_hashes(entries):
+  """Sets the `hash` field of each of the namedtuples in `entries`.
+
+  The hash is over the content of the entry plus a counter of how often the
+  same content appeared before in this file, so that identical entries of
+  one file are all kept, while overlapping files produce the same hashes.
+  """
+  seen = collections.Counter()
+  for entry in entries:
+    content = repr(tuple(entry._replace(hash=None)))
+    seen[content] += 1
+    yield entry._replace(hash=hashlib.sha1(
+      f'{content}#{seen[content]}'.encode()).hexdigest())
+
+
+_AccountEntry = collections.namedtuple(
+  '_AccountEntry',
+  ['account',
+   'kind',  # 'delta': `value` is added, 'balance': `value` is the new balance.
+   'value', 'date', 'info', 'hash'],
+  defaults=(None,))
+
+
+def _parse_accounts_json(accounts_json_p, since=None) -> _ParsedFile:
   with open(accounts_json_p, 'r') as f:
     accounts = json.load(f)
-    # TODO: Should be more granular.
-    currency = accounts["currency"]
-    with dc.connect():
-      for account_name, balance in accounts["last"].items():
-        dc.create_account(account_name, currency)
-        dc.add_transaction(account_name, balance,
-                           info='Initial')
-      for account_name, balance in accounts["now"].items():
-        last_balance = dc.get_balance(account_name)
-        dc.add_transaction(account_name, balance - last_balance,
-                           info='Last Update')
-      # Non liquits
-      for cat1_acc, transactions in accounts["cat1"].items():
-        dc.create_account(cat1_acc, currency, category=1)
-        for info, date, value in transactions:
-          dc.add_transaction('Non-Liquids', value, date=date, info=info)
+  # TODO: Should be more granular.
+  currency = accounts["currency"]
+  new_accounts = []
+  entries = []
+  for account_name, balance in accounts["last"].items():
+    new_accounts.append((account_name, currency, 0))
+    entries.append(_AccountEntry(account_name, 'delta', balance,
+                                 date=None, info='Initial'))
+  for account_name, balance in accounts["now"].items():
+    entries.append(_AccountEntry(account_name, 'balance', balance,
+                                 date=None, info='Last Update'))
+  # Non liquits
+  for cat1_acc, transactions in accounts["cat1"].items():
+    new_accounts.append((cat1_acc, currency, 1))
+    for info, date, value in transactions:
+      date = helpers.parse_date(date)
+      if since is not None and date < since:
+        continue
+      entries.append(_AccountEntry('Non-Liquids', 'delta', value,
+                                   date=date, info=info))
+  return _ParsedFile(accounts_json_p, new_accounts, list(_with_hashes(entries)),
+                     instruments=[], share_events=[])
 
 
 _StockTrade = collections.namedtuple(
   '_StockTrade',
-  ['symbol', 'currency', 'date', 'quantity', 'proceeds'])
+  ['symbol', 'currency', 'date', 'quantity', 'proceeds', 'hash'],
+  defaults=(None,))
 
 
 class _StockTradeMaker(object):
-  def __init__(self, header_row, symbols_yf):
-    """
-    :param header_row:
-    :param symbols_yf:  Maps symbol names to YF names (e.g. 'IMAE': 'IMAE.AS')
-    """
+  def __init__(self, header_row):
     self.mapping = {key: i for i, key in enumerate(header_row)}
-    self.symbols_yf = symbols_yf
 
   def make(self, trade_row) -> _StockTrade:
-    symbol = trade_row[self['Symbol']]
-    return _StockTrade(symbol=self.symbols_yf.get(symbol, symbol),
+    return _StockTrade(symbol=trade_row[self['Symbol']],
                        currency=trade_row[self['Currency']],
-                       date=trade_row[self['Date/Time']],
+                       date=helpers.parse_date(trade_row[self['Date/Time']]),
                        quantity=float(trade_row[self['Quantity']]),
                        proceeds=float(trade_row[self['Proceeds']]))
 
@@ -329,80 +1825,190 @@ _EXCH_TO_YF = {
 _AMERICAN_EXCH = {'ARCA', 'NASDAQ'}
 
 
-def _get_stock_yfinance_names(stocks_ibkr_csv_p):
-  """Convert IBKR short names to YF names and check if actually valid."""
-  with open(stocks_ibkr_csv_p, 'r') as f:
-    r = csv.reader(f)
-    symbol_col = exch_col = None
-    symbols_yf = {}
-    for row in r:
-      if not row or row[0] != 'Financial Instrument Information':
-        continue
-      if row[1] == 'Header':
-        symbol_col = row.index('Symbol')
-        exch_col = row.index('Listing Exch')
+# Validated symbols are checked again after this long.
+_SYMBOL_RESOLUTION_TTL_S = 30 * 24 * 60 * 60
+# Seconds to wait for validating symbols.
+_SYMBOL_VALIDATION_TIMEOUT_S = 30
+
+
+def _get_stock_yfinance_name(symbol, exch):
+  """Convert an IBKR short name to a YF name."""
+  if exch in _EXCH_TO_YF:
+    return symbol + '.' + _EXCH_TO_YF[exch]
+  if exch in _AMERICAN_EXCH:
+    return symbol
+  # TODO: Extend somehow.
+  raise ValueError(f'Unknown: {symbol} / {exch}')
+
+
+def _resolve_symbols(dc: DataController, instruments):
+  """Convert IBKR short names to YF names and check if actually valid.
+
+  Validated names are stored in the db, only new or expired ones are
+  checked online. Names that cannot be validated are still used, and are
+  checked again on the next import.
+
+  :param instruments: Iterable of (IBKR symbol, listing exchange).
+  :returns: Dict mapping IBKR symbols to YF symbols.
+  """
+  now = helpers.now_timestamp()
+  with dc.connect() as c:
+    known = {(symbol, exch): (symbol_yf, validated_at)
+             for symbol, exch, symbol_yf, validated_at in c.execute(
+               'SELECT ibkr_symbol, exchange, yf_symbol, validated_at '
+               'FROM symbolResolutions')}
+  symbols_yf = {}
+  to_validate = {}  # YF symbol -> (IBKR symbol, exchange)
+  for symbol, exch in sorted(instruments):
+    if (symbol, exch) in known:
+      symbol_yf, validated_at = known[symbol, exch]
+      if now - validated_at < _SYMBOL_RESOLUTION_TTL_S:
+        symbols_yf[symbol] = symbol_yf
         continue
-      symbol, exch = row[symbol_col], row[exch_col]
-      if exch in _EXCH_TO_YF:
-        symbol_yf = symbol + '.' + _EXCH_TO_YF[exch]
-      elif exch in _AMERICAN_EXCH:
-        symbol_yf = symbol
-      else:
-        # TODO: Extend somehow.
-        raise ValueError(f'Unknown: {symbol} / {exch}')
-      print(f'{symbol} -> {symbol_yf}')
-      symbols_yf[symbol] = symbol_yf
-  if not symbols_yf:
-    raise ValueError('No symbols found!')
-  symbol_values.check_symbols(symbols_yf.values())
+    symbol_yf = _get_stock_yfinance_name(symbol, exch)
+    print(f'{symbol} -> {symbol_yf}')
+    symbols_yf[symbol] = symbol_yf
+    to_validate[symbol_yf] = (symbol, exch)
+  if not to_validate:
+    return symbols_yf
+
+  short_names = symbol_values.check_symbols(
+    to_validate, timeout_s=_SYMBOL_VALIDATION_TIMEOUT_S)
+  for symbol_yf in to_validate.keys() - short_names.keys():
+    print(f'Could not validate {symbol_yf}, using it anyway.')
+  with dc.connect() as c:
+    c.executemany('INSERT OR REPLACE INTO symbolResolutions '
+                  '(ibkr_symbol, exchange, yf_symbol, short_name, '
+                  'validated_at) VALUES (?, ?, ?, ?, ?)',
+                  [(*to_validate[symbol_yf], symbol_yf, short_name, now)
+                   for symbol_yf, short_name in short_names.items()])
   return symbols_yf
 
 
-def _parse_stocks_ibkr_csv(stocks_ibkr_csv_p, dc: DataController):
+_StockSplit = collections.namedtuple(
+  '_StockSplit', ['symbol', 'date', 'ratio', 'hash'], defaults=(None,))
+
+# E.g. 'AAPL(US0378331005) Split 4 for 1 (AAPL, APPLE INC, US0378331005)'
+_SPLIT_RE = re.compile(
+  r'^(?P<symbol>[^(\s]+)\(.*?\)\s+Split\s+'
+  r'(?P<new>\d+(?:\.\d+)?)\s+for\s+(?P<old>\d+(?:\.\d+)?)')
+
+
+def _parse_split(row, header):
+  """Returns a `_StockSplit` for a 'Corporate Actions' row, or None."""
+  m = _SPLIT_RE.match(row[header.index('Description')])
+  if not m:
+    return None
+  return _StockSplit(symbol=m.group('symbol'),
+                     date=helpers.parse_date(row[header.index('Date/Time')]),
+                     ratio=float(m.group('new')) / float(m.group('old')))
+
+
+def _parse_stocks_ibkr_csv(stocks_ibkr_csv_p, since=None) -> _ParsedFile:
   """Parse CSV from IBKR.
 
   Notes:
-      - Just looks at orders
-      - Does not handle stock splits! These have to be edited by you
-        in the CSV. (TODO: at least detect them they are also in the CSV)
-      - Gets the "real" symbol that Yahoo understands by looking up the
-        exchange.
+      - Just looks at orders and at stock splits (from the
+        'Corporate Actions'). Splits are applied in date order with the trades.
+      - Symbols are IBKR symbols, together with the `instruments` they can be
+        converted to the "real" symbol that Yahoo understands, see
+        `_resolve_symbols`.
+      - Trades and splits before `since` are skipped. Rows at `since` are
+        kept, they are deduplicated by hash when merging.
   """
-  # First get the stocks and exchanges.
-  symbols_yf = _get_stock_yfinance_names(stocks_ibkr_csv_p)
-  # Now parse our trades.
-  print('-' * 20, 'Parsing trades...', sep='\n')
-  with open(stocks_ibkr_csv_p, 'r') as f, dc.connect():
+  instruments = []
+  events = []  # Trades and splits.
+  with open(stocks_ibkr_csv_p, 'r') as f:
     r = csv.reader(f)
-    symbols = set()
     stm = None
+    done_with_trades = False
+    instruments_header = None
+    corporate_actions_header = None
     for row in r:
-      if not row or row[0] != 'Trades':
+      if not row:
+        continue
+      if row[0] == 'Financial Instrument Information':
+        if row[1] == 'Header':
+          instruments_header = row
+        else:
+          instruments.append(
+            (row[instruments_header.index('Symbol')],
+             row[instruments_header.index('Listing Exch')]))
+        continue
+      if row[0] == 'Corporate Actions':
+        if row[1] == 'Header':
+          corporate_actions_header = row
+        elif row[1] == 'Data' and corporate_actions_header:
+          split = _parse_split(row, corporate_actions_header)
+          if split and (since is None or split.date >= since):
+            events.append(split)
+        continue
+      if row[0] != 'Trades' or done_with_trades:
         continue
       if row[1] == 'Header':
         if stm is not None:  # Second Header for Forex trades
-          break
-        stm = _StockTradeMaker(row, symbols_yf)
+          done_with_trades = True
+          continue
+        stm = _StockTradeMaker(row)
         continue
       if row[1] != 'Data':
         continue
-      st: _StockTrade = stm.make(row)
-      # Add symbols to db. Do it here because here we know the currency!
-      if st.symbol not in symbols:
-        dc.add_stock_symbol(st.symbol, st.currency)
-        symbols.add(st.symbol)
-      dc.add_share_transaction(st.symbol, st.quantity, st.proceeds, st.date)
-    print('\n'.join(map(str, dc.get_all_symbol_overviews())))
+      trade = stm.make(row)
+      if since is None or trade.date >= since:
+        events.append(trade)
+  if not instruments:
+    raise ValueError(f'No symbols found in {stocks_ibkr_csv_p}!')
+  return _ParsedFile(stocks_ibkr_csv_p, accounts=[], account_entries=[],
+                     instruments=instruments,
+                     share_events=list(_with_hashes(events)))
 
 
 def main():
   p = argparse.ArgumentParser()
   p.add_argument('--accounts_from_json', '-a')
   p.add_argument('--stocks_from_ibkr', '-s')
+  p.add_argument('--import_files', '-i', nargs='+',
+                 help='Accounts JSON and IBKR CSV files to import into '
+                      '--database. Already imported entries are skipped.')
+  p.add_argument('--database', '-db')
+  p.add_argument('--workers', type=int,
+                 help='Number of processes for parsing --import_files.')
+  p.add_argument('--incremental', action='store_true',
+                 help='Keep the existing db and only append rows newer than '
+                      'what was imported from the same files before.')
+  p.add_argument('--no_quote_daemon', action='store_true',
+                 help='Always fetch quotes in-process, even if '
+                      'quote_daemon.py is running.')
+  p.add_argument('--compact_before', metavar='DATE',
+                 help='Archive the transactions of --database before DATE, '
+                      'see DataController.compact.')
   flags = p.parse_args()
-  if flags.accounts_from_json:
+  if not flags.no_quote_daemon:
+    # Imported here, only the CLI needs it.
+    import quote_daemon
+    symbol_values.set_provider(quote_daemon.DaemonQuoteProvider(
+      fallback=symbol_values.get_provider()))
+  if flags.import_files:
+    if not flags.database:
+      p.error('--import_files needs --database')
+    dc = DataController(flags.database)
+    num_new = import_files(dc, flags.import_files, flags.workers,
+                           incremental=flags.incremental)
+    print('\n'.join(map(str, dc.get_all_symbol_overviews())))
+    print(f'Imported {num_new} new transactions.')
+  elif flags.compact_before:
+    if not flags.database:
+      p.error('--compact_before needs --database')
+    dc = DataController(flags.database)
+    num_archived = dc.compact(flags.compact_before)
+    # Give the space back to the file system.
+    with contextlib.closing(sqlite3.connect(flags.database)) as conn:
+      conn.execute('VACUUM')
+    print(f'Archived {num_archived} transactions.')
+  elif flags.accounts_from_json:
     create_db_from_files(flags.accounts_from_json,
-                         flags.stocks_from_ibkr)
+                         flags.stocks_from_ibkr,
+                         incremental=flags.incremental)
 
 
 if __name__ == '__main__':
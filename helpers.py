@@ -1,5 +1,8 @@
+import calendar
+import datetime
+import decimal
 import functools
-from typing import Union
+from typing import Optional, Union
 
 
 @functools.total_ordering
@@ -64,10 +67,188 @@ class OptionalBalance(OptionalFloat):
     return self.placeholder
 
 
+# Number of digits after the decimal point for each currency. Everything not
+# listed here uses `_DEFAULT_CURRENCY_SCALE`.
+CURRENCY_SCALES = {
+  'JPY': 0,
+  'KRW': 0,
+  'BHD': 3,
+  'KWD': 3,
+}
+_DEFAULT_CURRENCY_SCALE = 2
+
+
+def currency_scale(currency: str) -> int:
+  return CURRENCY_SCALES.get(currency, _DEFAULT_CURRENCY_SCALE)
+
+
+def to_minor(value, currency: str) -> int:
+  """Convert `value` (in major units, e.g. dollars) to minor units (cents).
+
+  Floats are interpreted via their shortest repr, so 1.005 becomes 101 cents
+  and not 100.
+  """
+  if isinstance(value, FixedBalance):
+    if value.scale != currency_scale(currency):
+      raise ValueError(f'Cannot convert {value} to {currency}')
+    return value.get_minor()
+  if isinstance(value, OptionalFloat):
+    value = value.get()
+  if isinstance(value, int):
+    return value * 10 ** currency_scale(currency)
+  value = decimal.Decimal(value if isinstance(value, str) else repr(value))
+  return int(value.scaleb(currency_scale(currency)).to_integral_value(
+    rounding=decimal.ROUND_HALF_EVEN))
+
+
+class FixedBalance(OptionalBalance):
+  """An `OptionalBalance` backed by an integer number of minor units.
+
+  Adding and subtracting stays in integers (other operands are converted with
+  `to_minor`), as does multiplying with ints. Everything else falls back to
+  the float arithmetic of `OptionalBalance`.
+  """
+
+  def __init__(self,
+               minor: Optional[int],
+               currency: str,
+               placeholder: str = '...'):
+    # Note: Does not call super().__init__, `value` is derived from `minor`.
+    self.currency = currency
+    self.placeholder = placeholder
+    self.scale = currency_scale(currency)
+    self.minor = None if minor is None else int(minor)
+
+  @staticmethod
+  def from_value(value, currency: str, placeholder: str = '...'):
+    """Make a `FixedBalance` from major units, see `to_minor`."""
+    if value is None or (isinstance(value, OptionalFloat) and
+                         not value.filled()):
+      return FixedBalance(None, currency, placeholder)
+    return FixedBalance(to_minor(value, currency), currency, placeholder)
+
+  @property
+  def value(self) -> Optional[float]:
+    if self.minor is None:
+      return None
+    return self.minor / 10 ** self.scale
+
+  def get_minor(self) -> int:
+    if self.minor is None:
+      raise ValueError
+    return self.minor
+
+  def _make(self, minor):
+    return FixedBalance(minor, self.currency, self.placeholder)
+
+  def _other_minor(self, other) -> Optional[int]:
+    if isinstance(other, OptionalBalance) and other.currency != self.currency:
+      raise TypeError(f'Currency mismatch: {self.currency} / {other.currency}')
+    if isinstance(other, OptionalFloat) and not other.filled():
+      return None
+    return to_minor(other, self.currency)
+
+  def __add__(self, other):
+    other = self._other_minor(other)
+    if self.minor is None or other is None:
+      return self._make(None)
+    return self._make(self.minor + other)
+
+  __radd__ = __add__
+
+  def __sub__(self, other):
+    return self + (-self._make(self._other_minor(other)))
+
+  def __rsub__(self, other):
+    return (-self) + other
+
+  def __neg__(self):
+    return self._make(None if self.minor is None else -self.minor)
+
+  def __pos__(self):
+    return self
+
+  def __abs__(self):
+    return self._make(None if self.minor is None else abs(self.minor))
+
+  def __mul__(self, other):
+    if isinstance(other, int) and not isinstance(other, bool):
+      return self._make(None if self.minor is None else self.minor * other)
+    return OptionalBalance.__mul__(self, other)
+
+  __rmul__ = __mul__
+
+  def __eq__(self, other):
+    if isinstance(other, FixedBalance) and other.scale == self.scale:
+      return self.minor == other.minor
+    return super().__eq__(other)
+
+  def __lt__(self, other):
+    if isinstance(other, FixedBalance) and other.scale == self.scale:
+      if self.minor is None or other.minor is None:
+        raise ValueError('Cannot compare empty balances')
+      return self.minor < other.minor
+    return super().__lt__(other)
+
+
 def format_balance(balance: float) -> str:
   return f'{balance:,.2f}' if balance else '0.00'
 
 
+# Formats produced by us (`datetime.now()` in the DataController), by the IBKR
+# exports ('Date/Time' column) and by hand-written accounts JSON files.
+DATE_FORMATS = (
+  '%Y-%m-%d, %H:%M:%S',
+  '%Y-%m-%d %H:%M:%S',
+  '%Y-%m-%dT%H:%M:%S',
+  '%Y-%m-%d, %H:%M',
+  '%Y-%m-%d',
+  '%Y%m%d;%H%M%S',
+  '%Y%m%d',
+  '%d.%m.%Y',
+  '%d.%m.%Y %H:%M:%S',
+)
+
+DISPLAY_DATE_FORMAT = '%Y-%m-%d, %H:%M:%S'
+
+
+def parse_date(date) -> int:
+  """Convert `date` into epoch seconds.
+
+  Dates are wall-clock times without a timezone, so they are encoded as if
+  they were UTC. This keeps the encoding stable across DST changes and
+  `format_date` gives back exactly what was put in.
+
+  :param date: A string in one of `DATE_FORMATS`, a `datetime`/`date`, or
+      an int (already encoded).
+  """
+  if isinstance(date, bool):
+    raise ValueError(f'Invalid date: {date!r}')
+  if isinstance(date, int):
+    return date
+  if isinstance(date, datetime.date):  # Also covers `datetime`.
+    return calendar.timegm(date.timetuple())
+  if not isinstance(date, str):
+    raise ValueError(f'Invalid date: {date!r}')
+  date = date.strip()
+  for fmt in DATE_FORMATS:
+    try:
+      return calendar.timegm(datetime.datetime.strptime(date, fmt).timetuple())
+    except ValueError:
+      continue
+  raise ValueError(f'Unknown date format: {date!r}')
+
+
+def format_date(timestamp: int, fmt=DISPLAY_DATE_FORMAT) -> str:
+  """Inverse of `parse_date`."""
+  return datetime.datetime.fromtimestamp(
+    timestamp, datetime.timezone.utc).strftime(fmt)
+
+
+def now_timestamp() -> int:
+  return parse_date(datetime.datetime.now())
+
+
 def _make_func(cls, func_name, checker=None, get_init_kwargs=None):
   """
   :param cls: Class to create.
@@ -118,6 +299,8 @@ def _finalize_classes():
 
   assert OptionalBalance(4., 'USD') * OptionalBalance(1., 'USD') == \
          OptionalBalance(4., 'USD')
+  assert FixedBalance.from_value(0.1, 'USD') + 0.2 == \
+         FixedBalance(30, 'USD')
 
 
 _finalize_classes()
\ No newline at end of file
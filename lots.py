@@ -0,0 +1,167 @@
+"""Position lots per symbol, for cost basis and realised/unrealised gains.
+
+A `Position` is updated trade by trade, so it can be maintained incrementally
+as new trades come in, or rebuilt by replaying all trades of a symbol once.
+It tracks two cost basis methods at the same time:
+  - FIFO: Sells close the oldest open lots first.
+  - Average cost: All open shares share the same cost per share.
+
+All money is in integer minor units (see `helpers.to_minor`). Costs are
+"what we paid", i.e., the negated proceeds of the opening trades.
+Short positions are supported: Their lots have negative quantity and cost.
+"""
+
+import collections
+import dataclasses
+from typing import Iterable
+
+FIFO = 'fifo'
+AVERAGE = 'average'
+METHODS = (FIFO, AVERAGE)
+
+# Quantities are floats (IBKR has fractional shares), anything smaller than
+# this is considered to be zero.
+_EPS = 1e-9
+
+
+@dataclasses.dataclass
+class Lot:
+  date: int  # See `helpers.parse_date`.
+  quantity: float
+  cost: int
+
+
+def _is_zero(quantity):
+  return abs(quantity) < _EPS
+
+
+def _prorate(amount: int, part: float, whole: float) -> int:
+  """`amount * part / whole`, rounded, and exactly `amount` if part == whole."""
+  if _is_zero(abs(whole) - abs(part)):
+    return amount
+  return round(amount * abs(part) / abs(whole))
+
+
+class Position(object):
+  def __init__(self,
+               lots: Iterable[Lot] = (),
+               average_cost: int = 0,
+               realized_fifo: int = 0,
+               realized_average: int = 0,
+               last_transaction_id: int = 0):
+    """
+    :param lots: Open lots, oldest first.
+    :param average_cost: Total cost of all open shares under average cost.
+    :param realized_fifo: Realised gain so far under FIFO.
+    :param realized_average: Realised gain so far under average cost.
+    :param last_transaction_id: ID of the last share transaction applied.
+    """
+    self.lots = collections.deque(lots)
+    self.average_cost = average_cost
+    self.realized = {FIFO: realized_fifo, AVERAGE: realized_average}
+    self.last_transaction_id = last_transaction_id
+
+  def __repr__(self):
+    return (f'Position(quantity={self.quantity}, lots={len(self.lots)}, '
+            f'realized={self.realized})')
+
+  @property
+  def quantity(self) -> float:
+    return sum(lot.quantity for lot in self.lots)
+
+  def cost_basis(self, method=FIFO) -> int:
+    if method == FIFO:
+      return sum(lot.cost for lot in self.lots)
+    if method == AVERAGE:
+      return self.average_cost
+    raise ValueError(method)
+
+  def get_realized(self, method=FIFO) -> int:
+    return self.realized[method]
+
+  def get_unrealized(self, market_value: int, method=FIFO) -> int:
+    """Unrealised gain given the `market_value` of all open shares."""
+    return market_value - self.cost_basis(method)
+
+  def apply(self, kind, date, quantity, proceeds, transaction_id=None,
+            ratio=None):
+    """Apply a row of the shareTransactions table.
+
+    Splits only use their `ratio`, their `quantity` follows from it.
+    """
+    if kind == 'split':
+      self.apply_split(ratio)
+    else:
+      self.apply_trade(date, quantity, proceeds)
+    if transaction_id is not None:
+      # Trades are applied in date order, so this is not necessarily the last.
+      self.last_transaction_id = max(self.last_transaction_id, transaction_id)
+
+  def apply_trade(self, date, quantity: float, proceeds: int):
+    """Buy (`quantity` > 0) or sell (`quantity` < 0) shares."""
+    if _is_zero(quantity):
+      # Fees and such, directly realised.
+      for method in METHODS:
+        self.realized[method] += proceeds
+      return
+    quantity_before = self.quantity
+    if _is_zero(quantity_before) or (quantity_before > 0) == (quantity > 0):
+      closing = 0.
+    else:
+      closing = min(abs(quantity), abs(quantity_before))
+      if quantity < 0:
+        closing = -closing
+    closing_proceeds = _prorate(proceeds, closing, quantity)
+
+    if closing:
+      # Average cost.
+      basis = _prorate(self.average_cost, closing, quantity_before)
+      self.average_cost -= basis
+      self.realized[AVERAGE] += closing_proceeds - basis
+      # FIFO.
+      self.realized[FIFO] += closing_proceeds - self._close_fifo(closing)
+
+    opening = quantity - closing
+    if not _is_zero(opening):
+      opening_cost = -(proceeds - closing_proceeds)
+      self.average_cost += opening_cost
+      self.lots.append(Lot(date, opening, opening_cost))
+    if _is_zero(self.quantity):
+      self.lots.clear()
+      self.average_cost = 0
+
+  def _close_fifo(self, closing: float) -> int:
+    """Remove `closing` shares from the oldest lots, returns their cost."""
+    remaining = abs(closing)
+    basis = 0
+    while not _is_zero(remaining):
+      lot = self.lots[0]
+      taken = min(remaining, abs(lot.quantity))
+      taken_cost = _prorate(lot.cost, taken, lot.quantity)
+      basis += taken_cost
+      remaining -= taken
+      if _is_zero(abs(lot.quantity) - taken):
+        self.lots.popleft()
+      else:
+        lot.cost -= taken_cost
+        lot.quantity += taken if lot.quantity < 0 else -taken
+    return basis
+
+  def apply_split(self, ratio: float):
+    """E.g. `ratio` = 4 for a 4-for-1 split. Costs are unchanged."""
+    for lot in self.lots:
+      lot.quantity *= ratio
+
+
+def combine(positions: Iterable[Position]) -> Position:
+  """One position holding all `positions`, e.g. of the same symbol in two dbs.
+
+  The lots are merged by date, and the costs and realised gains added up.
+  """
+  positions = list(positions)
+  return Position(
+    sorted((lot for position in positions for lot in position.lots),
+           key=lambda lot: lot.date),
+    sum(position.average_cost for position in positions),
+    sum(position.realized[FIFO] for position in positions),
+    sum(position.realized[AVERAGE] for position in positions))
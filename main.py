@@ -8,9 +8,24 @@ fh.setLevel(logging.DEBUG)
 logger.addHandler(fh)
 
 import argparse
+import asyncio
+import atexit
+import cProfile
+import os
+import time
+import numpy as np
 import urwid
 
+import async_data_controller
+import charts
 import data_controller
+import helpers
+import price_feed
+import profiling
+import projection
+import quote_daemon
+import refresh_policy
+import sql_trace
 import symbol_values
 
 
@@ -18,7 +33,9 @@ _BACKGROUND = urwid.SolidFill(u'\N{MEDIUM SHADE}')
 _BASE_CURRENCY = 'CHF'
 
 
-_main_event_loop = urwid.AsyncioEventLoop()
+_asyncio_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(_asyncio_loop)
+_main_event_loop = urwid.AsyncioEventLoop(loop=_asyncio_loop)
 
 
 _PALETTE = [
@@ -56,11 +73,18 @@ class Controller:
     self.view.original_widget = self.stack[-1]
 
   def push(self, w):
+    try:
+      self.stack[-1].hide()
+    except AttributeError:
+      pass
     self.stack.append(w)
     self._update()
 
   def pop(self):
-    self.stack.pop()
+    try:
+      self.stack.pop().hide()
+    except AttributeError:
+      pass
     try:
       self.stack[-1].refresh()
     except AttributeError:
@@ -69,6 +93,32 @@ class Controller:
 
 
 
+def _sum_in_base(balances):
+  """Sums `balances`, converting to `_BASE_CURRENCY` where needed."""
+  return sum((symbol_values.convert_currency(balance, balance.currency,
+                                             _BASE_CURRENCY)
+              for balance in balances),
+             helpers.FixedBalance(0, _BASE_CURRENCY))
+
+
+def _history_series(name, rows, currency) -> charts.Series:
+  """Series of the `DataController.get_balance_history` rows, in `currency`.
+
+  Other currencies are converted at the current rate.
+  """
+  if not rows:
+    return charts.Series(name, [], [])
+  dates, currencies, balances = zip(*rows)
+  weights = {}
+  for c in set(currencies):
+    # Balances are in minor units. Rates not fetched yet are None.
+    weight = symbol_values.convert_currency(
+      helpers.FixedBalance(1, c), c, currency).value
+    weights[c] = float('nan') if weight is None else weight
+  return charts.Series(name, dates,
+                       charts.combine(currencies, balances, weights))
+
+
 def make_button(title, callback_fn):
   button = urwid.Button(title)
   urwid.connect_signal(button, 'click', callback_fn)
@@ -80,11 +130,114 @@ def boldify(w):
 
 
 def on_main(fn):
-  def callback():
-    _main_event_loop.alarm(0, lambda: fn())
+  def callback(*args):
+    _main_event_loop.alarm(0, lambda: fn(*args))
   return callback
 
 
+def start_task(awaitable) -> asyncio.Future:
+  """Runs `awaitable` on the event loop, e.g. to wait for the db."""
+  task = asyncio.ensure_future(awaitable, loop=_asyncio_loop)
+  task.add_done_callback(_on_task_done)
+  return task
+
+
+def _on_task_done(task: asyncio.Future):
+  if not task.cancelled() and task.exception():
+    logger.error('Task failed', exc_info=task.exception())
+  # urwid only redraws after its own callbacks.
+  _main_event_loop.alarm(0, lambda: None)
+
+
+async def _ignore(future, exception_type):
+  try:
+    await future
+  except exception_type:
+    pass  # TODO: maybe handle
+
+
+def _placeholder():
+  return urwid.Filler(urwid.Text('Loading...', align='center'))
+
+
+class VisibleRowsListBox(urwid.ListBox):
+  """A ListBox that reports which of its rows are on screen.
+
+  :param row_keys: Maps positions in `body` to keys, e.g. symbols.
+  :param on_visible: Called with the set of keys of the visible rows,
+      on every render.
+  """
+
+  def __init__(self, body, row_keys, on_visible):
+    super().__init__(body)
+    self.row_keys = row_keys
+    self.on_visible = on_visible
+
+  def render(self, size, focus=False):
+    canvas = super().render(size, focus)
+    middle, top, bottom = self.calculate_visible(size, focus)
+    if middle:
+      positions = [middle[2]]
+      positions += [pos for _, pos, _ in top[1]]
+      positions += [pos for _, pos, _ in bottom[1]]
+      self.on_visible({self.row_keys[pos] for pos in positions
+                       if pos in self.row_keys})
+    return canvas
+
+
+class PagingListWalker(urwid.ListWalker):
+  """A list of widgets that loads more when scrolling above the first one.
+
+  :param load_older: Called when scrolling above the first widget, should
+      eventually call `prepend`. Until then, a placeholder is shown.
+  """
+
+  def __init__(self, widgets, load_older=None):
+    self._widgets = list(widgets)
+    # Positions stay valid when prepending, the first of `widgets` is 0.
+    self._offset = 0
+    self._focus = 0
+    self._load_older = load_older
+    self._loading = None  # Placeholder while loading.
+
+  def get_focus(self):
+    return self._get(self._focus)
+
+  def set_focus(self, position):
+    self._focus = position
+    self._modified()
+
+  def get_next(self, position):
+    return self._get(position + 1)
+
+  def get_prev(self, position):
+    if (position - 1 < -self._offset and self._load_older and
+        not self._loading):
+      self._loading = urwid.Text('Loading...')
+      self._load_older()
+    return self._get(position - 1)
+
+  def prepend(self, widgets):
+    """Adds older widgets, no widgets means there are no more."""
+    self._loading = None
+    if widgets:
+      self._widgets[:0] = widgets
+      self._offset += len(widgets)
+    else:
+      self._load_older = None
+      # In case the placeholder had the focus.
+      self._focus = max(self._focus, -self._offset)
+    self._modified()
+
+  def _get(self, position):
+    i = position + self._offset
+    if 0 <= i < len(self._widgets):
+      return self._widgets[i], position
+    if i == -1 and self._loading:
+      return self._loading, position
+    return None, None
+
+
 class Header(urwid.WidgetWrap):
   _ALIGNS = {'l': 'left', 'r': 'right'}
 
@@ -102,35 +255,148 @@ class Header(urwid.WidgetWrap):
 
 
 class SummaryView(urwid.WidgetWrap):
-  def __init__(self, dc: data_controller.DataController, controller: Controller):
-    self.dc = dc
+  def __init__(self, adc: async_data_controller.AsyncDataController,
+               controller: Controller, feed: price_feed.PriceFeed = None,
+               returns_path=None, projection_workers=0,
+               returns_fixture=False):
+    """
+    :param feed: If given, visible share rows are updated in place with its
+        ticks.
+    :param returns_path: History file of `ProjectionView`, by default next to
+        the db.
+    :param returns_fixture: See `ProjectionView`.
+    """
+    self.adc = adc
     self.controller = controller
+    self.returns_path = returns_path or (
+      os.path.splitext(adc.dc.db_path)[0] + '.returns.json')
+    self.projection_workers = projection_workers
+    self.returns_fixture = returns_fixture
+    self._task = None  # Loading from the db.
     self.focus_walker = None
     self._last_focus = None
-    symbol_values.Ticker.register_callback(
-      'SummaryView',
-      on_main(self.refresh))
-      # lambda: controller.main_loop.event_loop.alarm(0, lambda *_: self.refresh()))
-    with self.dc.connect():
-      super(SummaryView, self).__init__(self._get_menu())
+    # Symbol -> (SymbolOverview, gain Text, value Text), for in-place updates.
+    self._share_rows = {}
+    self._share_totals = None  # (gain Text, value Text)
+    self._feed = feed
+    self._subscription = None
+    self._is_subscribed = False  # See `_subscribe`.
+    super(SummaryView, self).__init__(_placeholder())
+    self.refresh()
 
   def unhandled_input(self, key):
     if key == 'r':
       self.refresh()
+    if key == 'g':
+      self._start(self._show_chart())
+    if key == '/':
+      self.controller.push(SearchView(self.adc, self.controller))
+    if key == 'p':
+      self.controller.push(ProjectionView(
+        self.adc, self.controller, self.returns_path,
+        self.projection_workers, self.returns_fixture))
+    if key == 'P':  # Hidden debug screen.
+      self.controller.push(ProfileView(self.controller))
 
   def refresh(self):
+    """Reloads from the db, the current menu stays until that is done."""
     logger.info('***\nREFRESH\n***')
-    with self.dc.connect():
-      self._set_w(self._get_menu())
-
-  def __del__(self):
-    symbol_values.Ticker.remove_callback('SummaryView')
+    self._subscribe()
+    self._start(self._refresh())
+
+  def _subscribe(self):
+    """Updates on ticks and quotes while shown, until `hide`."""
+    if self._is_subscribed:
+      return
+    self._is_subscribed = True
+    if self._feed:
+      # The last ticks of newly visible rows come while rendering (see
+      # `_set_visible_symbols`), so they are handled after it.
+      self._subscription = self._feed.subscribe((), on_main(self._on_tick))
+    symbol_values.Ticker.register_callback('SummaryView',
+                                           on_main(self._on_quotes))
+
+  def _on_quotes(self):
+    # Maybe hidden since the quotes came in.
+    if self._is_subscribed:
+      self.refresh()
 
-  def _get_menu(self):
+  def _start(self, coro):
+    """Starts `coro`, cancelling what is still loading."""
+    if self._task:
+      self._task.cancel()
+    self._task = start_task(coro)
+
+  async def _refresh(self):
+    data = await self.adc.run(self._load, interruptible=True)
+    self._set_w(self._get_menu(*data))
+
+  @staticmethod
+  def _load(dc: data_controller.DataController):
+    """Everything `_get_menu` needs, on the db thread."""
+    with dc.trace_refresh('SummaryView'):
+      return (dc.get_all_accounts(category=0),
+              dc.get_category_totals(category=0),
+              dc.get_all_accounts(category=1),
+              dc.get_category_totals(category=1),
+              dc.get_all_symbol_overviews())
+
+  async def _show_chart(self):
+    rows = await self.adc.get_balance_history()
+    self.controller.push(ChartView(
+      self.controller, _history_series('Total', rows, _BASE_CURRENCY),
+      _BASE_CURRENCY))
+
+  def hide(self):
+    """Also called when popped, views are not notified otherwise."""
+    self._set_visible_symbols(())
+    if self._task:
+      self._task.cancel()
+    if self._is_subscribed:
+      self._is_subscribed = False
+      if self._subscription:
+        self._subscription.close()
+        self._subscription = None
+      symbol_values.Ticker.remove_callback('SummaryView')
+
+  def _on_tick(self, tick: price_feed.Tick):
+    symbol_values.Ticker.make(tick.symbol).set_price(tick.price,
+                                                     tick.timestamp)
+    if tick.symbol in self._share_rows:
+      self._update_share_row(tick.symbol)
+      self._update_share_totals()
+
+  def _update_share_row(self, symbol_name):
+    so, gain_text, value_text = self._share_rows[symbol_name]
+    gain_text.set_text(so.get_current_total_gain().attr_str())
+    value_text.set_text(str(so.get_current_total_value()))
+
+  def _update_share_totals(self):
+    symbol_overviews = [so for so, _, _ in self._share_rows.values()]
+    total_gain = sum(
+      so.get_current_total_gain(currency=_BASE_CURRENCY)
+      for so in symbol_overviews)
+    total_share_value = sum(
+      so.get_current_total_value(currency=_BASE_CURRENCY)
+      for so in symbol_overviews)
+    gain_text, value_text = self._share_totals
+    gain_text.set_text(('bold', str(total_gain)))
+    value_text.set_text(('bold', str(total_share_value)))
+
+  def _set_visible_symbols(self, symbol_names):
+    if self._subscription:
+      self._subscription.set_symbols(symbol_names)
+    policy = symbol_values.get_refresh_policy()
+    if policy:
+      symbol_values.refresh(policy.set_visible(symbol_names))
+
+  @profiling.timed('ui.SummaryView._get_menu')
+  def _get_menu(self, accs, totals, special_accs, special_totals,
+                symbol_overviews):
+    """See `_load` for the arguments."""
     body = [urwid.Text(('brand', 'ppfin')), urwid.Divider()]
 
     # Normal (category-0) Accounts
-    accs = self.dc.get_all_accounts(category=0)
     body += [Header('Account', 'Diff', 'Balance', aligns='lrr')]
     for acc in accs:
       body.append(urwid.Columns([
@@ -138,74 +404,94 @@ class SummaryView(urwid.WidgetWrap):
         urwid.Text(acc.get_diff_to_last().attr_str(), align='right'),
         urwid.Text(str(acc.get_balance()), align='right')]))
 
-    total_diff = sum(acc.get_diff_to_last() for acc in accs).attr_str()
-    total = sum(acc.get_balance() for acc in accs)
+    total_diff = _sum_in_base(diff for _, diff in totals.values()).attr_str()
+    total = _sum_in_base(total for total, _ in totals.values())
 
     # Special (category-1) Accounts
-    accs = self.dc.get_all_accounts(category=1)
-    if accs:
-      for acc in accs:
+    if special_accs:
+      for acc in special_accs:
         body.append(urwid.Columns([
           make_button(acc.name, lambda btn: self._show_account(btn.get_label())),
           urwid.Text(''),
           urwid.Text(str(acc.get_balance()), align='right')]))
-        total += acc.get_balance()
+      total += _sum_in_base(total for total, _ in special_totals.values())
 
     body += [urwid.Columns([
       urwid.Text(('bold', 'Total')),
       boldify(urwid.Text(total_diff, align='right')),
       urwid.Text(('bold', str(total)), align='right')])]
 
-    body += [urwid.Divider(),
-             make_button('Update Balances', self._update_balances),
-             make_button('Add Account', self._add_account),
-             urwid.Divider()]
+    body += [urwid.Divider()]
+    if not self.adc.dc.read_only:
+      body += [make_button('Update Balances', self._update_balances),
+               make_button('Add Account', self._add_account),
+               urwid.Divider()]
 
     # Shares
-    symbol_overviews = self.dc.get_all_symbol_overviews()
+    self._prioritize(symbol_overviews)
+    row_keys = {}
+    self._share_rows = {}
     if not symbol_overviews:
       body += [urwid.Text('No Shares!')]
     else:
       body += [Header('Symbol', 'Shares', 'Gain', 'Possession', aligns='lrrr')]
       for so in symbol_overviews:
+        row_keys[len(body)] = so.symbol
+        gain_text = urwid.Text('', align='right')
+        value_text = urwid.Text('', align='right')
+        self._share_rows[so.symbol] = (so, gain_text, value_text)
+        self._update_share_row(so.symbol)
+        # Shares can only be updated in their own db.
+        symbol_widget = (urwid.Text(so.symbol) if self.adc.dc.read_only
+                         else make_button(so.symbol, self._update_share))
         body.append(urwid.Columns([
-          make_button(so.symbol, self._update_share),
+          symbol_widget,
           urwid.Text(str(so.quantity), align='right'),
-          urwid.Text(so.get_current_total_gain().attr_str(),
-                     align='right'),
-          urwid.Text(str(so.get_current_total_value()),
-                     align='right')]))
-
-      total_gain = sum(
-        so.get_current_total_gain(currency=_BASE_CURRENCY)
-        for so in symbol_overviews)
-      total_share_value = sum(
-        so.get_current_total_value(currency=_BASE_CURRENCY)
-        for so in symbol_overviews)
+          gain_text,
+          value_text]))
 
+      self._share_totals = (urwid.Text('', align='right'),
+                            urwid.Text('', align='right'))
+      self._update_share_totals()
       body += [
         urwid.Columns([
           urwid.Text(('bold', 'Total')),
           urwid.Text(''),
-          urwid.Text(('bold', str(total_gain)), align='right'),
-          urwid.Text(('bold', str(total_share_value)), align='right'),
+          *self._share_totals,
         ])
       ]
-    body += [urwid.Divider(),
-             make_button('Update Shares', self._update_shares),
-             make_button('Add Share', self._add_share),
-             urwid.Divider()]
+    body += [urwid.Divider()]
+    if not self.adc.dc.read_only:
+      body += [make_button('Update Shares', self._update_shares),
+               make_button('Add Share', self._add_share),
+               urwid.Divider()]
 
     self.focus_walker = urwid.SimpleFocusListWalker(body)
     urwid.connect_signal(self.focus_walker, 'modified',
                          lambda: self._cache_focus_value())
     if self._last_focus is not None:
       self.focus_walker.set_focus(self._last_focus)
-    return urwid.ListBox(self.focus_walker)
+    return VisibleRowsListBox(self.focus_walker, row_keys,
+                              self._set_visible_symbols)
+
+  def _prioritize(self, symbol_overviews):
+    """Schedules stale quotes of open positions, largest first."""
+    policy = symbol_values.get_refresh_policy()
+    if not policy:
+      return
+    open_symbols = []
+    for so in symbol_overviews:
+      if so.quantity == 0:
+        continue
+      value = symbol_values.Ticker.make(so.symbol).get_cached_value()
+      policy.set_weight(so.symbol, so.quantity * value.value if value.filled()
+                        else so.proceeds_so_far.value)
+      open_symbols.append(so.symbol)
+    symbol_values.refresh(open_symbols)
 
   def _show_account(self, account_name):
     self.controller.push(AccountDetailView(
-      self.dc, self.controller, account_name))
+      self.adc, self.controller, account_name))
 
   def _cache_focus_value(self):
     self._last_focus = self.focus_walker.focus
@@ -220,10 +506,9 @@ class SummaryView(urwid.WidgetWrap):
     def done(_):
       name = name_edit.get_edit_text()
       currency = cur_edit.get_edit_text()
-      try:
-        self.dc.add_stock_symbol(name, currency)
-      except data_controller.SymbolExistsException:
-        pass  # TODO: maybe handle
+      # The summary refreshes after this, there is only one db thread.
+      future = self.adc.add_stock_symbol(name, currency)
+      start_task(_ignore(future, data_controller.SymbolExistsException))
       self.controller.pop()
 
     header = urwid.Text('Add Share')
@@ -239,13 +524,13 @@ class SummaryView(urwid.WidgetWrap):
     self.controller.push(urwid.Filler(widget, 'top'))
 
   def _update_balances(self, _):
-    self.controller.push(UpdateView(self.dc, self.controller))
+    self.controller.push(UpdateView(self.adc, self.controller))
 
   def _add_account(self, _):
     def done(_):
       name, _ = name_edit.get_text()
       name = name.replace('Name: ', '')
-      self.dc.create_account(name, _BASE_CURRENCY)  # TODO
+      start_task(self.adc.create_account(name, _BASE_CURRENCY))  # TODO
       self.controller.pop()
 
     name_edit = urwid.Edit("Name: ")
@@ -261,44 +546,387 @@ class SummaryView(urwid.WidgetWrap):
 
 class AccountDetailView(urwid.WidgetWrap):
   def __init__(self,
-               dc: data_controller.DataController,
+               adc: async_data_controller.AsyncDataController,
                controller: Controller,
                account_name: str):
-    self.dc = dc
+    self.adc = adc
     self.controller = controller
     self.account_name = account_name
-    super().__init__(self._get())
-
-  def _get(self):
-    transactions = self.dc.get_account_transactions(self.account_name)
-
-    body = [Header('Date', 'Info', 'Amount', aligns='llr')]
-    for t in transactions:
-      body.append(urwid.Columns([
-        urwid.Text(t.date),
-        urwid.Text(t.info),
-        urwid.Text(t.value.attr_str(), align='right'),
-      ]))
+    self.walker: PagingListWalker = None
+    self._archive_id = None  # Of the last archive loaded.
+    super().__init__(_placeholder())
+    self._task = start_task(self._load())
+    self._chart_task = None
+
+  def hide(self):
+    self._task.cancel()
+    if self._chart_task:
+      self._chart_task.cancel()
+
+  async def _load(self):
+    transactions = await self.adc.get_account_transactions(self.account_name)
+    self._set_w(self._get(transactions))
+
+  @profiling.timed('ui.AccountDetailView._get')
+  def _get(self, transactions):
+    body = [self._make_row(t) for t in transactions]
     body += [
       urwid.Divider(),
       make_button('Done', lambda _: self.controller.pop())]
 
+    # Archived transactions are only loaded when scrolling past their
+    # checkpoint.
+    has_archive = any(t.is_checkpoint for t in transactions)
+    self.walker = PagingListWalker(
+      body, self._load_archived if has_archive else None)
+    return urwid.Frame(urwid.ListBox(self.walker),
+                       header=Header('Date', 'Info', 'Amount', aligns='llr'))
+
+  def unhandled_input(self, key):
+    if key == 'g':
+      if self._chart_task:
+        self._chart_task.cancel()
+      self._chart_task = start_task(self._show_chart())
+
+  async def _show_chart(self):
+    rows, currency = await self.adc.run(
+      lambda dc: (dc.get_balance_history(self.account_name),
+                  dc.get_balance(self.account_name).currency),
+      interruptible=True)
+    self.controller.push(ChartView(
+      self.controller, _history_series(self.account_name, rows, currency),
+      currency))
+
+  def _load_archived(self):
+    self._task = start_task(self._load_archived_async())
+
+  async def _load_archived_async(self):
+    transactions, self._archive_id = await self.adc.get_archived_transactions(
+      self.account_name, self._archive_id)
+    self.walker.prepend([self._make_row(t) for t in transactions])
+
+  @staticmethod
+  def _make_row(t: data_controller.AccountTransaction):
+    info = 'Archived (scroll up)' if t.is_checkpoint else t.info
+    return urwid.Columns([
+      urwid.Text(t.date),
+      urwid.Text(info),
+      urwid.Text(t.value.attr_str(), align='right'),
+    ])
+
+
+class ChartView(urwid.WidgetWrap):
+  """Chart of a `charts.Series`, see `unhandled_input` for the keys."""
+
+  def __init__(self, controller: Controller, series: charts.Series,
+               currency: str):
+    self.controller = controller
+    self.series = series
+    self.currency = currency
+    self.method = charts.MINMAX
+    if len(series):
+      self.first, self.last = series.x[0], series.x[-1] + 1
+    else:
+      self.first, self.last = 0, 1
+    self.start, self.end = self.first, self.last
+    self._range_text = urwid.Text('')
+    self._chart = _ChartWidget(self)
+    self._update()
+    super().__init__(urwid.Frame(
+      self._chart,
+      header=urwid.Pile([urwid.Text(('brand', series.name)),
+                         self._range_text]),
+      footer=urwid.Text('[+/-] zoom, [left/right] pan, [m]ethod, [q]uit')))
+
+  def unhandled_input(self, key):
+    length = self.end - self.start
+    if key == '+':
+      self._set_range(self.start + length / 4, self.end - length / 4)
+    elif key == '-':
+      self._set_range(self.start - length / 2, self.end + length / 2)
+    elif key == 'left':
+      self._set_range(self.start - length / 4, self.end - length / 4)
+    elif key == 'right':
+      self._set_range(self.start + length / 4, self.end + length / 4)
+    elif key == 'm':
+      self.method = charts.METHODS[
+        (charts.METHODS.index(self.method) + 1) % len(charts.METHODS)]
+      self._update()
+    elif key in ('q', 'esc'):
+      self.controller.pop()
+
+  def _set_range(self, start, end):
+    """Sets [start, end), shifted and clipped to the series."""
+    length = min(end - start, self.last - self.first)
+    start = min(max(start, self.first), self.last - length)
+    # Whole seconds, so that panning back hits the cache.
+    self.start, self.end = round(start), round(start + length)
+    self._update()
+
+  def _update(self):
+    self._range_text.set_text(
+      f'{helpers.format_date(self.start)} - '
+      f'{helpers.format_date(self.end)} ({self.method})')
+    self._chart._invalidate()
+
+
+class _ChartWidget(urwid.Widget):
+  _sizing = frozenset(['box'])
+
+  def __init__(self, view: ChartView):
+    super().__init__()
+    self.view = view
+
+  @profiling.timed('ui.ChartView.render')
+  def render(self, size, focus=False):
+    maxcol, maxrow = size
+    view = self.view
+    lows, highs = charts.downsample(view.series, view.start, view.end, maxcol,
+                                    view.method)
+    lines = charts.render(
+      lows, highs, maxrow, label=lambda value: str(
+        helpers.FixedBalance.from_value(float(value), view.currency)))
+    return urwid.Text('\n'.join(lines), wrap='clip').render((maxcol,))
+
+
+class ProjectionView(urwid.WidgetWrap):
+  """Percentile bands of the total in `_BASE_CURRENCY`, see `projection`."""
+
+  _YEARS = 10
+  _NUM_PATHS = 10000
+
+  def __init__(self, adc: async_data_controller.AsyncDataController,
+               controller: Controller, returns_path, num_workers=0,
+               returns_fixture=False):
+    """
+    :param returns_path: See `projection.load_history`, its steps must be
+        months.
+    :param num_workers: See `projection.project`.
+    :param returns_fixture: If True, `returns_path` is only read, and never
+        fetched, e.g. for testing without network.
+    """
+    self.adc = adc
+    self.controller = controller
+    self.returns_path = returns_path
+    self.num_workers = num_workers
+    self.returns_fixture = returns_fixture
+    super().__init__(_placeholder())
+    self._task = start_task(self._load())
+
+  def hide(self):
+    self._task.cancel()
+
+  def unhandled_input(self, key):
+    if key in ('q', 'esc'):
+      self.controller.pop()
+
+  async def _load(self):
+    portfolio = await self.adc.run(
+      lambda dc: projection.current_portfolio(dc, _BASE_CURRENCY),
+      interruptible=True)
+    try:
+      # Might fetch the history, and simulating takes a while.
+      bands = await _asyncio_loop.run_in_executor(
+        None, self._project, portfolio)
+    except Exception as e:
+      logger.error('Projection failed', exc_info=e)
+      self._set_w(urwid.Filler(urwid.Text(
+        f'Cannot project: {e!r}\n[q]uit', align='center')))
+      return
+    self._set_w(self._get(portfolio, bands))
+
+  def _project(self, portfolio: projection.Portfolio):
+    if self.returns_fixture:
+      history = projection.load_history(self.returns_path, portfolio.values,
+                                        max_age_s=None)
+    else:
+      history = projection.load_history(self.returns_path, portfolio.values)
+    return projection.project(portfolio, history, self._YEARS * 12,
+                              num_paths=self._NUM_PATHS,
+                              num_workers=self.num_workers)
+
+  def _get(self, portfolio: projection.Portfolio, bands):
+    percentiles = ', '.join(
+      f'{p}%: ' + str(helpers.FixedBalance.from_value(float(value),
+                                                     _BASE_CURRENCY))
+      for p, value in zip(projection.PERCENTILES, bands[:, -1]))
+    header = [urwid.Text(('brand', 'Projection')),
+              urwid.Text(f'{self._NUM_PATHS} paths, in {self._YEARS} years: '
+                         f'{percentiles}')]
+    if portfolio.missing:
+      header.append(urwid.Text(
+        f'Left out, no price yet: {", ".join(portfolio.missing)}'))
+    return urwid.Frame(_BandsWidget(bands),
+                       header=urwid.Pile(header),
+                       footer=urwid.Text('[q]uit'))
+
+
+class _BandsWidget(urwid.Widget):
+  """Draws the percentiles of `projection.project`, as nested bands."""
+  _sizing = frozenset(['box'])
+
+  def __init__(self, bands):
+    super().__init__()
+    self.bands = bands
+
+  def render(self, size, focus=False):
+    maxcol, maxrow = size
+    x = np.arange(self.bands.shape[1], dtype=np.float64)
+    end = len(x)
+    # The outermost percentiles first, down to the median.
+    pairs = [(i, len(self.bands) - 1 - i)
+             for i in range((len(self.bands) + 1) // 2)]
+    lines = charts.render_bands(
+      [(charts.minmax(x, self.bands[lo], 0, end, maxcol)[0],
+        charts.minmax(x, self.bands[hi], 0, end, maxcol)[1])
+       for lo, hi in pairs],
+      maxrow, label=lambda value: str(
+        helpers.FixedBalance.from_value(float(value), _BASE_CURRENCY)))
+    return urwid.Text('\n'.join(lines), wrap='clip').render((maxcol,))
+
+
+class SearchView(urwid.WidgetWrap):
+  """Searches the transactions of all accounts while typing.
+
+  Down/up move between the search field and the results, esc goes back.
+  """
+
+  _PAGE_SIZE = 50
+  # Typing faster than this only searches once.
+  _DEBOUNCE_S = 0.05
+
+  def __init__(self, adc: async_data_controller.AsyncDataController,
+               controller: Controller):
+    self.adc = adc
+    self.controller = controller
+    self.edit = urwid.Edit(('brand', 'Search: '))
+    urwid.connect_signal(self.edit, 'postchange', lambda *_: self._search())
+    self._status = urwid.Text('')
+    self.walker = urwid.SimpleFocusListWalker([])
+    self._task = None
+    self.frame = urwid.Frame(
+      urwid.ListBox(self.walker),
+      header=urwid.Pile([
+        self.edit, self._status,
+        Header('Date', 'Account', 'Info', 'Amount', aligns='lllr')]),
+      focus_part='header')
+    super().__init__(self.frame)
+
+  def hide(self):
+    if self._task:
+      self._task.cancel()
+
+  def unhandled_input(self, key):
+    if key == 'down' and self.frame.focus_position == 'header':
+      if self.walker:
+        self.frame.focus_position = 'body'
+    elif key == 'up' and self.frame.focus_position == 'body':
+      self.frame.focus_position = 'header'
+    elif key == 'esc':
+      self.controller.pop()
+
+  def _search(self, offset=0):
+    """Searches for the text in the search field, cancelling the last search."""
+    if self._task:
+      self._task.cancel()
+    self._task = start_task(self._search_async(self.edit.edit_text, offset))
+
+  async def _search_async(self, text, offset):
+    await asyncio.sleep(self._DEBOUNCE_S)
+    start = time.perf_counter()
+    # One more, to know if there is a next page.
+    results = await self.adc.run(
+      lambda dc: dc.search_transactions(
+        text, limit=self._PAGE_SIZE + 1, offset=offset),
+      interruptible=True)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    has_more = len(results) > self._PAGE_SIZE
+    results = results[:self._PAGE_SIZE]
+    rows = [self._make_row(result) for result in results]
+    if has_more:
+      rows.append(make_button(
+        'More', lambda _: self._search(offset + self._PAGE_SIZE)))
+    if offset:
+      del self.walker[-1]  # The previous 'More' button.
+    else:
+      del self.walker[:]
+    self.walker.extend(rows)
+    num_results = offset + len(results)
+    self._status.set_text(
+      f'{num_results}{"+" if has_more else ""} results, {elapsed_ms:.0f} ms'
+      if text.strip() else '')
+
+  def _make_row(self, result: data_controller.SearchResult):
+    t = result.transaction
+    return urwid.Columns([
+      urwid.Text(t.date),
+      make_button(result.account_name,
+                  lambda _: self.controller.push(AccountDetailView(
+                    self.adc, self.controller, result.account_name))),
+      urwid.Text(t.info),
+      urwid.Text(t.value.attr_str(), align='right'),
+    ])
+
+
+class ProfileView(urwid.WidgetWrap):
+  """Shows the timers and counters of `profiling`."""
+
+  def __init__(self, controller: Controller):
+    self.controller = controller
+    super().__init__(self._get())
+
+  def unhandled_input(self, key):
+    if key == 'r':
+      self.refresh()
+    if key == 't':
+      profiling.enable(not profiling.is_enabled())
+      self.refresh()
+    if key == 'c':
+      profiling.reset()
+      self.refresh()
+
+  def refresh(self):
+    self._set_w(self._get())
+
+  def _get(self):
+    state = 'enabled' if profiling.is_enabled() else 'disabled'
+    body = [urwid.Text(('brand', 'Profile')),
+            urwid.Text(f'Profiling is {state}. '
+                       f'[r]efresh, [t]oggle, [c]lear'),
+            urwid.Divider()]
+    body += [urwid.Text(line, wrap='clip') for line in profiling.report()]
+    body += [urwid.Divider(),
+             make_button('Done', lambda _: self.controller.pop())]
     return urwid.ListBox(urwid.SimpleFocusListWalker(body))
 
 
 class UpdateView(urwid.WidgetWrap):
   def __init__(self,
-               dc: data_controller.DataController,
+               adc: async_data_controller.AsyncDataController,
                controller: Controller):
-    self.dc = dc
+    self.adc = adc
     self.controller = controller
     self.done_button: urwid.AttrMap = None
     self.focus_walker: urwid.SimpleFocusListWalker = None
+    # Snapshot of the accounts, with their balances, and their edit fields.
     self.accs = None
-    super(UpdateView, self).__init__(self._get_menu())
+    self.edits = None
+    self._invalid = set()  # Indices into `accs` of unparsable fields.
+    super(UpdateView, self).__init__(_placeholder())
+    self._task = None
+    self.refresh()
 
   def refresh(self):
-    self._set_w(self._get_menu())
+    if self._task:
+      self._task.cancel()
+    self._task = start_task(self._load())
+
+  def hide(self):
+    self._task.cancel()
+
+  async def _load(self):
+    accs = await self.adc.get_all_accounts(category=0)
+    self._set_w(self._get_menu(accs))
 
   def unhandled_input(self, key):
     if key == 'enter':
@@ -312,22 +940,24 @@ class UpdateView(urwid.WidgetWrap):
       #   return
       self.focus_walker.set_focus(next_position)
 
-  def _get_menu(self):
+  def _get_menu(self, accs):
     body = [urwid.Text('Update'), urwid.Divider()]
-    self.accs = self.dc.get_all_accounts(category=0)
+    self.accs = accs
     if not self.accs:
       raise NotImplemented
     indent = max(len(acc.name) for acc in self.accs) + 5
-    for acc in self.accs:
+    self.edits = []
+    self._invalid = set()
+    for i, acc in enumerate(self.accs):
       label = acc.name + ':'
       indent_acc = (indent - len(label)) * ' '
-      body.append(urwid.Edit(f"{label}{indent_acc}"))
-        # make_button(acc.name, lambda _:...),
-        # urwid.Text(acc.get_formatted_balance(), align='right')]))
+      edit = urwid.Edit(f"{label}{indent_acc}")
+      urwid.connect_signal(edit, 'change', self._validate, user_args=[i])
+      self.edits.append(edit)
+    body += self.edits
 
     def done(_):
-      all_ok = self._validate()
-      if all_ok:
+      if not self._invalid:
         self._commit()
         self.controller.pop()
 
@@ -337,47 +967,45 @@ class UpdateView(urwid.WidgetWrap):
              make_button('Cancel', lambda _: self.controller.pop()),
              ]
     self.focus_walker = urwid.SimpleFocusListWalker(body)
-    urwid.connect_signal(self.focus_walker, 'modified',
-                         lambda: self._validate())
     return urwid.ListBox(self.focus_walker)
 
   def _commit(self):
-    edit_fields = [e for e in self.focus_walker
-                   if isinstance(e, urwid.Edit)]
-    assert len(edit_fields) == len(self.accs)
-    with self.dc.connect():
-      for e, acc in zip(edit_fields, self.accs):
-        assert acc.name in e.caption
-        value = e.get_edit_text()
-        if not value:
-          continue
-        value = float(value)
-        diff = value - acc.get_balance()
-        self.dc.add_transaction(acc.name, diff)
-
-
-  def _validate(self):
-    all_ok = True
-    for i, e in enumerate(self.focus_walker):
-      if not isinstance(e, urwid.Edit):
-        continue
+    """Writes the diffs to the balances of the snapshot, in one batch."""
+    diffs = []
+    for e, acc in zip(self.edits, self.accs):
       value = e.get_edit_text()
       if not value:
         continue
-      try:
-        float(value)
-        is_ok = True
-      except ValueError:
-        is_ok = False
-      caption = e.caption
-      if is_ok and '!' in caption:
-        caption = caption.replace('!', ':')
-        e.set_caption(caption)
-      if not is_ok and '!' not in caption:
-        caption = caption.replace(':', '!')
-        e.set_caption(('err', caption))
-      all_ok = all_ok and is_ok
-    if not all_ok:
+      value = helpers.FixedBalance.from_value(value, acc.currency)
+      diffs.append((acc.name, value - acc.get_balance()))
+    # Not cancelled, and queued before the refresh of the summary.
+    start_task(self.adc.add_transactions(diffs))
+
+  def _validate(self, i, e: urwid.Edit, value):
+    """Called with the new text of the `i`-th field whenever it changes."""
+    # Parsed like in `_commit`, and must fit an INTEGER column.
+    try:
+      is_ok = not value or abs(
+        helpers.to_minor(value, self.accs[i].currency)) < 2 ** 63
+    except (ValueError, ArithmeticError):
+      is_ok = False
+    caption = e.caption
+    if is_ok and '!' in caption:
+      caption = caption.replace('!', ':')
+      e.set_caption(caption)
+    if not is_ok and '!' not in caption:
+      caption = caption.replace(':', '!')
+      e.set_caption(('err', caption))
+    was_ok = not self._invalid
+    if is_ok:
+      self._invalid.discard(i)
+    else:
+      self._invalid.add(i)
+    if was_ok != (not self._invalid):
+      self._update_done_button()
+
+  def _update_done_button(self):
+    if self._invalid:
       self.done_button.set_attr_map({None: 'err'})
       self.done_button.original_widget.set_label(
         'Errors: All values must be floats!')
@@ -385,14 +1013,18 @@ class UpdateView(urwid.WidgetWrap):
       self.done_button.set_attr_map({None: None})
       self.done_button.original_widget.set_label(
         'Done')
-    return all_ok
 
 
 class MainWindow:
-  def __init__(self, dc: data_controller.DataController):
+  def __init__(self, dc: data_controller.DataController,
+               feed: price_feed.PriceFeed = None, **summary_kwargs):
+    """:param summary_kwargs: See `SummaryView`."""
     self.dc = dc
+    # The views never query on the event loop, see `start_task`.
+    self.adc = async_data_controller.AsyncDataController(dc)
     self.controller = Controller()
-    self.controller.push(SummaryView(dc, self.controller))
+    self.controller.push(SummaryView(self.adc, self.controller, feed,
+                                     **summary_kwargs))
     self.main_loop = None
 
   def make_main_loop(self):
@@ -424,12 +1056,78 @@ def exit_program(button):
 
 def main():
   p = argparse.ArgumentParser()
-  p.add_argument('--database', '-db', required=True)
+  p.add_argument('--database', '-db', required=True, nargs='+',
+                 help='If several are given, they are shown combined and '
+                      'read-only, e.g., one db per person.')
+  p.add_argument('--profile',
+                 help='Enable timers (see the debug screen, key P) and write '
+                      'a cProfile dump to this path on exit.')
+  p.add_argument('--trace_sql',
+                 help='Record SQL query statistics and write a report to '
+                      'this path on exit.')
+  p.add_argument('--slow_query_ms', type=float, default=10,
+                 help='With --trace_sql, queries slower than this are '
+                      'reported with their query plan.')
+  p.add_argument('--refresh_all', action='store_true',
+                 help='Refresh all quotes every 5 minutes, instead of '
+                      'prioritising visible symbols and open markets.')
+  p.add_argument('--feed', choices=('poll', 'daemon', 'simulated'),
+                 help='Stream prices of the visible shares: poll them every '
+                      '--feed_interval_s, subscribe to the quote daemon, or '
+                      'simulate ticks for testing.')
+  p.add_argument('--feed_interval_s', type=float, default=30)
+  p.add_argument('--no_quote_daemon', action='store_true',
+                 help='Always fetch quotes in-process, even if '
+                      'quote_daemon.py is running.')
+  p.add_argument('--returns',
+                 help='Monthly prices for the projection (key p), see '
+                      'projection.History. Fetched and cached here if '
+                      'outdated. Defaults to a file next to the database.')
+  p.add_argument('--returns_fixture', action='store_true',
+                 help='Only read --returns, never fetch it, e.g. a fixture '
+                      'for testing without network.')
+  p.add_argument('--projection_workers', type=int, default=0,
+                 help='Simulate the projection in this many processes.')
   flags = p.parse_args()
-  dc = data_controller.DataController(flags.database)
-  mw = MainWindow(dc)
+  if not flags.no_quote_daemon:
+    symbol_values.set_provider(quote_daemon.DaemonQuoteProvider(
+      fallback=symbol_values.get_provider()))
+  if not flags.refresh_all:
+    symbol_values.set_refresh_policy(refresh_policy.RefreshPolicy())
+  profiler = None
+  if flags.profile:
+    profiling.enable()
+    profiler = cProfile.Profile()
+    profiler.enable()
+  trace = None
+  if flags.trace_sql:
+    trace = sql_trace.QueryStats(flags.slow_query_ms / 1000)
+    atexit.register(trace.dump, flags.trace_sql)
+  if len(flags.database) == 1:
+    dc = data_controller.DataController(flags.database[0], trace=trace)
+  else:
+    dc = data_controller.PortfolioDataController(flags.database, trace=trace)
+  feed = None
+  if flags.feed == 'poll':
+    feed = price_feed.PollingFeed(flags.feed_interval_s)
+  elif flags.feed == 'daemon':
+    feed = quote_daemon.DaemonFeed(interval_s=flags.feed_interval_s)
+  elif flags.feed == 'simulated':
+    feed = price_feed.SimulatedFeed(interval_s=flags.feed_interval_s)
+  if feed:
+    feed.start(_asyncio_loop)
+  mw = MainWindow(dc, feed, returns_path=flags.returns,
+                  projection_workers=flags.projection_workers,
+                  returns_fixture=flags.returns_fixture)
   loop = mw.make_main_loop()
-  loop.run()
+  try:
+    loop.run()
+  finally:
+    mw.adc.close()
+    if profiler:
+      profiler.disable()
+      profiler.dump_stats(flags.profile)
+      logger.info('\n'.join(profiling.report()))
 
 
 
@@ -0,0 +1,170 @@
+"""Subscription-style price feeds, delivering ticks on an asyncio loop.
+
+  feed = price_feed.PollingFeed(interval_s=30)
+  feed.start()
+  subscription = feed.subscribe(['AAPL', 'NESN.SW'], callback=print)
+  ...
+  subscription.set_symbols(['AAPL'])  # E.g., when rows scroll away.
+  subscription.close()
+
+Without a callback, a subscription is an async iterator of `Tick`s:
+
+  async for tick in feed.subscribe(['AAPL']):
+    ...
+
+Only symbols with at least one subscriber are polled, and ticks are only
+published when the price changed. So that they don't have to wait for that,
+subscriptions get the last tick of a symbol right when they add it.
+"""
+
+import asyncio
+import collections
+import random
+import time
+from typing import Callable, Iterable, Optional
+
+import symbol_values
+
+import logging
+
+logger = logging.getLogger()
+
+Tick = collections.namedtuple('Tick', ['symbol', 'price', 'timestamp'])
+
+
+class Subscription(object):
+  def __init__(self, feed: 'PriceFeed', symbol_names: Iterable[str],
+               callback: Optional[Callable[[Tick], None]] = None):
+    self.feed = feed
+    self.symbol_names = frozenset(symbol_names)
+    self.callback = callback
+    self._queue = None if callback else asyncio.Queue()
+
+  def set_symbols(self, symbol_names: Iterable[str]):
+    symbol_names = frozenset(symbol_names)
+    added = symbol_names - self.symbol_names
+    self.symbol_names = symbol_names
+    self.feed._send_last_ticks(self, added)
+
+  def close(self):
+    self.feed._subscriptions.remove(self)
+
+  def _put(self, tick: Tick):
+    if self.callback:
+      self.callback(tick)
+    else:
+      self._queue.put_nowait(tick)
+
+  def __aiter__(self):
+    if not self._queue:
+      raise TypeError('Subscriptions with a callback are not iterable.')
+    return self
+
+  async def __anext__(self) -> Tick:
+    return await self._queue.get()
+
+
+class PriceFeed(object):
+  """Base class, subclasses implement `_run`, which calls `_publish`."""
+
+  def __init__(self):
+    self._subscriptions = []
+    self._last_ticks = {}
+    self._task: Optional[asyncio.Task] = None
+
+  def subscribe(self, symbol_names: Iterable[str],
+                callback: Optional[Callable[[Tick], None]] = None
+                ) -> Subscription:
+    subscription = Subscription(self, symbol_names, callback)
+    self._subscriptions.append(subscription)
+    self._send_last_ticks(subscription, subscription.symbol_names)
+    return subscription
+
+  def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+    """Starts publishing on `loop`, which does not have to be running yet."""
+    loop = loop or asyncio.get_event_loop()
+    self._task = loop.create_task(self._run())
+
+  def stop(self):
+    if self._task:
+      self._task.cancel()
+      self._task = None
+
+  def subscribed_symbols(self) -> set:
+    return set().union(*(subscription.symbol_names
+                         for subscription in self._subscriptions))
+
+  def _publish(self, tick: Tick):
+    last_tick = self._last_ticks.get(tick.symbol)
+    if last_tick and last_tick.price == tick.price:
+      return
+    self._last_ticks[tick.symbol] = tick
+    for subscription in list(self._subscriptions):
+      if tick.symbol in subscription.symbol_names:
+        subscription._put(tick)
+
+  def _send_last_ticks(self, subscription: Subscription, symbol_names):
+    """Catches up `subscription`, which did not get these symbols before."""
+    for symbol_name in sorted(symbol_names):
+      if symbol_name in self._last_ticks:
+        subscription._put(self._last_ticks[symbol_name])
+
+  async def _run(self):
+    raise NotImplementedError
+
+
+class PollingFeed(PriceFeed):
+  """Polls the subscribed symbols from the `symbol_values` provider."""
+
+  def __init__(self, interval_s=30.):
+    super().__init__()
+    self.interval_s = interval_s
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      symbol_names = sorted(self.subscribed_symbols())
+      quotes = await asyncio.gather(
+        *(loop.run_in_executor(None, symbol_values.fetch_quote, symbol_name)
+          for symbol_name in symbol_names),
+        return_exceptions=True)
+      for symbol_name, quote in zip(symbol_names, quotes):
+        if isinstance(quote, Exception):
+          logger.info(f'*** Polling {symbol_name} failed: {quote}')
+          continue
+        self._publish(Tick(quote.symbol, quote.price, quote.fetched_at))
+      await asyncio.sleep(self.interval_s)
+
+
+class SimulatedFeed(PriceFeed):
+  """Random walks starting at `prices`, for testing without network.
+
+  :param prices: Maps symbols to their initial price. Other symbols start
+      at their last fetched value (see `symbol_values.Ticker`), or at 100.
+  :param volatility: Standard deviation of the relative change per tick.
+  """
+
+  def __init__(self, prices=None, interval_s=1., volatility=0.001,
+               seed=None, clock=time.time):
+    super().__init__()
+    self.prices = dict(prices or {})
+    self.interval_s = interval_s
+    self.volatility = volatility
+    self.clock = clock
+    self._rand = random.Random(seed)
+
+  def step(self):
+    """Publishes one tick for every subscribed symbol."""
+    for symbol_name in sorted(self.subscribed_symbols()):
+      price = self.prices.get(symbol_name)
+      if price is None:
+        price = symbol_values.Ticker.make(
+          symbol_name).get_cached_value().value or 100.
+      price *= 1 + self._rand.gauss(0, self.volatility)
+      self.prices[symbol_name] = price
+      self._publish(Tick(symbol_name, price, self.clock()))
+
+  async def _run(self):
+    while True:
+      self.step()
+      await asyncio.sleep(self.interval_s)
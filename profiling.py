@@ -0,0 +1,137 @@
+"""Lightweight timers and counters, to see where time goes.
+
+Everything is disabled by default, in which case `timer` returns a shared
+no-op context manager and `timed` functions only check a global. Enable with
+`enable()` (main.py does so for --profile).
+
+  with profiling.timer('quote.fetch'):
+    ...
+
+  @profiling.timed('ui.render')
+  def render(): ...
+"""
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}  # name -> Histogram
+_counters = collections.Counter()
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram(object):
+  """Durations in power-of-two buckets of microseconds."""
+
+  def __init__(self):
+    self.buckets = collections.Counter()  # bit length of us -> count
+    self.count = 0
+    self.total_s = 0.
+    self.max_s = 0.
+
+  def add(self, seconds):
+    self.buckets[int(seconds * 1e6).bit_length()] += 1
+    self.count += 1
+    self.total_s += seconds
+    self.max_s = max(self.max_s, seconds)
+
+  def percentile(self, p) -> float:
+    """Upper bound of the bucket containing the `p`-th percentile, in s."""
+    if not self.count:
+      return 0.
+    needed = p / 100 * self.count
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= needed:
+        return min(2 ** bucket / 1e6, self.max_s)
+    return self.max_s
+
+  def mean(self) -> float:
+    return self.total_s / self.count if self.count else 0.
+
+
+def enable(enabled=True):
+  global _enabled
+  _enabled = enabled
+
+
+def is_enabled():
+  return _enabled
+
+
+def reset():
+  with _lock:
+    _histograms.clear()
+    _counters.clear()
+
+
+def record(name, seconds):
+  with _lock:
+    if name not in _histograms:
+      _histograms[name] = Histogram()
+    _histograms[name].add(seconds)
+
+
+def count(name, n=1):
+  if _enabled:
+    with _lock:
+      _counters[name] += n
+
+
+class _Timer(object):
+  __slots__ = ('name', 'start')
+
+  def __init__(self, name):
+    self.name = name
+    self.start = None
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *_):
+    record(self.name, time.perf_counter() - self.start)
+
+
+def timer(name):
+  """Context manager recording its duration under `name`, if enabled."""
+  return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def timed(name):
+  """Decorator recording the duration of each call under `name`."""
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return fn(*args, **kwargs)
+      start = time.perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        record(name, time.perf_counter() - start)
+    return wrapper
+  return decorator
+
+
+def report():
+  """Returns the timers and counters as lines of text."""
+  with _lock:
+    histograms = dict(_histograms)
+    counters = dict(_counters)
+  lines = [f'{"Timer":36s} {"count":>7s} {"mean":>9s} {"p50":>9s} '
+           f'{"p90":>9s} {"p99":>9s} {"max":>9s} {"total":>9s}']
+  for name, h in sorted(histograms.items(), key=lambda item: -item[1].total_s):
+    times = [h.mean(), h.percentile(50), h.percentile(90), h.percentile(99),
+             h.max_s, h.total_s]
+    lines.append(f'{name:36s} {h.count:7d} ' +
+                 ' '.join(f'{t * 1000:7.2f}ms' for t in times))
+  if counters:
+    lines += ['', f'{"Counter":36s} {"count":>7s}']
+    lines += [f'{name:36s} {n:7d}' for name, n in sorted(counters.items())]
+  return lines
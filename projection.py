@@ -0,0 +1,246 @@
+"""Monte Carlo projection of the portfolio value, from historical returns.
+
+The log returns of the symbols are modelled as multivariate normal, with the
+mean and covariance of their `History`. Correlated returns are drawn for all
+paths, steps and symbols at once, via the Cholesky factor of the covariance,
+so there is no Python loop over paths or symbols. Paths are simulated in
+chunks of bounded memory, optionally spread over a process pool:
+
+  history = projection.load_history('returns.json', symbols)
+  portfolio = projection.current_portfolio(dc, 'CHF')
+  bands = projection.project(portfolio, history, num_steps=120)
+
+Cash stays as it is, and values in other currencies are converted at the
+current rate, i.e., exchange rates are not simulated.
+"""
+
+import concurrent.futures
+import dataclasses
+import json
+import multiprocessing
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+
+import profiling
+import symbol_values
+
+import logging
+
+logger = logging.getLogger()
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Of the random draws of one chunk of paths, see `project`.
+_CHUNK_BYTES = 32 * 2 ** 20
+
+# Two returns are needed for a covariance.
+_MIN_PRICES = 3
+
+# The cache of `load_history` is refreshed after this.
+_MAX_HISTORY_AGE_S = 7 * 24 * 60 * 60
+
+
+class History(object):
+  """Closing prices of symbols, one period apart, e.g. monthly.
+
+  The file format (see `load` and `save`) is
+      {"fetched_at": 1600000000, "prices": {"AAPL": [1.2, 1.3, ...], ...},
+       "missing": ["XYZ", ...]}
+  where all lists end at the same date. Shorter lists, e.g. of younger
+  symbols, are fine, only the common dates are used. `missing` are the
+  symbols that were fetched without getting a history.
+  """
+
+  def __init__(self, prices: Dict[str, List[float]], fetched_at=None,
+               missing=()):
+    self.prices = {symbol: np.asarray(symbol_prices, dtype=np.float64)
+                   for symbol, symbol_prices in prices.items()}
+    self.fetched_at = fetched_at
+    self.missing = sorted(missing)
+
+  @property
+  def symbols(self):
+    return list(self.prices)
+
+  def log_returns(self, symbols) -> np.ndarray:
+    """Returns of `symbols` at the common dates, shape (dates, symbols)."""
+    num_dates = min(len(self.prices[symbol]) for symbol in symbols)
+    prices = np.stack([self.prices[symbol][-num_dates:]
+                       for symbol in symbols], axis=1)
+    return np.diff(np.log(prices), axis=0)
+
+  @staticmethod
+  def load(path) -> 'History':
+    with open(path, 'r') as f:
+      data = json.load(f)
+    return History(data['prices'], data.get('fetched_at'),
+                   data.get('missing', ()))
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump({'fetched_at': self.fetched_at,
+                 'prices': {symbol: symbol_prices.tolist()
+                            for symbol, symbol_prices in self.prices.items()},
+                 'missing': self.missing},
+                f)
+
+
+def load_history(path, symbols, max_age_s=_MAX_HISTORY_AGE_S) -> History:
+  """Prices of `symbols` from the file at `path`, fetched if needed.
+
+  The file is a cache: if it is missing, older than `max_age_s` or misses
+  some of `symbols`, they are fetched and the file is overwritten. Symbols
+  without history are remembered, and not fetched again until it is too
+  old. With `max_age_s=None`, it is only read, e.g. a fixture.
+  """
+  history = History.load(path) if os.path.isfile(path) else None
+  if max_age_s is None:
+    if history is None:
+      raise FileNotFoundError(path)
+    return history
+  if (history and time.time() - (history.fetched_at or 0) <= max_age_s and
+      set(symbols) <= set(history.symbols) | set(history.missing)):
+    return history
+  prices = _fetch_prices(symbols)
+  history = History(prices, fetched_at=time.time(),
+                    missing=set(symbols) - set(prices))
+  history.save(path)
+  return history
+
+
+def _fetch_prices(symbols, period='10y', interval='1mo'):
+  """Monthly closing prices of `symbols`, leaving out the unknown ones."""
+  import yfinance as yf  # Only needed when we actually go online.
+  closes = yf.download(list(symbols), period=period, interval=interval,
+                       auto_adjust=True, progress=False)['Close']
+  prices = {}
+  for symbol in symbols:
+    if symbol not in closes:
+      logger.info(f'*** No history for {symbol}')
+      continue
+    symbol_prices = closes[symbol].dropna()
+    if len(symbol_prices) > 1:
+      prices[symbol] = symbol_prices.tolist()
+  return prices
+
+
+@dataclasses.dataclass
+class Portfolio:
+  """Current values, in major units of `currency`."""
+  currency: str
+  cash: float
+  values: Dict[str, float]  # Of the open positions, per symbol.
+  # Accounts and symbols without a price or exchange rate yet.
+  missing: List[str] = dataclasses.field(default_factory=list)
+
+  @property
+  def total(self):
+    return self.cash + sum(self.values.values())
+
+
+def current_portfolio(dc, currency) -> Portfolio:
+  """The account balances and open positions of `dc`, in `currency`."""
+  portfolio = Portfolio(currency, 0., {})
+  for acc in dc.get_all_accounts():
+    balance = symbol_values.convert_currency(
+      acc.get_balance(), acc.currency, currency)
+    if balance.filled():
+      portfolio.cash += balance.value
+    else:
+      portfolio.missing.append(acc.name)
+  for so in dc.get_all_symbol_overviews():
+    if so.quantity == 0:
+      continue
+    value = so.get_current_total_value(currency)
+    if value.filled():
+      portfolio.values[so.symbol] = value.value
+    else:
+      portfolio.missing.append(so.symbol)
+  return portfolio
+
+
+@dataclasses.dataclass
+class Model:
+  """Multivariate normal log returns per step."""
+  mean: np.ndarray  # Shape (symbols,).
+  cholesky: np.ndarray  # Lower triangular factor of the covariance.
+
+  @staticmethod
+  def fit(log_returns: np.ndarray) -> 'Model':
+    """Fits the returns of shape (dates, symbols)."""
+    covariance = np.atleast_2d(np.cov(log_returns, rowvar=False))
+    return Model(log_returns.mean(axis=0), _cholesky(covariance))
+
+
+def _cholesky(covariance):
+  try:
+    return np.linalg.cholesky(covariance)
+  except np.linalg.LinAlgError:
+    # Not positive definite, e.g. with fewer dates than symbols. Use the
+    # nearest matrix that is.
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    eigenvalues = np.clip(eigenvalues, 1e-12, None)
+    return np.linalg.cholesky(
+      (eigenvectors * eigenvalues) @ eigenvectors.T)
+
+
+def _simulate_chunk(args):
+  """Totals of `num_paths` paths, shape (num_paths, num_steps + 1)."""
+  model, values, cash, num_steps, num_paths, seed = args
+  rng = np.random.default_rng(seed)
+  # float32 is precise enough, and faster to draw.
+  log_returns = rng.standard_normal((num_paths, num_steps, len(values)),
+                                    dtype=np.float32)
+  log_returns = log_returns @ model.cholesky.T.astype(np.float32)
+  log_returns += model.mean.astype(np.float32)
+  # Growth of each symbol since today.
+  np.cumsum(log_returns, axis=1, out=log_returns)
+  np.exp(log_returns, out=log_returns)
+  totals = np.empty((num_paths, num_steps + 1), dtype=np.float32)
+  totals[:, 0] = cash + values.sum()
+  totals[:, 1:] = log_returns @ values.astype(np.float32) + cash
+  return totals
+
+
+@profiling.timed('projection.project')
+def project(portfolio: Portfolio, history: History, num_steps,
+            num_paths=10000, percentiles=PERCENTILES, seed=None,
+            num_workers=0, chunk_size=None) -> np.ndarray:
+  """Percentiles of the simulated total of `portfolio` after each step.
+
+  A step is the period of `history`, e.g. a month. Symbols without history,
+  i.e. with less than `_MIN_PRICES`, keep their value, like cash.
+
+  :param seed: For reproducible results, also with `num_workers`.
+  :param num_workers: If > 1, chunks are simulated in that many processes.
+  :param chunk_size: Paths per chunk, by default as many as fit in
+      `_CHUNK_BYTES`.
+  :returns: Array of shape (len(percentiles), num_steps + 1), the first
+      column is the current total.
+  """
+  symbols = [symbol for symbol in portfolio.values
+             if len(history.prices.get(symbol, ())) >= _MIN_PRICES]
+  cash = portfolio.total - sum(portfolio.values[symbol] for symbol in symbols)
+  if not symbols:
+    return np.full((len(percentiles), num_steps + 1), cash)
+  values = np.array([portfolio.values[symbol] for symbol in symbols])
+  model = Model.fit(history.log_returns(symbols))
+  # The draws and their product with the Cholesky factor, in float32.
+  chunk_size = chunk_size or max(
+    1, _CHUNK_BYTES // (2 * 4 * num_steps * len(symbols)))
+  sizes = [min(chunk_size, num_paths - start)
+           for start in range(0, num_paths, chunk_size)]
+  seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+  chunks = [(model, values, cash, num_steps, size, chunk_seed)
+            for size, chunk_seed in zip(sizes, seeds)]
+  if num_workers > 1:
+    # Not forked, the UI has threads running.
+    with concurrent.futures.ProcessPoolExecutor(
+        num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+      totals = list(pool.map(_simulate_chunk, chunks))
+  else:
+    totals = [_simulate_chunk(chunk) for chunk in chunks]
+  return np.percentile(np.concatenate(totals), percentiles, axis=0)
@@ -0,0 +1,284 @@
+"""A local daemon sharing one quote cache between all ppfin processes.
+
+The daemon owns the `symbol_values.Ticker`s, so every symbol is fetched at
+most once per TTL, however many TUIs and imports ask for it. Start it with
+
+  python quote_daemon.py
+
+Clients talk JSON lines over a Unix domain socket (see
+`default_socket_path`):
+
+  -> {"op": "get", "symbols": ["AAPL", "USDCHF=X"], "force": false}
+  <- {"quotes": {"AAPL": {"symbol": "AAPL", "price": 1.0, "short_name":
+      "Apple", "fetched_at": 1600000000.0}}, "errors": {"USDCHF=X": "..."}}
+
+  -> {"op": "subscribe", "symbols": ["AAPL"]}
+  <- {"tick": {"symbol": "AAPL", "price": 1.0, "fetched_at": 1600000000.0}}
+     ... whenever the quote was refetched. Replaces earlier subscriptions.
+
+`DaemonQuoteProvider` and `DaemonFeed` are the clients, both fall back to
+fetching in-process if the daemon is not running.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import tempfile
+from typing import Iterable
+
+import price_feed
+import symbol_values
+
+import logging
+
+logger = logging.getLogger()
+
+
+def default_socket_path():
+  return os.environ.get(
+    'PPFIN_QUOTE_SOCKET',
+    os.path.join(tempfile.gettempdir(), f'ppfin-quotes-{os.getuid()}.sock'))
+
+
+def _encode(message: dict) -> bytes:
+  return json.dumps(message).encode() + b'\n'
+
+
+class QuoteDaemon(object):
+  def __init__(self, path=None, interval_s=5.):
+    """
+    :param path: Of the socket, defaults to `default_socket_path()`.
+    :param interval_s: How often subscribed symbols are checked for updates.
+        They are only refetched when stale, see `symbol_values.Ticker`.
+    """
+    self.path = path or default_socket_path()
+    self.interval_s = interval_s
+    self._server = None
+
+  async def start(self):
+    if os.path.exists(self.path):
+      if _is_listening(self.path):
+        raise OSError(f'A daemon is already running at {self.path}')
+      os.remove(self.path)  # Left over from a crashed daemon.
+    self._server = await asyncio.start_unix_server(self._handle, self.path)
+    os.chmod(self.path, 0o600)
+    logger.info(f'Quote daemon listening at {self.path}')
+
+  async def serve_forever(self):
+    if not self._server:
+      await self.start()
+    async with self._server:
+      await self._server.serve_forever()
+
+  def close(self):
+    if self._server:
+      self._server.close()
+      self._server = None
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+  async def get(self, symbol_names: Iterable[str], force=False) -> dict:
+    """Quotes of `symbol_names`, fetching the stale ones concurrently."""
+    tickers = [symbol_values.Ticker.make(symbol_name)
+               for symbol_name in symbol_names]
+    futures = []
+    for ticker in tickers:
+      future = ticker.lazy_update(force)
+      if not future and ticker.waiting:
+        future = ticker.pending
+      if future:
+        futures.append(asyncio.wrap_future(future))
+    await asyncio.gather(*futures, return_exceptions=True)
+    quotes, errors = {}, {}
+    for ticker in tickers:
+      quote = ticker.quote
+      if quote:
+        quotes[ticker.symbol_name] = {
+          'symbol': quote.symbol, 'price': quote.price,
+          'short_name': quote.short_name, 'fetched_at': quote.fetched_at}
+      else:
+        pending = ticker.pending
+        error = pending and pending.done() and pending.exception()
+        errors[ticker.symbol_name] = str(error or 'No quote')
+    return {'quotes': quotes, 'errors': errors}
+
+  async def _handle(self, reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter):
+    subscription = None
+    try:
+      async for line in reader:
+        try:
+          request = json.loads(line)
+          op = request['op']
+          symbol_names = list(request['symbols'])
+        except (ValueError, KeyError, TypeError) as e:
+          writer.write(_encode({'error': f'Invalid request: {e}'}))
+          continue
+        if op == 'get':
+          writer.write(_encode(
+            await self.get(symbol_names, request.get('force', False))))
+        elif op == 'subscribe':
+          if subscription:
+            subscription.cancel()
+          subscription = asyncio.create_task(
+            self._stream(symbol_names, writer))
+        else:
+          writer.write(_encode({'error': f'Unknown op: {op}'}))
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      if subscription:
+        subscription.cancel()
+      writer.close()
+
+  async def _stream(self, symbol_names, writer: asyncio.StreamWriter):
+    sent = {}  # Symbol -> fetched_at of the last tick sent.
+    while True:
+      result = await self.get(symbol_names)
+      for symbol_name, quote in result['quotes'].items():
+        if sent.get(symbol_name) == quote['fetched_at']:
+          continue
+        sent[symbol_name] = quote['fetched_at']
+        writer.write(_encode({'tick': {
+          'symbol': symbol_name, 'price': quote['price'],
+          'fetched_at': quote['fetched_at']}}))
+      await writer.drain()
+      await asyncio.sleep(self.interval_s)
+
+
+def _is_listening(path) -> bool:
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    try:
+      s.connect(path)
+      return True
+    except OSError:
+      return False
+
+
+class DaemonQuoteProvider(symbol_values.QuoteProvider):
+  """Gets quotes from the daemon, or from `fallback` if it is not running."""
+
+  def __init__(self, path=None, fallback: symbol_values.QuoteProvider = None,
+               timeout_s=60.):
+    self.path = path or default_socket_path()
+    self.fallback = fallback or symbol_values.YFinanceProvider()
+    self.timeout_s = timeout_s
+
+  def fetch(self, symbol_name) -> dict:
+    result = self._get([symbol_name])
+    if result is None:
+      return self.fallback.fetch(symbol_name)
+    if symbol_name not in result:
+      raise symbol_values.QuoteError(f'No quote for {symbol_name}')
+    return result[symbol_name]
+
+  def fetch_many(self, symbol_names: Iterable[str], force=False) -> dict:
+    """Returns a dict mapping symbols to `info`s, leaving out failed ones."""
+    symbol_names = list(symbol_names)
+    result = self._get(symbol_names, force)
+    if result is not None:
+      return result
+    infos = {}
+    for symbol_name in symbol_names:
+      try:
+        infos[symbol_name] = self.fallback.fetch(symbol_name)
+      except Exception as e:
+        logger.info(f'*** Failed to get {symbol_name}: {e}')
+    return infos
+
+  def _get(self, symbol_names, force=False):
+    """Infos from the daemon, or None if it is not available."""
+    try:
+      result = self._request({'op': 'get', 'symbols': symbol_names,
+                              'force': force})
+    except OSError as e:
+      logger.info(f'Quote daemon not available ({e}), fetching in-process.')
+      return None
+    for symbol_name, error in result['errors'].items():
+      logger.info(f'*** Daemon failed to get {symbol_name}: {error}')
+    return {symbol_name: {'regularMarketPrice': quote['price'],
+                          'shortName': quote['short_name']}
+            for symbol_name, quote in result['quotes'].items()}
+
+  def _request(self, request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.settimeout(self.timeout_s)
+      s.connect(self.path)
+      s.sendall(_encode(request))
+      with s.makefile('rb') as f:
+        line = f.readline()
+    if not line:
+      raise ConnectionError('Quote daemon closed the connection.')
+    return json.loads(line)
+
+
+class DaemonFeed(price_feed.PollingFeed):
+  """Ticks from the daemon, or polled in-process if it is not running."""
+
+  def __init__(self, path=None, interval_s=30.):
+    super().__init__(interval_s)
+    self.path = path or default_socket_path()
+
+  async def _run(self):
+    try:
+      reader, writer = await asyncio.open_unix_connection(self.path)
+    except OSError as e:
+      logger.info(f'Quote daemon not available ({e}), polling in-process.')
+      return await super()._run()
+    try:
+      await self._stream(reader, writer)
+    except ConnectionError as e:
+      logger.info(f'Lost the quote daemon ({e}), polling in-process.')
+    finally:
+      writer.close()
+    return await super()._run()
+
+  async def _stream(self, reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter):
+    symbol_names = None
+    while True:
+      if self.subscribed_symbols() != symbol_names:
+        symbol_names = self.subscribed_symbols()
+        writer.write(_encode({'op': 'subscribe',
+                              'symbols': sorted(symbol_names)}))
+        await writer.drain()
+      try:
+        # Short timeout, to notice changed subscriptions.
+        line = await asyncio.wait_for(reader.readline(), timeout=1.)
+      except asyncio.TimeoutError:
+        continue
+      if not line:
+        raise ConnectionError('Closed by the daemon.')
+      tick = json.loads(line).get('tick')
+      if tick:
+        self._publish(price_feed.Tick(tick['symbol'], tick['price'],
+                                      tick['fetched_at']))
+
+
+def main():
+  p = argparse.ArgumentParser()
+  p.add_argument('--socket', help='Defaults to ' + default_socket_path())
+  p.add_argument('--interval_s', type=float, default=5.,
+                 help='How often subscriptions are checked for new quotes.')
+  p.add_argument('--replay',
+                 help='Serve quotes recorded in this file instead of '
+                      'fetching, see symbol_values.RecordedQuoteProvider.')
+  flags = p.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  if flags.replay:
+    symbol_values.set_provider(
+      symbol_values.RecordedQuoteProvider(flags.replay))
+  daemon = QuoteDaemon(flags.socket, flags.interval_s)
+  try:
+    asyncio.run(daemon.serve_forever())
+  except KeyboardInterrupt:
+    pass
+  finally:
+    daemon.close()
+
+
+if __name__ == '__main__':
+  main()
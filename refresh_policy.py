@@ -0,0 +1,137 @@
+"""Decides which quotes are worth refreshing, and how often.
+
+Without a policy, every `symbol_values.Ticker` is refetched whenever it is
+older than 5 minutes and its value is asked for. With a `RefreshPolicy` (see
+`symbol_values.set_refresh_policy`), the time-to-live of a quote depends on:
+  - whether the market of the symbol is open (see `market_of`),
+  - whether the symbol is on screen, or was recently (see `set_visible`).
+Positions that are not visible are still fetched once, so totals are
+complete, but only refreshed every `background_ttl_s`.
+
+`order` sorts symbols such that visible and large positions are fetched
+first (see `set_weight`).
+"""
+
+import dataclasses
+import datetime
+import threading
+import time
+import zoneinfo
+from typing import Iterable, Optional
+
+
+@dataclasses.dataclass(frozen=True)
+class Market:
+  name: str
+  timezone: str
+  opens: datetime.time
+  closes: datetime.time
+
+  def is_open(self, timestamp: float) -> bool:
+    now = datetime.datetime.fromtimestamp(timestamp,
+                                          zoneinfo.ZoneInfo(self.timezone))
+    if now.weekday() >= 5:
+      return False
+    return self.opens <= now.time() < self.closes
+
+
+US = Market('US', 'America/New_York', datetime.time(9, 30),
+            datetime.time(16))
+# FX trades around the clock during the week, roughly Monday to Friday in New
+# York.
+FX = Market('FX', 'America/New_York', datetime.time(0), datetime.time.max)
+
+# Yahoo Finance suffix -> market, see `data_controller._EXCH_TO_YF`.
+MARKETS = {
+  'SW': Market('SIX', 'Europe/Zurich', datetime.time(9), datetime.time(17, 30)),
+  'AS': Market('Euronext Amsterdam', 'Europe/Amsterdam', datetime.time(9),
+               datetime.time(17, 30)),
+  'L': Market('LSE', 'Europe/London', datetime.time(8), datetime.time(16, 30)),
+}
+
+
+def market_of(symbol_name) -> Market:
+  """Market of a Yahoo Finance symbol, symbols without suffix are US."""
+  if symbol_name.endswith('=X'):
+    return FX
+  _, dot, suffix = symbol_name.rpartition('.')
+  if dot:
+    return MARKETS.get(suffix, US)
+  return US
+
+
+class RefreshPolicy(object):
+  def __init__(self,
+               open_ttl_s=5 * 60,
+               closed_ttl_s=6 * 60 * 60,
+               background_ttl_s=60 * 60,
+               recent_s=10 * 60,
+               clock=time.time):
+    """
+    :param open_ttl_s: TTL of visible quotes while their market is open.
+    :param closed_ttl_s: TTL of quotes while their market is closed.
+    :param background_ttl_s: Minimum TTL of positions not on screen.
+    :param recent_s: Positions count as visible for this long after they
+        left the screen.
+    :param clock: Returns the current time, in seconds since the epoch.
+    """
+    self.open_ttl_s = open_ttl_s
+    self.closed_ttl_s = closed_ttl_s
+    self.background_ttl_s = background_ttl_s
+    self.recent_s = recent_s
+    self.clock = clock
+    self._lock = threading.Lock()
+    self._positions = set()  # Symbols that are rows of a view.
+    self._visible = set()
+    self._last_seen = {}  # Symbol -> time it left the screen.
+    self._weights = {}  # Symbol -> rough size of the position.
+
+  def set_weight(self, symbol_name, weight: float):
+    """Registers `symbol_name` as a position, of size `weight`.
+
+    Symbols that are never registered (e.g. FX rates) are not subject to
+    visibility, only to market hours.
+    """
+    with self._lock:
+      self._positions.add(symbol_name)
+      self._weights[symbol_name] = abs(weight or 0)
+
+  def set_visible(self, symbol_names: Iterable[str]) -> set:
+    """Sets the symbols currently on screen, returns the newly visible."""
+    symbol_names = set(symbol_names)
+    now = self.clock()
+    with self._lock:
+      for symbol_name in self._visible - symbol_names:
+        self._last_seen[symbol_name] = now
+      newly_visible = symbol_names - self._visible
+      self._visible = symbol_names
+    return newly_visible
+
+  def is_visible(self, symbol_name) -> bool:
+    """True if on screen or recently so, or not a position at all."""
+    with self._lock:
+      if symbol_name not in self._positions or symbol_name in self._visible:
+        return True
+      last_seen = self._last_seen.get(symbol_name)
+    return last_seen is not None and self.clock() - last_seen < self.recent_s
+
+  def ttl(self, symbol_name) -> float:
+    if market_of(symbol_name).is_open(self.clock()):
+      ttl = self.open_ttl_s
+    else:
+      ttl = self.closed_ttl_s
+    if not self.is_visible(symbol_name):
+      ttl = max(ttl, self.background_ttl_s)
+    return ttl
+
+  def should_refresh(self, symbol_name, queried: Optional[float]) -> bool:
+    """Whether a quote fetched at time `queried` (or never) is stale."""
+    if queried is None:
+      return True
+    return self.clock() - queried > self.ttl(symbol_name)
+
+  def order(self, symbol_names: Iterable[str]) -> list:
+    """Sorts `symbol_names`: visible first, then by decreasing weight."""
+    return sorted(symbol_names,
+                  key=lambda s: (not self.is_visible(s),
+                                 -self._weights.get(s, 0)))
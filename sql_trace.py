@@ -0,0 +1,170 @@
+"""Opt-in SQL query statistics for the `DataController`.
+
+A `QueryStats` is attached to a `DataController` (see its `trace` argument),
+which then hands out `TracingCursor`s. Queries are counted and timed per
+normalised SQL text and per call site, and counted per refresh (see
+`QueryStats.refresh`). Queries slower than a threshold are recorded together
+with their EXPLAIN QUERY PLAN.
+"""
+
+import collections
+import contextlib
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import logging
+
+logger = logging.getLogger()
+
+_THIS_FILE = os.path.abspath(__file__)
+_SKIP_FILES = {_THIS_FILE, os.path.abspath(contextlib.__file__)}
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_sql(sql: str) -> str:
+  """Replaces literals with ?, so that equivalent queries group together."""
+  sql = _STRING_RE.sub('?', sql)
+  sql = _NUMBER_RE.sub('?', sql)
+  sql = _IN_LIST_RE.sub('IN (...)', sql)
+  return _WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def _call_site() -> str:
+  frame = sys._getframe(1)
+  while frame and os.path.abspath(frame.f_code.co_filename) in _SKIP_FILES:
+    frame = frame.f_back
+  if not frame:
+    return '?'
+  return (f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} '
+          f'({frame.f_code.co_name})')
+
+
+class _SqlStats(object):
+  __slots__ = ('count', 'total_s', 'max_s')
+
+  def __init__(self):
+    self.count = 0
+    self.total_s = 0.
+    self.max_s = 0.
+
+
+class QueryStats(object):
+  def __init__(self, slow_threshold_s=0.01):
+    self.slow_threshold_s = slow_threshold_s
+    self._lock = threading.Lock()
+    self.by_sql = collections.defaultdict(_SqlStats)
+    self.by_site = collections.Counter()
+    self.num_statements = 0  # From the trace callback, includes triggers.
+    self.slow = {}  # Normalised SQL -> (seconds, query plan)
+    self.refreshes = []  # List of (name, num queries, num statements)
+    self._current_refresh = None
+
+  def trace_callback(self, statement):
+    with self._lock:
+      self.num_statements += 1
+
+  def record(self, sql, params, seconds, conn: sqlite3.Connection):
+    normalized = normalize_sql(sql)
+    with self._lock:
+      stats = self.by_sql[normalized]
+      stats.count += 1
+      stats.total_s += seconds
+      stats.max_s = max(stats.max_s, seconds)
+      self.by_site[_call_site()] += 1
+      is_new_slow = (seconds >= self.slow_threshold_s and
+                     normalized not in self.slow)
+      if is_new_slow:
+        self.slow[normalized] = (seconds, None)
+    if is_new_slow:
+      self.slow[normalized] = (seconds, self._explain(sql, params, conn))
+      logger.info(f'Slow query ({seconds * 1000:.1f}ms): {normalized}')
+
+  @staticmethod
+  def _explain(sql, params, conn):
+    try:
+      return [row[-1] for row in
+              conn.execute('EXPLAIN QUERY PLAN ' + sql, params or ())]
+    except sqlite3.Error as e:
+      return [f'Cannot explain: {e}']
+
+  def num_queries(self):
+    with self._lock:
+      return sum(stats.count for stats in self.by_sql.values())
+
+  @contextlib.contextmanager
+  def refresh(self, name):
+    """Counts the queries issued within the block as one refresh."""
+    queries, statements = self.num_queries(), self.num_statements
+    try:
+      yield
+    finally:
+      self.refreshes.append((name, self.num_queries() - queries,
+                             self.num_statements - statements))
+
+  def report(self, top=20):
+    """Returns the statistics as lines of text."""
+    lines = [f'{self.num_queries()} queries, '
+             f'{self.num_statements} statements.', '',
+             f'{"count":>7s} {"total":>9s} {"max":>9s}  SQL']
+    by_total = sorted(self.by_sql.items(), key=lambda item: -item[1].total_s)
+    for sql, stats in by_total[:top]:
+      lines.append(f'{stats.count:7d} {stats.total_s * 1000:7.2f}ms '
+                   f'{stats.max_s * 1000:7.2f}ms  {sql}')
+    lines += ['', f'{"count":>7s}  Call site']
+    lines += [f'{n:7d}  {site}' for site, n in self.by_site.most_common(top)]
+    if self.refreshes:
+      lines += ['', f'{"queries":>7s} {"stmts":>7s}  Refresh']
+      lines += [f'{queries:7d} {statements:7d}  {name}'
+                for name, queries, statements in self.refreshes[-top:]]
+    if self.slow:
+      lines += ['', f'Slow queries (>= {self.slow_threshold_s * 1000:.0f}ms):']
+      for sql, (seconds, plan) in self.slow.items():
+        lines.append(f'{seconds * 1000:7.2f}ms  {sql}')
+        lines += [f'           {step}' for step in plan or []]
+    return lines
+
+  def dump(self, path=None):
+    """Writes `report` to `path`, or to stderr."""
+    text = '\n'.join(self.report()) + '\n'
+    if path:
+      with open(path, 'w') as f:
+        f.write(text)
+    else:
+      sys.stderr.write(text)
+
+
+class TracingCursor(object):
+  """Wraps a `sqlite3.Cursor`, recording executed queries in `stats`."""
+
+  def __init__(self, cursor: sqlite3.Cursor, stats: QueryStats):
+    self._cursor = cursor
+    self._stats = stats
+
+  def execute(self, sql, params=()):
+    start = time.perf_counter()
+    self._cursor.execute(sql, params)
+    self._stats.record(sql, params, time.perf_counter() - start,
+                       self._cursor.connection)
+    return self
+
+  def executemany(self, sql, seq_of_params):
+    seq_of_params = list(seq_of_params)
+    start = time.perf_counter()
+    self._cursor.executemany(sql, seq_of_params)
+    self._stats.record(sql, seq_of_params[0] if seq_of_params else (),
+                       time.perf_counter() - start, self._cursor.connection)
+    return self
+
+  def __iter__(self):
+    return iter(self._cursor)
+
+  def __getattr__(self, item):
+    return getattr(self._cursor, item)
@@ -1,27 +1,238 @@
+import bisect
+import collections
 import concurrent.futures
+import json
+import random
+import threading
 import urllib.error
+import weakref
 from typing import Optional
 
-import yfinance as yf
 import time
 
 import helpers
+import profiling
 
 import logging
 
 logger = logging.getLogger()
 
-_tickers = {}
+# All tickers in use, so that there is only one per symbol, see `Ticker.make`.
+_tickers = weakref.WeakValueDictionary()
+# The most recently used ones are kept even if unused, with their quotes.
+_recent_tickers = collections.OrderedDict()
+_tickers_lock = threading.Lock()
+_MAX_TICKERS = 256
 _callbacks = {}
 _executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
 
+class QuoteError(Exception):
+  pass
+
+
+class Quote(object):
+  """The part of a provider's `info` dict that we actually use."""
+
+  __slots__ = ('symbol', 'price', 'short_name', 'fetched_at')
+
+  def __init__(self, symbol, price: float, short_name: Optional[str],
+               fetched_at: float):
+    self.symbol = symbol
+    self.price = price
+    self.short_name = short_name
+    self.fetched_at = fetched_at
+
+  def __repr__(self):
+    return f'Quote({self.symbol}, {self.price}, {self.short_name!r})'
+
+  @staticmethod
+  def from_info(symbol, info: dict, fetched_at: float) -> 'Quote':
+    """Uses the live price if there is one, otherwise the day's open."""
+    price = info.get('regularMarketPrice')
+    if price is None:
+      price = info.get('regularMarketOpen')
+    if price is None:
+      logger.info(f'No regularMarketPrice or regularMarketOpen: {info}')
+      raise ValueError(symbol)
+    return Quote(symbol, float(price), info.get('shortName'), fetched_at)
+
+
+class QuoteProvider(object):
+  """Source of quotes. `fetch` returns an `info` dict like yfinance."""
+
+  def fetch(self, symbol_name) -> dict:
+    raise NotImplementedError
+
+
+class YFinanceProvider(QuoteProvider):
+  def fetch(self, symbol_name) -> dict:
+    import yfinance as yf  # Only needed when we actually go online.
+    return yf.Ticker(symbol_name).info
+
+
+class RecordedQuoteProvider(QuoteProvider):
+  """Replays quotes from a file, without network.
+
+  The file has one JSON object per line:
+      {"symbol": "AAPL", "time": 1600000000, "info": {"regularMarketOpen": 1}}
+  `fetch` returns the latest `info` recorded at or before `clock()`, or the
+  earliest one if there is none before.
+  """
+
+  def __init__(self, path, clock=time.time):
+    self.clock = clock
+    quotes = collections.defaultdict(list)
+    with open(path, 'r') as f:
+      for line in f:
+        if not line.strip():
+          continue
+        record = json.loads(line)
+        quotes[record['symbol']].append((record['time'], record['info']))
+    # symbol -> ([times], [infos]), sorted by time.
+    self._quotes = {}
+    for symbol_name, symbol_quotes in quotes.items():
+      symbol_quotes.sort(key=lambda quote: quote[0])
+      self._quotes[symbol_name] = tuple(map(list, zip(*symbol_quotes)))
+
+  def fetch(self, symbol_name) -> dict:
+    if symbol_name not in self._quotes:
+      raise QuoteError(f'No recorded quotes for {symbol_name}')
+    times, infos = self._quotes[symbol_name]
+    i = bisect.bisect_right(times, self.clock())
+    return infos[max(i - 1, 0)]
+
+  @staticmethod
+  def write(path, symbol_name, info, timestamp=None):
+    """Append a quote to a file readable by `RecordedQuoteProvider`."""
+    if timestamp is None:
+      timestamp = time.time()
+    with open(path, 'a') as f:
+      f.write(json.dumps({'symbol': symbol_name, 'time': timestamp,
+                          'info': info}) + '\n')
+
+
+class RecordingQuoteProvider(QuoteProvider):
+  """Fetches from `provider` and records everything to `path`."""
+
+  def __init__(self, provider: QuoteProvider, path):
+    self.provider = provider
+    self.path = path
+    self._lock = threading.Lock()
+
+  def fetch(self, symbol_name) -> dict:
+    info = self.provider.fetch(symbol_name)
+    with self._lock:
+      RecordedQuoteProvider.write(self.path, symbol_name, info)
+    return info
+
+
+class SimulatedQuoteProvider(QuoteProvider):
+  """Wraps `provider`, adding latency and HTTP errors, for load tests."""
+
+  def __init__(self, provider: QuoteProvider, latency_s=0.1,
+               latency_jitter_s=0.05, error_rate=0., seed=None):
+    self.provider = provider
+    self.latency_s = latency_s
+    self.latency_jitter_s = latency_jitter_s
+    self.error_rate = error_rate
+    self._rand = random.Random(seed)
+    self._lock = threading.Lock()
+    self.num_fetches = 0
+    self.num_errors = 0
+
+  def fetch(self, symbol_name) -> dict:
+    with self._lock:
+      self.num_fetches += 1
+      latency = max(0., self._rand.gauss(self.latency_s,
+                                         self.latency_jitter_s))
+      fail = self._rand.random() < self.error_rate
+      if fail:
+        self.num_errors += 1
+    time.sleep(latency)
+    if fail:
+      raise urllib.error.HTTPError(
+        f'simulated://{symbol_name}', 503, 'Simulated error', None, None)
+    return self.provider.fetch(symbol_name)
+
+
+_provider: QuoteProvider = YFinanceProvider()
+
+
+def set_provider(provider: QuoteProvider) -> QuoteProvider:
+  """Sets the provider used by all `Ticker`s, returns the previous one."""
+  global _provider
+  previous, _provider = _provider, provider
+  return previous
+
+
+def get_provider() -> QuoteProvider:
+  return _provider
+
+
+# A `refresh_policy.RefreshPolicy`, or None to refresh every ticker after
+# its `query_cache_timeout_s`.
+_refresh_policy = None
+
+
+def set_refresh_policy(policy):
+  """Sets the policy used by all `Ticker`s, returns the previous one."""
+  global _refresh_policy
+  previous, _refresh_policy = _refresh_policy, policy
+  return previous
+
+
+def get_refresh_policy():
+  return _refresh_policy
+
+
+def fetch_quote(symbol_name, retry=5) -> Quote:
+  """Fetches from the current provider, retrying on HTTP errors."""
+  try:
+    info = _provider.fetch(symbol_name)
+  except urllib.error.HTTPError as e:
+    if retry:
+      logger.info(f'*** Caught {e} for {symbol_name}, retry={retry}')
+      profiling.count('quote.retries')
+      return fetch_quote(symbol_name, retry - 1)
+    raise e
+  # Only keep what we need, `info` can have hundreds of entries.
+  return Quote.from_info(symbol_name, info, time.time())
+
+
+def refresh(symbol_names):
+  """Schedules updates of the stale `symbol_names`, most important first.
+
+  :returns: The futures of the scheduled updates.
+  """
+  if _refresh_policy:
+    symbol_names = _refresh_policy.order(symbol_names)
+  futures = [Ticker.make(symbol_name).lazy_update()
+             for symbol_name in symbol_names]
+  return [fut for fut in futures if fut]
+
+
 class Ticker(object):
+  __slots__ = ('symbol_name', 'queried', 'quote', 'query_cache_timeout_s',
+               '_current_value', 'waiting', 'pending', '__weakref__')
+
   @staticmethod
   def make(symbol_name) -> 'Ticker':
-    if symbol_name not in _tickers:
-      _tickers[symbol_name] = Ticker(symbol_name)
-    return _tickers[symbol_name]
+    """Returns the shared ticker of `symbol_name`.
+
+    Tickers that are not referenced anymore are dropped, except for the
+    `_MAX_TICKERS` most recently used ones. Fetches in progress reference
+    their ticker.
+    """
+    with _tickers_lock:
+      ticker = _tickers.get(symbol_name)
+      if ticker is None:
+        ticker = _tickers[symbol_name] = Ticker(symbol_name)
+      _recent_tickers[symbol_name] = ticker
+      _recent_tickers.move_to_end(symbol_name)
+      while len(_recent_tickers) > _MAX_TICKERS:
+        _recent_tickers.popitem(last=False)
+      return ticker
 
   @staticmethod
   def register_callback(name, callback_fn):
@@ -38,15 +249,27 @@ class Ticker(object):
     logger.info(f'*** Create Ticker for {symbol_name}')
     self.symbol_name = symbol_name
     self.queried = None  # Time of query
-    self.info_cache = None
+    self.quote: Optional[Quote] = None
     self.query_cache_timeout_s = 5 * 60  # 5 minutes.
     self._current_value = helpers.OptionalFloat(None)
     self.waiting = False
+    self.pending: Optional[concurrent.futures.Future] = None  # Last update.
 
   def get_current_value(self) -> helpers.OptionalFloat:
     self.lazy_update()
     return self._current_value
 
+  def get_cached_value(self) -> helpers.OptionalFloat:
+    """The last fetched value, without triggering an update."""
+    return self._current_value
+
+  def set_price(self, price: float, timestamp: float):
+    """Sets the value from elsewhere (see `price_feed`), without callbacks."""
+    short_name = self.quote.short_name if self.quote else None
+    self.quote = Quote(self.symbol_name, price, short_name, timestamp)
+    self._current_value = helpers.OptionalFloat(price)
+    self.queried = timestamp
+
   def lazy_update(self, force=None) -> Optional[concurrent.futures.Future]:
     if force or self._should_update():
       return self._schedule_update()
@@ -56,31 +279,29 @@ class Ticker(object):
     self.queried = time.time()
     self.waiting = True
 
-    def _get_info(retry=5):
+    def _update():
+      # Done here and not in `_done`, so that the value is set once the
+      # future has a result.
       try:
-        return yf.Ticker(self.symbol_name).info
-      except urllib.error.HTTPError as e:
-        if retry:
-          logger.info(f'*** Caught {e} for {self.symbol_name}, retry={retry}')
-          return _get_info(retry-1)
-        raise e
+        profiling.count('quote.fetches')
+        with profiling.timer('quote.fetch'):
+          self.quote = fetch_quote(self.symbol_name)
+        self._current_value = helpers.OptionalFloat(self.quote.price)
+        logger.info(f' --> {self.symbol_name} {self._current_value}')
+        return self.quote
+      finally:
+        self.waiting = False
 
     def _done(fut_):
       logger.info(f'DONE {self.symbol_name} {_callbacks.keys()}')
-      self.info_cache = fut_.result()
-      try:
-        self._current_value = helpers.OptionalFloat(
-          self.info_cache['regularMarketOpen'])
-        logger.info(f' --> {self.symbol_name} {self._current_value}')
-      except KeyError:
-        import pprint
-        pprint.pprint(self.info_cache)
-        raise ValueError(self.symbol_name)
-      self.waiting = False
-      for callback in _callbacks.values():
-        callback()
-
-    fut = _executor.submit(lambda: _get_info())
+      if fut_.exception():
+        logger.info(f'*** Failed {self.symbol_name}: {fut_.exception()}')
+        return
+      with profiling.timer('quote.callbacks'):
+        for callback in list(_callbacks.values()):
+          callback()
+
+    fut = self.pending = _executor.submit(_update)
     logger.info(f'*** Pending: {_executor._work_queue.qsize()} jobs')
     fut.add_done_callback(_done)
     return fut
@@ -90,6 +311,8 @@ class Ticker(object):
       return True
     if self.waiting:
       return False
+    if _refresh_policy:
+      return _refresh_policy.should_refresh(self.symbol_name, self.queried)
     passed = time.time() - self.queried
     if passed > self.query_cache_timeout_s:
       return True
@@ -110,13 +333,40 @@ def convert_currency(amount, from_cur, to_cur) -> helpers.OptionalBalance:
   return helpers.OptionalBalance(base_amount * amount, to_cur)
 
 
-def check_symbols(symbols):
-  futs = [Ticker.make(symbol_name).lazy_update(force=True)
-          for symbol_name in symbols]
-  for fut in concurrent.futures.as_completed(futs):
-    info = fut.result()
-    print('Checked:', info['shortName'])
-  return True
+def check_symbols(symbols, timeout_s=None) -> dict:
+  """Fetches `symbols` concurrently, to see which ones exist.
+
+  Each symbol gets its own thread, so a slow one neither delays the others
+  nor holds the workers of `_executor`, which update the tickers.
+
+  :param timeout_s: Maximum time for each fetch. Fetches that take longer
+      are abandoned.
+  :returns: A dict mapping the valid symbols to their short names. Symbols
+      that failed or were not fetched within `timeout_s` are left out.
+  """
+  symbols = list(symbols)
+  if not symbols:
+    return {}
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(symbols))
+  try:
+    futures = {executor.submit(fetch_quote, symbol_name): symbol_name
+               for symbol_name in symbols}
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout_s)
+  finally:
+    # Doesn't wait for the abandoned fetches.
+    executor.shutdown(wait=False)
+  short_names = {}
+  for fut in done:
+    symbol_name = futures[fut]
+    if fut.exception():
+      logger.info(f'*** Cannot check {symbol_name}: {fut.exception()}')
+      continue
+    quote = fut.result()
+    print('Checked:', quote.short_name)
+    short_names[symbol_name] = quote.short_name
+  for fut in not_done:
+    logger.info(f'*** Timeout checking {futures[fut]}')
+  return short_names
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import async_data_controller
+from data_controller import DataController
+
+
+@pytest.fixture()
+def adc(tmpdir):
+  dc = DataController(str(tmpdir / 'test.db'))
+  dc.setup()
+  adc = async_data_controller.AsyncDataController(dc)
+  yield adc
+  adc.close()
+
+
+def test_calls_run_in_order(adc):
+  async def create_and_get():
+    # Not awaited, the read still sees the write.
+    adc.create_account('Bank', 'CHF')
+    return await adc.get_all_accounts()
+
+  accounts = asyncio.run(create_and_get())
+  assert [acc.name for acc in accounts] == ['Bank']
+
+
+def test_cancel_skips_queued_call(adc):
+  release = threading.Event()
+
+  def block(dc):
+    release.wait()
+
+  async def cancel_queued():
+    blocking = adc.run(block)
+    queued = adc.create_account('Bank', 'CHF')
+    queued.cancel()
+    release.set()
+    await blocking
+    return await adc.get_all_accounts()
+
+  assert asyncio.run(cancel_queued()) == []
+
+
+def test_cancel_interrupts_running_query(adc):
+  def count_forever(dc):
+    with dc.connect() as c:
+      c.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 '
+                'FROM n) SELECT count(*) FROM n')
+      return c.fetchone()
+
+  errors = []
+
+  def record_error(dc):
+    try:
+      count_forever(dc)
+    except sqlite3.OperationalError as e:
+      errors.append(e)
+
+  async def cancel_running():
+    running = adc.run(record_error, interruptible=True)
+    await asyncio.sleep(0.1)
+    running.cancel()
+    # The worker is free again.
+    return await asyncio.wait_for(adc.get_all_accounts(), timeout=10)
+
+  assert asyncio.run(cancel_running()) == []
+  assert errors and 'interrupted' in str(errors[0])
@@ -0,0 +1,75 @@
+import numpy as np
+
+import charts
+
+
+def test_minmax():
+  x = np.arange(10.)
+  y = np.array([0., 1., 5., 1., 0., 0., -3., 0., 0., 2.])
+  lows, highs = charts.minmax(x, y, 0, 10, 5)
+  assert list(lows) == [0., 1., 0., -3., 0.]
+  assert list(highs) == [1., 5., 1., 0., 2.]
+  # Before the first point there is nothing, after the last one it stays.
+  lows, highs = charts.minmax(x, y, -4, 16, 5)
+  assert np.isnan(lows[0]) and np.isnan(highs[0])
+  assert (lows[-1], highs[-1]) == (2., 2.)
+  # Columns without points continue the step function.
+  lows, highs = charts.minmax(np.array([0., 9.]), np.array([1., 2.]), 0, 10, 5)
+  assert list(lows) == [1., 1., 1., 1., 1.]
+  assert list(highs) == [1., 1., 1., 1., 2.]
+
+
+def test_lttb():
+  x = np.arange(1000.)
+  y = np.zeros(1000)
+  y[500] = 10.
+  sx, sy = charts.lttb(x, y, 20)
+  assert len(sx) == 20
+  assert (sx[0], sx[-1]) == (0., 999.)
+  assert 10. in sy
+  assert np.all(np.diff(sx) > 0)
+  # Nothing to reduce.
+  assert len(charts.lttb(x[:10], y[:10], 20)[0]) == 10
+
+
+def test_downsample_is_cached():
+  series = charts.Series('test', np.arange(100.), np.arange(100.))
+  for method in charts.METHODS:
+    result = charts.downsample(series, 0, 100, 10, method)
+    assert charts.downsample(series, 0, 100, 10, method) is result
+    assert charts.downsample(series, 0, 100, 20, method) is not result
+  # Appending points invalidates the cache.
+  longer = charts.Series('test', np.arange(101.), np.arange(101.))
+  assert charts.downsample(longer, 0, 100, 10) is not charts.downsample(
+    series, 0, 100, 10)
+
+
+def test_combine():
+  keys = ['CHF', 'USD', 'CHF', 'USD']
+  y = [1., 10., 2., 20.]
+  assert list(charts.combine(keys, y, {'CHF': 1., 'USD': 0.5})) == [
+    1., 6., 7., 12.]
+
+
+def test_render():
+  lows = np.array([np.nan, 0., 1., 2.])
+  highs = np.array([np.nan, 1., 1., 2.])
+  assert charts.render(lows, highs, 3) == [
+    '   █',
+    ' ██ ',
+    ' █  ']
+  assert charts.render(lows, highs, 3, label=lambda v: f'{v:.0f}') == [
+    '2  █',
+    ' ██ ',
+    '0█  ']
+
+
+def test_render_bands():
+  outer = (np.array([0., 0., 0., 0.]), np.array([1., 2., 3., 4.]))
+  inner = (np.array([.5, 1., 1.5, 2.]), np.array([.5, 1., 1.5, 2.]))
+  assert charts.render_bands([outer, inner], 5, chars='░█') == [
+    '   ░',
+    '  ░░',
+    ' ░██',
+    '░█░░',
+    '█░░░']
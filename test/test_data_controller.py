@@ -1,5 +1,15 @@
+import concurrent.futures
+import json
+import sqlite3
+
 import pytest
+
+import helpers
+import symbol_values
 from data_controller import DataController, UnknownSymbolException
+from data_controller import PortfolioDataController
+from data_controller import import_files, _create_tables_v0, _resolve_symbols
+from data_controller import _known_hashes, _MIGRATIONS
 
 
 
@@ -71,6 +81,8 @@ def test_shares_buy_sell(data_controller):
   overview = data_controller.get_symbol_overview('TEST')
   assert overview.quantity == 0
   assert overview.proceeds_so_far == 10
+  # Closed positions don't need a quote.
+  assert overview.get_current_total_value() == 0
 
 
 def test_shares_two_buys(data_controller):
@@ -87,4 +99,543 @@ def test_shares_get_all(data_controller):
   for symbol in symbols:
     data_controller.add_stock_symbol(symbol, 'USD')
   assert [so.symbol
-          for so in data_controller.get_all_symbol_overviews()] == symbols
\ No newline at end of file
+          for so in data_controller.get_all_symbol_overviews()] == symbols
+
+def test_transaction_dates(data_controller):
+  data_controller.add_transaction(_TEST_ACCOUNT_NAME, 10, date='2020-03-01')
+  data_controller.add_transaction(_TEST_ACCOUNT_NAME, 5,
+                                  date='2020-01-15, 10:00:00')
+  data_controller.add_transaction(_TEST_ACCOUNT_NAME, 1,
+                                  date='2020-02-01 12:30:00')
+  transactions = data_controller.get_account_transactions(_TEST_ACCOUNT_NAME)
+  assert [t.date for t in transactions] == ['2020-01-15, 10:00:00',
+                                            '2020-02-01, 12:30:00',
+                                            '2020-03-01, 00:00:00']
+  transactions = data_controller.get_account_transactions(
+    _TEST_ACCOUNT_NAME, start='2020-02-01', end='2020-03-01')
+  assert [t.value for t in transactions] == [1]
+  assert data_controller.get_balance_as_of(
+    _TEST_ACCOUNT_NAME, '2020-02-01, 12:30:00') == 6
+  assert data_controller.get_balance_as_of(_TEST_ACCOUNT_NAME, '2019-01-01') == 0
+  with pytest.raises(ValueError):
+    data_controller.add_transaction(_TEST_ACCOUNT_NAME, 1, date='yesterday')
+
+
+def _create_db(db_path, version):
+  """A db at `version`, as the code of that version created it."""
+  conn = sqlite3.connect(db_path)
+  c = conn.cursor()
+  _create_tables_v0(c)
+  for migration in _MIGRATIONS[:version]:
+    migration(c)
+  c.execute(f'PRAGMA user_version = {version}')
+  return conn
+
+
+def test_migrate_text_dates(tmp_database_path):
+  conn = sqlite3.connect(tmp_database_path)
+  _create_tables_v0(conn.cursor())
+  conn.execute("INSERT INTO accounts (name, currency, category) "
+               "VALUES ('Old', 'USD', 0)")
+  conn.execute("INSERT INTO transactions "
+               "(accountID, date, info, value, balance_after) "
+               "VALUES (1, '2019-12-31, 23:59:59', 'Initial', 3, 3)")
+  conn.commit()
+  conn.close()
+  dc = DataController(tmp_database_path)
+  transactions = dc.get_account_transactions('Old')
+  assert [t.date for t in transactions] == ['2019-12-31, 23:59:59']
+  assert dc.get_balance('Old') == 3
+
+
+def test_balances_are_exact(data_controller):
+  for _ in range(1000):
+    data_controller.add_transaction(_TEST_ACCOUNT_NAME, 0.1)
+  balance = data_controller.get_balance(_TEST_ACCOUNT_NAME)
+  assert balance.get_minor() == 10000
+  assert balance == 100
+
+
+def test_category_totals(tmp_database_path):
+  dc = DataController(tmp_database_path)
+  dc.create_account('A', 'USD')
+  dc.create_account('B', 'USD')
+  dc.create_account('C', 'JPY')
+  dc.create_account('D', 'USD', category=1)
+  dc.add_transaction('A', 10.5)
+  dc.add_transaction('A', 0.25)
+  dc.add_transaction('B', 3)
+  dc.add_transaction('C', 1000)
+  dc.add_transaction('D', 7)
+  totals = dc.get_category_totals(category=0)
+  # Like `get_balance(name, -2)`, a single transaction has no diff.
+  assert [(acc.get_diff_to_last(), dc.get_balance(acc.name, -2))
+          for acc in dc.get_all_accounts(category=0)] == [
+    (0.25, 10.5), (0, 3), (0, 1000)]
+  assert totals['USD'] == (13.75, 0.25)
+  assert totals['JPY'] == (1000, 0)
+  assert totals['JPY'][0].get_minor() == 1000
+  assert dc.get_category_totals(category=1) == {'USD': (7, 0)}
+  dc.create_account('E', 'EUR', category=1)
+  assert dc.get_category_totals(category=1) == {'USD': (7, 0), 'EUR': (0, 0)}
+
+
+def test_add_transactions(data_controller):
+  data_controller.add_transaction(_TEST_ACCOUNT_NAME, 10)
+  balances = data_controller.add_transactions(
+    [(_TEST_ACCOUNT_NAME, 5), (_TEST_ACCOUNT_NAME + '_2', 1.25),
+     (_TEST_ACCOUNT_NAME, -2)], date='2020-01-01', info='Month end')
+  assert balances == [15, 1.25, 13]
+  assert data_controller.get_balance(_TEST_ACCOUNT_NAME) == 13
+  assert data_controller.get_balance(_TEST_ACCOUNT_NAME, index=-2) == 15
+  assert [(t.date, t.info) for t in data_controller.get_account_transactions(
+    _TEST_ACCOUNT_NAME + '_2')] == [('2020-01-01, 00:00:00', 'Month end')]
+  with pytest.raises(ValueError):
+    data_controller.add_transactions([('Unknown', 1)])
+
+
+def test_aggregates_match_transactions(tmp_database_path):
+  dc = DataController(tmp_database_path)
+  for name, category in [('A', 0), ('B', 0), ('C', 1)]:
+    dc.create_account(name, 'USD', category)
+  for i in range(30):
+    dc.add_transaction('ABC'[i % 3], i * 1.5 - 10)
+  with dc.connect() as c:
+    # Not the latest transaction of A, must not change the aggregates.
+    c.execute('INSERT INTO transactions (id, accountID, date, value, '
+              'balance_after) VALUES (0, 1, 0, 100, 100)')
+  expected = {}
+  for acc in dc.get_all_accounts():
+    transactions = dc.get_account_transactions(acc.name)
+    assert acc.get_balance().get_minor() == sum(
+      t.value.get_minor() for t in transactions) - 100 * (acc.name == 'A')
+    assert acc.get_diff_to_last() == transactions[-1].value
+    category = 1 if acc.name == 'C' else 0
+    total, diff = expected.get(category, (0, 0))
+    expected[category] = (total + acc.get_balance(),
+                          diff + acc.get_diff_to_last())
+  for category, (total, diff) in expected.items():
+    assert dc.get_category_totals(category) == {'USD': (total, diff)}
+
+
+def test_positions_incremental(data_controller):
+  data_controller.add_stock_symbol('TEST', 'USD')
+  data_controller.add_share_transaction('TEST', quantity=10, proceeds=-100,
+                                        date='2020-01-01')
+  data_controller.add_stock_split('TEST', 2, date='2020-02-01')
+  data_controller.add_share_transaction('TEST', quantity=-5, proceeds=40,
+                                        date='2020-03-01')
+  overview = data_controller.get_symbol_overview('TEST')
+  assert overview.quantity == 15
+  assert overview.get_realized_gain() == 15
+  assert overview.get_cost_basis() == 75
+
+  incremental = data_controller.get_position('TEST')
+  data_controller.rebuild_positions()
+  rebuilt = data_controller.get_position('TEST')
+  assert list(incremental.lots) == list(rebuilt.lots)
+  assert incremental.realized == rebuilt.realized
+
+
+def test_split_before_earlier_trades(data_controller):
+  data_controller.add_stock_symbol('TEST', 'USD')
+  data_controller.add_share_transaction('TEST', quantity=-2, proceeds=30,
+                                        date='2020-03-01')
+  # Recorded before any holdings, and before the trades are inserted.
+  data_controller.add_stock_split('TEST', 2, date='2020-02-01')
+  data_controller.add_share_transaction('TEST', quantity=10, proceeds=-100,
+                                        date='2020-01-01')
+  overview = data_controller.get_symbol_overview('TEST')
+  assert overview.quantity == 18
+  assert overview.get_cost_basis() == 90
+  assert [s.quantity for s in data_controller.get_all_symbol_overviews()] == [
+    18]
+
+  data_controller.add_share_transaction('TEST', quantity=4, proceeds=-20,
+                                        date='2020-01-15')
+  assert data_controller.get_symbol_overview('TEST').quantity == 26
+  data_controller.rebuild_positions()
+  assert data_controller.get_position('TEST').quantity == 26
+
+
+def test_migrate_split_ratios(tmp_database_path):
+  conn = _create_db(tmp_database_path, 9)
+  conn.execute("INSERT INTO stocks (symbol, currency) VALUES ('TEST', 'USD')")
+  # A 3:2 split, stored by its quantity only.
+  conn.executemany(
+    'INSERT INTO shareTransactions (symbolID, date, quantity, proceeds, '
+    'quantity_after, proceeds_after, kind) VALUES (1, ?, ?, ?, ?, ?, ?)',
+    [(1577836800, 10, -10000, 10, -10000, 'trade'),
+     (1580515200, 5, 0, 15, -10000, 'split')])
+  conn.commit()
+  conn.close()
+  dc = DataController(tmp_database_path)
+  assert dc.get_position('TEST').quantity == 15
+  assert dc.get_symbol_overview('TEST').quantity == 15
+
+
+def test_compact(data_controller):
+  name = _TEST_ACCOUNT_NAME
+  for i, date in enumerate(['2020-01-01', '2020-02-01', '2020-03-01',
+                            '2020-04-01']):
+    data_controller.add_transaction(name, i + 1, date=date,
+                                    info=f'T{i}', content_hash=f'h{i}')
+  data_controller.add_stock_symbol('TEST', 'USD')
+  data_controller.add_share_transaction('TEST', quantity=10, proceeds=-100,
+                                        date='2020-01-01')
+  data_controller.add_stock_split('TEST', 2, date='2020-02-01')
+  data_controller.add_share_transaction('TEST', quantity=-5, proceeds=40,
+                                        date='2020-04-01')
+  position = data_controller.get_position('TEST')
+  totals = data_controller.get_category_totals()
+
+  assert data_controller.compact('2020-03-01') == 4
+  # Nothing new to archive.
+  assert data_controller.compact('2020-03-01') == 0
+  transactions = data_controller.get_account_transactions(name)
+  assert [(t.info, t.value, t.is_checkpoint) for t in transactions] == [
+    ('', 3, True), ('T2', 3, False), ('T3', 4, False)]
+  assert data_controller.get_balance(name) == 10
+  assert data_controller.get_balance(name, -2) == 6
+  assert data_controller.get_balance_as_of(name, '2020-01-15') == 1
+  assert data_controller.get_balance_as_of(name, '2020-03-15') == 6
+  assert data_controller.get_category_totals() == totals
+  archived, archive_id = data_controller.get_archived_transactions(name)
+  assert [t.info for t in archived] == ['T0', 'T1']
+  assert data_controller.get_archived_transactions(name, archive_id) == (
+    [], None)
+
+  # Lots survive compaction and replays.
+  data_controller.rebuild_positions()
+  rebuilt = data_controller.get_position('TEST')
+  assert list(rebuilt.lots) == list(position.lots)
+  assert rebuilt.realized == position.realized
+  assert data_controller.get_symbol_overview('TEST').quantity == 15
+  with pytest.raises(ValueError):
+    data_controller.add_share_transaction('TEST', quantity=1, proceeds=-10,
+                                          date='2020-01-15')
+
+  # Compacting again archives into a new archive, behind the checkpoint.
+  data_controller.add_transaction(name, 5, date='2020-05-01')
+  assert data_controller.compact('2020-05-01') == 2
+  assert [t.value for t in data_controller.get_account_transactions(name)] == [
+    10, 5]
+  assert data_controller.get_balance_as_of(name, '2020-03-15') == 6
+  archived, archive_id = data_controller.get_archived_transactions(name)
+  assert [t.info for t in archived] == ['T2', 'T3']
+  archived, _ = data_controller.get_archived_transactions(name, archive_id)
+  assert [t.info for t in archived] == ['T0', 'T1']
+  # Imports still skip archived rows.
+  with data_controller.connect() as c:
+    assert _known_hashes(c, ['h0', 'h3', 'new']) == {'h0', 'h3'}
+
+
+def test_balance_history(tmp_database_path):
+  dc = DataController(tmp_database_path)
+  dc.create_account('A', 'USD')
+  dc.create_account('B', 'USD', category=1)
+  dc.create_account('C', 'CHF')
+  dc.add_transaction('A', 1, date='2020-01-01')
+  dc.add_transaction('B', 2, date='2020-01-02')
+  dc.add_transaction('C', 3, date='2020-01-03')
+  # Out of order.
+  dc.add_transaction('A', 4, date='2020-01-01T12:00:00')
+  day = helpers.parse_date('2020-01-02') - helpers.parse_date('2020-01-01')
+  start = helpers.parse_date('2020-01-01')
+  assert dc.get_balance_history('A') == [
+    (start, 'USD', 100), (start + day // 2, 'USD', 500)]
+  assert dc.get_balance_history() == [
+    (start, 'USD', 100), (start + day // 2, 'USD', 500),
+    (start + day, 'USD', 700), (start + 2 * day, 'CHF', 300)]
+  assert dc.get_balance_history(category=0, start='2020-01-02') == [
+    (start + 2 * day, 'CHF', 300)]
+  assert dc.get_balance_history(start='2020-01-02', end='2020-01-03') == [
+    (start + day, 'USD', 700)]
+
+
+def test_search_transactions(tmp_database_path, monkeypatch):
+  dc = DataController(tmp_database_path)
+  dc.create_account('A', 'CHF')
+  dc.create_account('B', 'CHF')
+  dc.add_transaction('A', 1, date='2020-01-01', info='Migros Zürich')
+  dc.add_transaction('A', 2, date='2020-01-02', info='Rent')
+  dc.add_transaction('B', 3, date='2020-01-03', info='Migros Migros Bern')
+  dc.add_transaction('B', 4, date='2020-01-04', info='Coop "AND" more')
+
+  def search(text, **kwargs):
+    return [(r.account_name, r.transaction.info)
+            for r in dc.search_transactions(text, **kwargs)]
+
+  # More occurrences rank first.
+  assert search('migros') == [('B', 'Migros Migros Bern'),
+                              ('A', 'Migros Zürich')]
+  assert search('zur') == [('A', 'Migros Zürich')]
+  assert search('zur ') == []
+  assert search('migros b') == [('B', 'Migros Migros Bern')]
+  assert search('migros', account_name='A') == [('A', 'Migros Zürich')]
+  assert search('migros', date_range=('2020-01-02', None)) == [
+    ('B', 'Migros Migros Bern')]
+  assert search('migros', limit=1, offset=1) == [('A', 'Migros Zürich')]
+  # Operators and quotes are searched as words.
+  assert search('"and') == [('B', 'Coop "AND" more')]
+  assert search('  ') == []
+  # Too many matches to rank, the newest come first.
+  monkeypatch.setattr('data_controller._MAX_RANKED', 1)
+  assert search('migros') == [('B', 'Migros Migros Bern'),
+                              ('A', 'Migros Zürich')]
+  assert search('m') == [('B', 'Coop "AND" more'),
+                         ('B', 'Migros Migros Bern'),
+                         ('A', 'Migros Zürich')]
+  monkeypatch.undo()
+  # Archived transactions are removed from the index.
+  dc.compact('2020-01-04')
+  assert search('migros') == []
+  assert search('coop')[0][1] == 'Coop "AND" more'
+
+
+def test_search_migration(tmp_database_path):
+  conn = _create_db(tmp_database_path, 8)
+  conn.execute("INSERT INTO accounts (name, currency, category) "
+               "VALUES ('A', 'CHF', 0)")
+  conn.execute("INSERT INTO transactions "
+               "(accountID, date, info, value, balance_after) "
+               "VALUES (1, 1577836800, 'Before the index', 100, 100)")
+  conn.commit()
+  conn.close()
+  dc = DataController(tmp_database_path)
+  assert [r.transaction.info for r in dc.search_transactions('index')] == [
+    'Before the index']
+
+
+def test_connections_per_thread(data_controller):
+  with data_controller.connect() as c:
+    assert data_controller.get_balance(_TEST_ACCOUNT_NAME) == 0
+    # The other thread commits on its own connection, and is not blocked.
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+      executor.submit(data_controller.add_transaction,
+                      _TEST_ACCOUNT_NAME, 5).result(timeout=10)
+    c.execute('SELECT 1')
+  assert data_controller.get_balance(_TEST_ACCOUNT_NAME) == 5
+  with data_controller.connect() as c:
+    assert c.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_connect_rolls_back_on_error(data_controller):
+  with pytest.raises(ValueError):
+    with data_controller.connect():
+      data_controller.add_transaction(_TEST_ACCOUNT_NAME, 5)
+      raise ValueError('Rolled back')
+  assert data_controller.get_balance(_TEST_ACCOUNT_NAME) == 0
+
+
+def test_submit_write(data_controller):
+  def add(value):
+    return lambda dc: dc.add_transaction(_TEST_ACCOUNT_NAME, value)
+
+  def fail(dc):
+    dc.add_transaction(_TEST_ACCOUNT_NAME, 1000)
+    raise ValueError('Rolled back')
+
+  with concurrent.futures.ThreadPoolExecutor(4) as executor:
+    futures = list(executor.map(data_controller.submit_write,
+                                [add(1)] * 50 + [fail] + [add(2)] * 50))
+    # Reads are not blocked by the writes.
+    executor.submit(data_controller.get_all_accounts).result(timeout=10)
+  data_controller.close()
+  with pytest.raises(ValueError):
+    futures[50].result()
+  # Submitted from several threads, so in any order.
+  del futures[50]
+  assert max(future.result() for future in futures) == 150
+  assert data_controller.get_balance(_TEST_ACCOUNT_NAME) == 150
+  assert len(data_controller.get_account_transactions(
+    _TEST_ACCOUNT_NAME)) == 100
+
+
+_IBKR_CSV = '''\
+Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,Date/Time,Quantity,T. Price,Proceeds
+Trades,Data,Order,Stocks,USD,AAPL,"{date}",10,100,-1000
+Trades,Data,Order,Stocks,USD,AAPL,"2020-09-01, 10:00:00",-20,150,3000
+Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,Date/Time,Quantity,T. Price,Proceeds
+Trades,Data,Order,Forex,USD,USD.CHF,"2020-01-01, 10:00:00",1,1,1
+Corporate Actions,Header,Asset Category,Currency,Report Date,Date/Time,Description,Quantity
+Corporate Actions,Data,Stocks,USD,2020-08-31,"2020-08-28, 20:25:00",AAPL(US0378331005) Split 4 for 1 (AAPL; APPLE INC),30
+Financial Instrument Information,Header,Asset Category,Symbol,Description,Listing Exch
+Financial Instrument Information,Data,Stocks,AAPL,APPLE INC,NASDAQ
+'''
+
+
+def test_import_files(tmpdir, tmp_database_path, monkeypatch):
+  monkeypatch.setattr(symbol_values, 'check_symbols',
+                      lambda symbols, timeout_s=None: {s: s for s in symbols})
+  paths = []
+  # The second file overlaps with the first one.
+  for i, date in enumerate(['2020-01-02, 10:00:00', '2020-01-03, 10:00:00']):
+    path = str(tmpdir / f'stocks_{i}.csv')
+    with open(path, 'w') as f:
+      f.write(_IBKR_CSV.format(date=date))
+    paths.append(path)
+  accounts_path = str(tmpdir / 'accounts.json')
+  with open(accounts_path, 'w') as f:
+    json.dump({'currency': 'CHF', 'last': {'Bank': 10}, 'now': {'Bank': 12.5},
+               'cat1': {'Non-Liquids': [['Bought', '2019-01-01', 100]]}}, f)
+  paths.append(accounts_path)
+
+  dc = DataController(tmp_database_path)
+  assert import_files(dc, paths, workers=2) == 7
+  assert dc.get_balance('Bank') == 12.5
+  assert dc.get_balance('Non-Liquids') == 100
+  overview = dc.get_symbol_overview('AAPL')
+  assert overview.quantity == 60
+  assert overview.proceeds_so_far == 1000
+  # FIFO: The 20 shares sold are half of the (split) first lot.
+  assert overview.get_realized_gain() == 3000 - 1000 / 2
+
+  # Importing again is a no-op.
+  assert import_files(dc, paths, workers=2) == 0
+  assert dc.get_symbol_overview('AAPL').quantity == 60
+
+
+def test_import_incremental(tmpdir, tmp_database_path, monkeypatch):
+  monkeypatch.setattr(symbol_values, 'check_symbols',
+                      lambda symbols, timeout_s=None: {s: s for s in symbols})
+  path = str(tmpdir / 'stocks.csv')
+  with open(path, 'w') as f:
+    f.write(_IBKR_CSV.format(date='2020-01-02, 10:00:00'))
+  dc = DataController(tmp_database_path)
+  assert import_files(dc, [path], incremental=True) == 3
+  assert dc.get_import_watermarks() == {
+    path: helpers.parse_date('2020-09-01, 10:00:00')}
+  # A new trade is added to the statement.
+  lines = _IBKR_CSV.format(date='2020-01-02, 10:00:00').splitlines(True)
+  lines.insert(3, 'Trades,Data,Order,Stocks,USD,AAPL,"2020-10-01, 10:00:00",'
+                  '5,100,-500\n')
+  with open(path, 'w') as f:
+    f.write(''.join(lines))
+  assert import_files(dc, [path], incremental=True) == 1
+  assert dc.get_symbol_overview('AAPL').quantity == 25
+  assert import_files(dc, [path], incremental=True) == 0
+
+
+def test_import_incremental_json(tmpdir, tmp_database_path):
+  path = str(tmpdir / 'accounts.json')
+  house = [['Bought', '2020-01-01', 100], ['Renovated', '2020-06-01', 10]]
+
+  def write():
+    with open(path, 'w') as f:
+      json.dump({'currency': 'CHF', 'last': {'Bank': 10}, 'now': {'Bank': 12},
+                 'cat1': {'Non-Liquids': house}}, f)
+
+  write()
+  dc = DataController(tmp_database_path)
+  assert import_files(dc, [path], incremental=True) == 4
+  assert dc.get_import_watermarks() == {path: helpers.parse_date('2020-06-01')}
+  # Entries before the watermark are not even parsed.
+  house += [['Forgotten', '2019-01-01', 5], ['Sold', '2021-01-01', -110]]
+  write()
+  assert import_files(dc, [path], incremental=True) == 1
+  assert dc.get_balance('Non-Liquids') == 0
+  assert dc.get_import_watermarks() == {path: helpers.parse_date('2021-01-01')}
+
+
+_IBKR_SPLIT_FIRST_CSV = '''\
+Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,Date/Time,Quantity,T. Price,Proceeds
+Trades,Data,Order,Stocks,USD,MSFT,"2020-03-01, 10:00:00",10,100,-1000
+Corporate Actions,Header,Asset Category,Currency,Report Date,Date/Time,Description,Quantity
+Corporate Actions,Data,Stocks,USD,2020-01-31,"2020-01-30, 20:25:00",MSFT(US5949181045) Split 2 for 1 (MSFT; MICROSOFT CORP),0
+Corporate Actions,Data,Stocks,USD,2020-01-31,"2020-01-30, 20:25:00",TSLA(US88160R1014) Split 5 for 1 (TSLA; TESLA INC),0
+Financial Instrument Information,Header,Asset Category,Symbol,Description,Listing Exch
+Financial Instrument Information,Data,Stocks,MSFT,MICROSOFT CORP,NASDAQ
+'''
+
+
+def test_import_split_of_new_symbol(tmpdir, tmp_database_path, monkeypatch):
+  monkeypatch.setattr(symbol_values, 'check_symbols',
+                      lambda symbols, timeout_s=None: {s: s for s in symbols})
+  path = str(tmpdir / 'stocks.csv')
+  with open(path, 'w') as f:
+    f.write(_IBKR_SPLIT_FIRST_CSV)
+  dc = DataController(tmp_database_path)
+  # The split of TSLA, which was never traded, is skipped.
+  assert import_files(dc, [path]) == 2
+  assert dc.get_symbol_overview('MSFT').quantity == 10
+  assert [so.symbol for so in dc.get_all_symbol_overviews()] == ['MSFT']
+
+
+def test_resolve_symbols(tmp_database_path, monkeypatch):
+  checked = []
+
+  def check_symbols(symbols, timeout_s=None):
+    checked.append(sorted(symbols))
+    return {s: 'Name of ' + s for s in symbols if s != 'BAD.SW'}
+
+  monkeypatch.setattr(symbol_values, 'check_symbols', check_symbols)
+  dc = DataController(tmp_database_path)
+  instruments = {('AAPL', 'NASDAQ'), ('NESN', 'EBS'), ('BAD', 'EBS')}
+  expected = {'AAPL': 'AAPL', 'NESN': 'NESN.SW', 'BAD': 'BAD.SW'}
+  assert _resolve_symbols(dc, instruments) == expected
+  assert checked == [['AAPL', 'BAD.SW', 'NESN.SW']]
+  # Only the symbol that could not be validated is checked again.
+  assert _resolve_symbols(dc, instruments) == expected
+  assert checked[1:] == [['BAD.SW']]
+  # Expired mappings are validated again.
+  monkeypatch.setattr('data_controller._SYMBOL_RESOLUTION_TTL_S', -1)
+  _resolve_symbols(dc, {('AAPL', 'NASDAQ')})
+  assert checked[2:] == [['AAPL']]
+  with pytest.raises(ValueError):
+    _resolve_symbols(dc, {('X', 'UNKNOWN')})
+
+
+def test_portfolio(tmpdir):
+  alice = DataController(str(tmpdir / 'alice.db'))
+  alice.create_account('Bank', 'CHF')
+  alice.add_transaction('Bank', 10)
+  alice.add_transaction('Bank', 5)
+  alice.add_stock_symbol('AAPL', 'USD')
+  alice.add_share_transaction('AAPL', 10, -1000)
+  bob = DataController(str(tmpdir / 'bob.db'))
+  bob.create_account('Bank', 'CHF')
+  bob.create_account('Savings', 'USD', category=1)
+  bob.add_transaction('Bank', 20)
+  bob.add_transaction('Savings', 100)
+  bob.add_stock_symbol('AAPL', 'USD')
+  bob.add_share_transaction('AAPL', 5, -600)
+
+  dc = PortfolioDataController([alice.db_path, bob.db_path])
+  assert [(acc.name, acc.get_balance(), acc.get_diff_to_last())
+          for acc in dc.get_all_accounts()] == [
+    ('alice/Bank', 15, 5), ('bob/Bank', 20, 0), ('bob/Savings', 100, 0)]
+  assert [acc.name for acc in dc.get_all_accounts(category=1)] == [
+    'bob/Savings']
+  assert dc.get_category_totals() == {'CHF': (35, 5), 'USD': (100, 0)}
+  assert dc.get_category_totals(category=0) == {'CHF': (35, 5)}
+  overview, = dc.get_all_symbol_overviews()
+  assert (overview.symbol, overview.quantity) == ('AAPL', 15)
+  assert overview.proceeds_so_far == -1600
+  assert overview.get_cost_basis() == 1600
+  assert dc.get_position('AAPL').quantity == 15
+  assert dc.get_currency_of_symbol('AAPL') == 'USD'
+  with pytest.raises(UnknownSymbolException):
+    dc.get_position('MSFT')
+  assert [t.value for t in dc.get_account_transactions('bob/Bank')] == [20]
+  assert dc.get_balance('bob/Bank') == 20
+  assert dc.get_balance('alice/Bank', index=-2) == 10
+  assert {currency: balance
+          for _, currency, balance in dc.get_balance_history()} == {
+    'CHF': 3500, 'USD': 10000}
+  assert [balance for _, _, balance in dc.get_balance_history('bob/Bank')] == [
+    2000]
+  alice.add_transaction('Bank', 1, info='Salary')
+  bob.add_transaction('Bank', 2, info='Salary')
+  assert sorted(r.account_name for r in dc.search_transactions('sal')) == [
+    'alice/Bank', 'bob/Bank']
+  assert [r.transaction.value for r in dc.search_transactions(
+    'salary', account_name='bob/Bank')] == [2]
+  bob.create_account('Old', 'CHF')
+  bob.add_transaction('Old', 1, date='2020-01-01')
+  bob.add_transaction('Old', 2, date='2020-02-01')
+  bob.compact('2020-01-15')
+  transactions, _ = dc.get_archived_transactions('bob/Old')
+  assert [t.value for t in transactions] == [1]
+  with pytest.raises(sqlite3.OperationalError):
+    dc.create_account('New', 'CHF')
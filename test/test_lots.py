@@ -0,0 +1,69 @@
+import pytest
+
+import lots
+
+
+def _position(*trades):
+  position = lots.Position()
+  for date, (quantity, proceeds) in enumerate(trades):
+    position.apply_trade(date, quantity, proceeds)
+  return position
+
+
+def test_fifo_and_average():
+  position = _position((10, -1000), (10, -2000), (-15, 3000))
+  assert position.quantity == 5
+  # FIFO: Sold 10 @ 100 and 5 @ 200 for 3000.
+  assert position.get_realized(lots.FIFO) == 3000 - 1000 - 1000
+  assert position.cost_basis(lots.FIFO) == 1000
+  # Average: Sold 15 @ 150 for 3000.
+  assert position.get_realized(lots.AVERAGE) == 3000 - 2250
+  assert position.cost_basis(lots.AVERAGE) == 750
+
+
+@pytest.mark.parametrize('method', lots.METHODS)
+def test_realized_plus_unrealized_is_total_gain(method):
+  trades = [(10, -1000), (5, -700), (-12, 1800), (3, -500)]
+  position = _position(*trades)
+  market_value = position.quantity * 170
+  total_gain = market_value + sum(proceeds for _, proceeds in trades)
+  assert position.get_realized(method) + \
+         position.get_unrealized(market_value, method) == total_gain
+
+
+def test_close_all():
+  position = _position((3, -100), (-3, 90))
+  assert not position.lots
+  assert position.get_realized(lots.FIFO) == -10
+  assert position.get_realized(lots.AVERAGE) == -10
+  assert position.cost_basis(lots.AVERAGE) == 0
+
+
+def test_flip_to_short():
+  position = _position((10, -1000), (-15, 1800))
+  assert position.quantity == -5
+  # Closing 10 for 1200, opening a short of 5 for 600.
+  assert position.get_realized(lots.FIFO) == 200
+  assert position.cost_basis(lots.FIFO) == -600
+  position.apply_trade(2, 5, -500)
+  assert position.get_realized(lots.FIFO) == 300
+  assert not position.lots
+
+
+def test_split():
+  position = _position((10, -1000))
+  position.apply_split(4)
+  assert position.quantity == 40
+  position.apply_trade(1, -40, 1200)
+  assert position.get_realized(lots.FIFO) == 200
+
+
+def test_combine():
+  first = _position((10, -1000), (-5, 600))
+  second = lots.Position()
+  second.apply_trade(0.5, 2, -300)
+  combined = lots.combine([first, second])
+  assert [lot.date for lot in combined.lots] == [0, 0.5]
+  assert combined.quantity == 7
+  assert combined.cost_basis(lots.FIFO) == 800
+  assert combined.get_realized(lots.AVERAGE) == 100
@@ -0,0 +1,65 @@
+import asyncio
+
+import price_feed
+import symbol_values
+
+
+def test_simulated_feed():
+  feed = price_feed.SimulatedFeed({'A': 10.}, seed=0, clock=lambda: 5)
+  ticks = []
+  subscription = feed.subscribe(['A', 'B'], ticks.append)
+  feed.subscribe(['C'], ticks.append)
+  feed.step()
+  assert [(t.symbol, t.timestamp) for t in ticks] == [('A', 5), ('B', 5),
+                                                     ('C', 5)]
+  assert abs(ticks[0].price - 10.) < 1
+  subscription.set_symbols(['B'])
+  feed.step()
+  assert [t.symbol for t in ticks[3:]] == ['B', 'C']
+  subscription.close()
+  assert feed.subscribed_symbols() == {'C'}
+
+
+def test_new_symbols_get_last_tick():
+  feed = price_feed.SimulatedFeed({'A': 10.}, seed=0, clock=lambda: 5)
+  ticks = []
+  feed.subscribe(['A'], ticks.append)
+  feed.step()
+  late_ticks = []
+  subscription = feed.subscribe(['A', 'B'], late_ticks.append)
+  assert late_ticks == ticks
+  subscription.set_symbols(['A'])
+  assert late_ticks == ticks
+  subscription.set_symbols([])
+  subscription.set_symbols(['A'])
+  assert late_ticks == ticks * 2
+
+
+def test_polling_feed(tmpdir):
+  path = str(tmpdir / 'quotes.jsonl')
+  symbol_values.RecordedQuoteProvider.write(
+    path, 'AAPL', {'regularMarketOpen': 1., 'regularMarketPrice': 2.}, 0)
+  symbol_values.RecordedQuoteProvider.write(
+    path, 'MSFT', {'regularMarketOpen': 3.}, 0)
+  previous = symbol_values.set_provider(
+    symbol_values.RecordedQuoteProvider(path))
+
+  async def run():
+    feed = price_feed.PollingFeed(interval_s=0.01)
+    feed.start()
+    ticks = []
+    async for tick in feed.subscribe(['AAPL', 'MSFT', 'UNKNOWN']):
+      ticks.append(tick)
+      if len(ticks) == 2:
+        break
+    # Prices don't change, so nothing more is published.
+    await asyncio.sleep(0.05)
+    feed.stop()
+    return ticks
+
+  try:
+    ticks = asyncio.run(run())
+  finally:
+    symbol_values.set_provider(previous)
+  assert sorted((t.symbol, t.price) for t in ticks) == [('AAPL', 2.),
+                                                       ('MSFT', 3.)]
@@ -0,0 +1,37 @@
+import profiling
+
+
+def test_disabled_records_nothing():
+  profiling.reset()
+  profiling.enable(False)
+  with profiling.timer('t'):
+    pass
+  profiling.count('c')
+  assert profiling.report() == profiling.report()[:1]
+
+
+def test_timers_and_counters():
+  profiling.reset()
+  profiling.enable()
+  try:
+    @profiling.timed('fn')
+    def fn():
+      return 1
+    assert fn() == 1
+    with profiling.timer('block'):
+      pass
+    profiling.count('calls', 3)
+    report = '\n'.join(profiling.report())
+    assert 'fn' in report and 'block' in report and 'calls' in report
+  finally:
+    profiling.enable(False)
+    profiling.reset()
+
+
+def test_histogram_percentiles():
+  h = profiling.Histogram()
+  for ms in range(1, 101):
+    h.add(ms / 1000)
+  assert h.count == 100
+  assert 0.05 <= h.percentile(50) <= 0.1
+  assert h.percentile(100) == h.max_s == 0.1
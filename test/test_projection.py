@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+import pytest
+
+import projection
+import symbol_values
+from data_controller import DataController
+
+
+def _history(log_returns, symbols):
+  prices = np.exp(np.cumsum(np.vstack([np.zeros(len(symbols)), log_returns]),
+                            axis=0))
+  return projection.History({symbol: prices[:, i].tolist()
+                             for i, symbol in enumerate(symbols)})
+
+
+def test_project_without_volatility():
+  # Doubles every step.
+  history = _history(np.full((10, 1), np.log(2)), ['A'])
+  portfolio = projection.Portfolio('CHF', 100., {'A': 10., 'B': 5.})
+  bands = projection.project(portfolio, history, num_steps=3, num_paths=100)
+  assert bands.shape == (len(projection.PERCENTILES), 4)
+  # B has no history and stays like cash.
+  for band in bands:
+    np.testing.assert_allclose(band, [115., 125., 145., 185.], rtol=1e-4)
+
+
+def test_project_matches_the_distribution():
+  rng = np.random.default_rng(0)
+  history = _history(rng.normal(0.01, 0.05, (1000, 2)), ['A', 'B'])
+  portfolio = projection.Portfolio('CHF', 0., {'A': 100., 'B': 100.})
+  bands = projection.project(portfolio, history, num_steps=12,
+                             num_paths=20000, percentiles=(50,), seed=0,
+                             chunk_size=1000)
+  returns = history.log_returns(['A', 'B'])
+  # About the median of each symbol, times two.
+  expected = 200 * np.exp(12 * returns.mean())
+  assert bands[0, -1] == pytest.approx(expected, rel=0.02)
+
+  def spread(h):
+    low, high = projection.project(portfolio, h, num_steps=12,
+                                   num_paths=20000, percentiles=(5, 95),
+                                   seed=0)[:, -1]
+    return high - low
+
+  # Perfectly correlated, the spread is wider than for independent symbols.
+  correlated = _history(np.repeat(returns[:, :1], 2, axis=1), ['A', 'B'])
+  assert spread(correlated) > 1.2 * spread(history)
+
+
+def test_project_is_reproducible():
+  rng = np.random.default_rng(0)
+  history = _history(rng.normal(0.01, 0.05, (20, 3)), ['A', 'B', 'C'])
+  portfolio = projection.Portfolio('CHF', 0., {'A': 1., 'B': 2., 'C': 3.})
+  bands = projection.project(portfolio, history, num_steps=5, num_paths=100,
+                             seed=1, chunk_size=10)
+  np.testing.assert_array_equal(bands, projection.project(
+    portfolio, history, num_steps=5, num_paths=100, seed=1, chunk_size=10,
+    num_workers=2))
+
+
+def test_load_history(tmpdir, monkeypatch):
+  path = str(tmpdir / 'returns.json')
+  with pytest.raises(FileNotFoundError):
+    projection.load_history(path, ['A'], max_age_s=None)
+  fetched = []
+
+  def fetch_prices(symbols):
+    fetched.append(sorted(symbols))
+    return {symbol: [1., 2., 3.] for symbol in symbols if symbol != 'NONE'}
+
+  monkeypatch.setattr(projection, '_fetch_prices', fetch_prices)
+  assert projection.load_history(path, ['A']).symbols == ['A']
+  assert projection.load_history(path, ['A']).symbols == ['A']
+  assert projection.load_history(path, ['A', 'B']).symbols == ['A', 'B']
+  # Symbols without history are not fetched again.
+  assert projection.load_history(path, ['A', 'NONE']).missing == ['NONE']
+  assert projection.load_history(path, ['A', 'NONE']).symbols == ['A']
+  assert fetched == [['A'], ['A', 'B'], ['A', 'NONE']]
+  # A fixture is never fetched.
+  history = projection.History.load(path)
+  history.fetched_at = time.time() - 365 * 24 * 60 * 60
+  history.save(path)
+  assert projection.load_history(path, ['C'], max_age_s=None).symbols == [
+    'A']
+  assert len(fetched) == 3
+
+
+def test_current_portfolio(tmpdir):
+  dc = DataController(str(tmpdir / 'test.db'))
+  dc.create_account('Bank', 'CHF')
+  dc.add_transaction('Bank', 100)
+  dc.create_account('Savings', 'CHF', category=1)
+  dc.add_transaction('Savings', 50)
+  for symbol in ('PRICED', 'CLOSED'):
+    dc.add_stock_symbol(symbol, 'CHF')
+    dc.add_share_transaction(symbol, 2, -10)
+  dc.add_share_transaction('CLOSED', -2, 12)
+  symbol_values.Ticker.make('PRICED').set_price(7., time.time())
+  portfolio = projection.current_portfolio(dc, 'CHF')
+  assert (portfolio.cash, portfolio.values) == (150., {'PRICED': 14.})
+  assert portfolio.total == 164.
+  symbol_values._tickers.clear()
+  symbol_values._recent_tickers.clear()
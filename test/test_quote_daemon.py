@@ -0,0 +1,91 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+import quote_daemon
+import symbol_values
+
+
+@pytest.fixture()
+def recorded_quotes(tmpdir):
+  path = str(tmpdir / 'quotes.jsonl')
+  symbol_values.RecordedQuoteProvider.write(
+    path, 'AAPL', {'regularMarketOpen': 10., 'shortName': 'Apple'}, 0)
+  provider = symbol_values.SimulatedQuoteProvider(
+    symbol_values.RecordedQuoteProvider(path), latency_s=0.,
+    latency_jitter_s=0.)
+  previous = symbol_values.set_provider(provider)
+  symbol_values._tickers.clear()
+  symbol_values._recent_tickers.clear()
+  yield provider
+  symbol_values.set_provider(previous)
+  symbol_values._tickers.clear()
+  symbol_values._recent_tickers.clear()
+
+
+@pytest.fixture()
+def socket_path():
+  # Not in tmpdir, Unix socket paths must be short.
+  tmp_dir = tempfile.mkdtemp()
+  yield os.path.join(tmp_dir, 'quotes.sock')
+  shutil.rmtree(tmp_dir)
+
+
+@pytest.fixture()
+def daemon(recorded_quotes, socket_path):
+  loop = asyncio.new_event_loop()
+  daemon = quote_daemon.QuoteDaemon(socket_path, interval_s=0.01)
+  loop.run_until_complete(daemon.start())
+  thread = threading.Thread(target=loop.run_forever, daemon=True)
+  thread.start()
+  yield daemon
+
+  async def shutdown():
+    daemon.close()
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=10)
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.close()
+
+
+def test_get_through_daemon(daemon, recorded_quotes, socket_path):
+  # The fallback raises, it must not be used.
+  provider = quote_daemon.DaemonQuoteProvider(socket_path,
+                                              symbol_values.QuoteProvider())
+  for _ in range(3):
+    infos = provider.fetch_many(['AAPL', 'MSFT'])
+    assert infos == {'AAPL': {'regularMarketPrice': 10., 'shortName': 'Apple'}}
+  # All clients share the cache of the daemon.
+  assert recorded_quotes.num_fetches == 2
+  assert provider.fetch('AAPL')['regularMarketPrice'] == 10.
+  with pytest.raises(symbol_values.QuoteError):
+    provider.fetch('MSFT')
+
+
+def test_fallback_without_daemon(recorded_quotes, socket_path):
+  provider = quote_daemon.DaemonQuoteProvider(socket_path, recorded_quotes)
+  assert provider.fetch('AAPL')['regularMarketOpen'] == 10.
+  assert provider.fetch_many(['AAPL', 'MSFT']).keys() == {'AAPL'}
+
+
+def test_feed(daemon, socket_path):
+  async def first_tick():
+    feed = quote_daemon.DaemonFeed(socket_path)
+    feed.start()
+    try:
+      async for tick in feed.subscribe(['AAPL']):
+        return tick
+    finally:
+      feed.stop()
+
+  tick = asyncio.run(asyncio.wait_for(first_tick(), timeout=10))
+  assert (tick.symbol, tick.price) == ('AAPL', 10.)
@@ -0,0 +1,72 @@
+import refresh_policy
+import symbol_values
+
+_WEDNESDAY_15_UTC = 1704294000  # 2024-01-03, 15:00 UTC.
+_WEDNESDAY_22_UTC = 1704319200
+_SATURDAY_15_UTC = 1704553200
+
+
+def test_markets():
+  assert refresh_policy.market_of('NESN.SW').name == 'SIX'
+  assert refresh_policy.market_of('IWDA.AS').name == 'Euronext Amsterdam'
+  assert refresh_policy.market_of('AAPL') is refresh_policy.US
+  assert refresh_policy.market_of('BRK.B') is refresh_policy.US
+  assert refresh_policy.market_of('USDCHF=X') is refresh_policy.FX
+  for symbol in ('NESN.SW', 'VUSA.L', 'AAPL', 'USDCHF=X'):
+    market = refresh_policy.market_of(symbol)
+    assert market.is_open(_WEDNESDAY_15_UTC), symbol
+    assert not market.is_open(_SATURDAY_15_UTC), symbol
+  assert not refresh_policy.market_of('AAPL').is_open(_WEDNESDAY_22_UTC)
+  assert refresh_policy.FX.is_open(_WEDNESDAY_22_UTC)
+
+
+def test_ttls():
+  now = [_WEDNESDAY_15_UTC]
+  policy = refresh_policy.RefreshPolicy(
+    open_ttl_s=10, closed_ttl_s=1000, background_ttl_s=100, recent_s=50,
+    clock=lambda: now[0])
+  # Not a position, e.g. FX.
+  assert policy.ttl('USDCHF=X') == 10
+  policy.set_weight('AAPL', 1)
+  assert policy.ttl('AAPL') == 100
+  assert policy.set_visible(['AAPL']) == {'AAPL'}
+  assert policy.ttl('AAPL') == 10
+  assert policy.set_visible([]) == set()
+  now[0] += 40
+  assert policy.ttl('AAPL') == 10  # Recently viewed.
+  now[0] += 20
+  assert policy.ttl('AAPL') == 100
+  assert policy.should_refresh('AAPL', None)
+  assert not policy.should_refresh('AAPL', now[0] - 50)
+  now[0] = _SATURDAY_15_UTC
+  assert policy.ttl('AAPL') == 1000
+
+
+def test_order():
+  policy = refresh_policy.RefreshPolicy()
+  for symbol, weight in [('A', 10), ('B', -1000), ('C', 100), ('D', 1)]:
+    policy.set_weight(symbol, weight)
+  policy.set_visible(['D'])
+  assert policy.order('ABCD') == ['D', 'B', 'C', 'A']
+
+
+def test_tickers_use_policy(tmpdir):
+  path = str(tmpdir / 'quotes.jsonl')
+  symbol_values.RecordedQuoteProvider.write(
+    path, 'AAPL', {'regularMarketOpen': 1.}, 0)
+  previous_provider = symbol_values.set_provider(
+    symbol_values.RecordedQuoteProvider(path))
+  policy = refresh_policy.RefreshPolicy(open_ttl_s=0, closed_ttl_s=0,
+                                        background_ttl_s=10 ** 6)
+  previous_policy = symbol_values.set_refresh_policy(policy)
+  try:
+    policy.set_weight('AAPL', 1)
+    aapl = symbol_values.Ticker('AAPL')
+    aapl.lazy_update().result()
+    # Not visible, not refreshed.
+    assert aapl.lazy_update() is None
+    policy.set_visible(['AAPL'])
+    aapl.lazy_update().result()
+  finally:
+    symbol_values.set_provider(previous_provider)
+    symbol_values.set_refresh_policy(previous_policy)
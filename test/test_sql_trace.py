@@ -0,0 +1,64 @@
+import pytest
+
+import sql_trace
+from data_controller import DataController
+
+
+@pytest.fixture()
+def traced_dc(tmpdir):
+  return DataController(str(tmpdir / 'test.db'), trace=sql_trace.QueryStats())
+
+
+def _num_queries(dc, fn):
+  with dc.trace_refresh('test'):
+    fn()
+  _, queries, _ = dc.trace.refreshes[-1]
+  return queries
+
+
+def test_normalize_sql():
+  assert sql_trace.normalize_sql(
+    "SELECT *  FROM t\n WHERE a=3 AND b='x' AND c IN (?, ?, ?)") == \
+         'SELECT * FROM t WHERE a=? AND b=? AND c IN (...)'
+
+
+@pytest.mark.parametrize('num', [1, 10])
+def test_no_n_plus_one(traced_dc, num):
+  for i in range(num):
+    traced_dc.create_account(f'Acc{i}', 'USD')
+    traced_dc.add_transaction(f'Acc{i}', 10)
+    traced_dc.add_transaction(f'Acc{i}', 5)
+    traced_dc.add_stock_symbol(f'SYM{i}', 'USD')
+    traced_dc.add_share_transaction(f'SYM{i}', 1, -10)
+
+  def get_accounts():
+    for acc in traced_dc.get_all_accounts():
+      acc.get_balance()
+      acc.get_diff_to_last()
+
+  def get_overviews():
+    for so in traced_dc.get_all_symbol_overviews():
+      assert so.quantity == 1
+
+  assert _num_queries(traced_dc, get_accounts) == 1
+  assert _num_queries(traced_dc, get_overviews) == 1
+
+
+def test_failed_refresh_is_counted(traced_dc):
+  with pytest.raises(ValueError):
+    with traced_dc.trace_refresh('failing'):
+      traced_dc.create_account('Acc', 'USD')
+      raise ValueError()
+  name, queries, _ = traced_dc.trace.refreshes[-1]
+  assert name == 'failing'
+  assert queries > 0
+
+
+def test_slow_queries_are_explained(traced_dc):
+  traced_dc.trace.slow_threshold_s = 0
+  traced_dc.create_account('Acc', 'USD')
+  traced_dc.get_balance('Acc')
+  report = '\n'.join(traced_dc.trace.report())
+  assert 'Slow queries' in report
+  assert 'SEARCH' in report  # From EXPLAIN QUERY PLAN.
+  assert 'data_controller.py' in report  # Call sites.
@@ -1,30 +1,121 @@
-import symbol_values
+import gc
+import threading
 import time
 
+import pytest
+
+import symbol_values
+
+
+@pytest.fixture(autouse=True)
+def recorded_quotes(tmpdir):
+  path = str(tmpdir / 'quotes.jsonl')
+  for t, price in [(100, 10.), (200, 20.)]:
+    symbol_values.RecordedQuoteProvider.write(
+      path, 'AAPL', {'regularMarketOpen': price, 'shortName': 'Apple'}, t)
+  provider = symbol_values.RecordedQuoteProvider(path, clock=lambda: 150)
+  previous = symbol_values.set_provider(provider)
+  symbol_values._tickers.clear()
+  symbol_values._recent_tickers.clear()
+  yield provider
+  symbol_values.set_provider(previous)
+  symbol_values._tickers.clear()
+  symbol_values._recent_tickers.clear()
+
 
 def test_cache():
   aapl = symbol_values.Ticker('AAPL')
   assert aapl.queried is None
-  aapl.current_value()
+  aapl.lazy_update().result()
+  assert aapl.get_current_value() == 10.
   last_queried = aapl.queried
   assert last_queried is not None
-  time.sleep(0.1)
-  aapl.current_value()
+  assert aapl.lazy_update() is None
+  aapl.get_current_value()
   # Make sure we are using the cache!
   assert aapl.queried == last_queried
 
 
 def test_global_cache():
-  while symbol_values._tickers:
-    symbol_values._tickers.popitem()
   aapl = symbol_values.Ticker.make('AAPL')
   assert aapl.queried is None
-  aapl.current_value()
+  aapl.lazy_update().result()
   last_queried = aapl.queried
   assert last_queried is not None
   aapl = symbol_values.Ticker.make('AAPL')
-  time.sleep(0.1)
-  aapl.current_value()
+  aapl.get_current_value()
   # Make sure we are using the cache!
   assert aapl.queried == last_queried
 
+
+def test_replay_clock(recorded_quotes):
+  recorded_quotes.clock = lambda: 250
+  aapl = symbol_values.Ticker.make('AAPL')
+  aapl.lazy_update().result()
+  assert aapl.get_current_value() == 20.
+  with pytest.raises(symbol_values.QuoteError):
+    symbol_values.Ticker.make('MSFT').lazy_update().result()
+
+
+def test_recorded_time_zero(tmpdir):
+  path = str(tmpdir / 'zero.jsonl')
+  for t, price in [(0, 5.), (100, 10.)]:
+    symbol_values.RecordedQuoteProvider.write(
+      path, 'AAPL', {'regularMarketOpen': price}, t)
+  provider = symbol_values.RecordedQuoteProvider(path, clock=lambda: 50)
+  assert provider.fetch('AAPL') == {'regularMarketOpen': 5.}
+
+
+def test_simulated_errors_are_retried(recorded_quotes):
+  provider = symbol_values.SimulatedQuoteProvider(
+    recorded_quotes, latency_s=0., latency_jitter_s=0., error_rate=0.5, seed=0)
+  symbol_values.set_provider(provider)
+  assert symbol_values.check_symbols(['AAPL']) == {'AAPL': 'Apple'}
+  assert provider.num_fetches == provider.num_errors + 1
+
+
+def test_check_symbols_skips_failures(recorded_quotes):
+  assert symbol_values.check_symbols(['AAPL', 'MSFT'],
+                                     timeout_s=10) == {'AAPL': 'Apple'}
+
+
+def test_check_symbols_abandons_slow_fetches(recorded_quotes):
+  release = threading.Event()
+
+  class SlowProvider(symbol_values.QuoteProvider):
+    def fetch(self, symbol_name):
+      if symbol_name == 'SLOW':
+        release.wait()
+      return recorded_quotes.fetch('AAPL')
+
+  symbol_values.set_provider(SlowProvider())
+  try:
+    start = time.monotonic()
+    assert symbol_values.check_symbols(['SLOW', 'A', 'B'], timeout_s=0.2) == {
+      'A': 'Apple', 'B': 'Apple'}
+    assert time.monotonic() - start < 5
+    # The slow fetch doesn't hold the workers that update the tickers.
+    quote = symbol_values.Ticker.make('AAPL').lazy_update().result(timeout=5)
+    assert quote.price == 10.
+  finally:
+    release.set()
+
+
+def test_quote_is_trimmed():
+  quote = symbol_values.Ticker.make('AAPL').lazy_update().result()
+  assert (quote.symbol, quote.price, quote.short_name) == ('AAPL', 10., 'Apple')
+  assert not hasattr(quote, '__dict__')
+
+
+def test_tickers_are_evicted(monkeypatch):
+  monkeypatch.setattr(symbol_values, '_MAX_TICKERS', 3)
+  held = symbol_values.Ticker.make('HELD')
+  for symbol_name in ['A', 'B', 'C']:
+    symbol_values.Ticker.make(symbol_name)
+  symbol_values.Ticker.make('A')  # Now most recently used.
+  symbol_values.Ticker.make('D')
+  assert list(symbol_values._recent_tickers) == ['C', 'A', 'D']
+  gc.collect()
+  assert sorted(symbol_values._tickers) == ['A', 'C', 'D', 'HELD']
+  # Still in use, so not replaced by a second ticker.
+  assert symbol_values.Ticker.make('HELD') is held